@@ -10,69 +10,287 @@ Usage locally:
 
 
 
-from flask import Flask, request, render_template_string, jsonify
-import pandas as pd
-import os
+from flask import Flask, request, render_template_string, jsonify, Response
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 import ast
-from huggingface_hub import InferenceClient
+import json
+import time
+from array import array
+from concurrent.futures import as_completed
+from math import nan, isnan
+from serving.backends import get_backend
+from serving.chunking import get_chunker, hypothesis_tokens, chunk_aggregation, aggregate
+from serving.fanout import fanout, gather, ItemError
+from serving.cache import prediction_cache
+from serving.singleflight import singleflight
+from serving.batching import batcher_from_env, batching_enabled
+from serving.jobs import job_store_from_env, job_runner_from_env
+from serving.resilience import resilience_from_env
+from serving.deadline import DeadlineExceeded, latest as latest_deadline
+from serving.threshold import decision_threshold
+from serving.cascade import cascade_from_env
+from serving.admission import (AdmissionError, limits_from_env, job_limits_from_env, admission_from_env,
+                               trusted_proxies_from_env)
+from serving.metrics import (metrics, request_latency, review_length, reviews_scored, review_errors, cache_lookups,
+                             cascade_reviews, cascade_stage_latency, rejected_requests)
 #from dotenv import load_dotenv
 #load_dotenv()  # Loads from .env
 
-my_token=os.getenv("HUGGING_FACE_TOKEN")
-
+model_name='MoritzLaurer/DeBERTa-v3-large-mnli-fever-anli-ling-wanli'
+aggregation=chunk_aggregation() # how the scores of the windows of a long review are combined
+resilience=resilience_from_env() # retries, request deadline and circuit breaker around the calls to the model
+threshold=decision_threshold() # positive score above which a review is predicted as positive
+cascade=cascade_from_env(aggregation) # small model scoring reviews before the zero-shot one (PREDICT_CASCADE=1), or None
+# Scores depend on the model, the chunk aggregation and the cascade, so all of them are part of the cache keys
+score_key=f"{model_name}/{aggregation}" + (f"/{cascade.key}" if cascade is not None else "")
+limits=limits_from_env() # maximum reviews, characters and body size of a prediction request
+job_limits=job_limits_from_env() # same for the files of bulk jobs
+admission=admission_from_env() # bound of the reviews in flight per worker, and per client if ADMISSION_CLIENT_SHARE is set
 
 
 app = Flask(__name__)
+trusted_proxies=trusted_proxies_from_env() # proxies whose X-Forwarded-For entries give the address of the client
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+
+
+def classify_windows(backend, reviews, positive_label, negative_label, deadline=None):
+    """
+    Splits reviews into windows that fit the maximum sequence length of the model, and scores the windows of all the
+    reviews in a single call to the backend.
+
+    Args:
+        backend (Backend): backend used to score
+        reviews (list): reviews to score
+        positive_label (str): label indicating positive review
+        negative_label (str): label indicating negative review
+        deadline (Deadline): deadline of the request, after which failed calls are not retried
+
+    Returns:
+        outputs (list): for every review, the list of outputs of the model for each of its windows
+    """
+    candidate_labels = [positive_label, negative_label]
+    chunker = get_chunker(model_name, reserved_tokens=hypothesis_tokens(candidate_labels))
+    windows = [chunker.split(review) for review in reviews]
+    window_outputs = backend.zero_shot_classification([window for review_windows in windows for window in review_windows],
+                                                      candidate_labels = candidate_labels, deadline = deadline)
+    outputs = []
+    start = 0
+    for review_windows in windows:
+        outputs.append(window_outputs[start:start + len(review_windows)])
+        start += len(review_windows)
+    return outputs
+
+
+def positive_score_of(window_outputs, positive_label):
+    """
+    Extracts the positive score of a review from the outputs of the model for its windows.
+
+    Args:
+        window_outputs (list): outputs of the model for every window of the review
+        positive_label (str): label indicating positive review
+
+    Returns:
+        positive_score (float): scores of the positive label in the windows, combined with the chunk aggregation
+    """
+    window_scores = [item["score"] for output in window_outputs for item in output if item["label"] == positive_label]
+    return aggregate(window_scores, aggregation)
+
+
+def score_batch(items):
+    """
+    Sends a batch of reviews gathered by the micro-batcher to the model. Backends able to score many texts at once get
+    a single call per set of labels, the remote one gets concurrent calls of one review each, on the threads of the
+    batcher. Every review keeps the deadline of its request, reviews whose deadline passed while queued are not sent.
 
+    Args:
+        items (list): tuples of (review, positive_label, negative_label, deadline)
 
-def get_sentiment(reviews, positive_label, negative_label):
+    Returns:
+        outputs (list): outputs of the windows of every item, or the exception raised by its call
     """
-    Calculates sentiment of a review or a list of reviews. 
+    backend = resilience.wrap(get_backend(model_name))
+    if not backend.batched:
+        outputs = batcher.fanout.map(lambda item: classify_windows(backend, [item[0]], item[1], item[2], item[3])[0],
+                                     items)
+        return [output.exception if isinstance(output, ItemError) else output for output in outputs]
+
+    outputs = [None] * len(items)
+    groups = {}
+    for i, (review, positive_label, negative_label, deadline) in enumerate(items):
+        if deadline is not None and deadline.remaining() == 0:
+            outputs[i] = DeadlineExceeded("Request deadline exceeded while waiting for a batch")
+            continue
+        groups.setdefault((positive_label, negative_label), []).append(i)
+    for (positive_label, negative_label), indices in groups.items():
+        try:
+            # A single call for reviews of several requests, it may go on until the last of their deadlines
+            group_outputs = classify_windows(backend, [items[i][0] for i in indices], positive_label, negative_label,
+                                             latest_deadline([items[i][3] for i in indices]))
+        except Exception as e:
+            group_outputs = [e] * len(indices)
+        for i, output in zip(indices, group_outputs):
+            outputs[i] = output
+    return outputs
+
+
+# Micro-batching of reviews coming from concurrent requests (PREDICT_BATCHING=1)
+batcher = batcher_from_env(score_batch) if batching_enabled() else None
+
+
+def get_sentiment(reviews, positive_label, negative_label, endpoint="json"):
+    """
+    Calculates sentiment of a review or a list of reviews. Calls to the model are made concurrently (up to
+    PREDICT_CONCURRENCY at a time per worker), and long reviews are scored in windows fitting the model. Failed calls
+    are retried until the deadline of the request (PREDICT_DEADLINE), and fail fast while the model is unavailable.
+    With the cascade, only the reviews the first stage model is unsure about are sent to the zero-shot model.
 
     Args:
         reviews (str or list): a single review (str) or a list of reviews (list)
         positive_label (str): label indicating positive review
         negative_label (str): label indicating negative review
+        endpoint (str): label of the metrics recorded for the request ("json" or "form")
 
     Returns:
-        outputs_list (list): list with the sentiment of the reviews (positive or negative).
+        outputs_list (list): list with the sentiment of the reviews (positive or negative), in the same order as the
+        input. Reviews whose call failed get a dictionary with the error instead.
     """
     # Make sure input is a list (output of hf is 3 classes if a string is given, or just the top class if a list is given)
     if not isinstance(reviews, list):
         reviews = [reviews]
-    client=InferenceClient(
-        model='MoritzLaurer/DeBERTa-v3-large-mnli-fever-anli-ling-wanli',
-        token=my_token
-        )
-    
-    # Inference for all reviews
-    all_rows = []
-    for i, review in enumerate(reviews):
-        review = review[:4010] # truncation of long reviews to the maximum we have seen
-        output = client.zero_shot_classification(review, candidate_labels = [positive_label, negative_label])
-        for item in output:
-            all_rows.append({
-                "review_index": i,
-                "review" : review, 
-                "label": item["label"],
-                "score": item["score"]
-            })
-
-    # Create DataFrame
-    df = pd.DataFrame(all_rows)
-
-    # Extract positive score only
-    df = df[df["label"] == positive_label].reset_index(drop=True)
-
-    # Format output df 
-    df.drop(columns=['label'], inplace=True)
-    df.rename(columns={'score':'positive_score'}, inplace=True)
-
-    outputs_list = ['positive' if score > 0.5 else 'negative' for score in df['positive_score']]
+    backend = resilience.wrap(get_backend(model_name)) # shared by all requests, see SENTIMENT_BACKEND
+    deadline = resilience.new_deadline()
+
+    # Reviews already scored are served from the cache. Long reviews are not truncated but scored in windows, whose
+    # scores are combined with the chunk aggregation, so it is part of the key
+    keys = [prediction_cache.make_key(score_key, positive_label, negative_label, review) for review in reviews]
+    positive_scores = array('d', (nan if score is None else score for score in map(prediction_cache.get, keys)))
+
+    # Duplicated reviews are scored once. Only the first position of every missing review is sent to the model
+    first_index = {}
+    for i, score in enumerate(positive_scores):
+        if isnan(score): # not cached
+            first_index.setdefault(keys[i], i)
+    missing = list(first_index.values())
+    # Repeats of a missing review within the request are neither hits nor calls to the model
+    hits = sum(1 for score in positive_scores if not isnan(score))
+    cache_lookups.inc(hits, model=model_name, endpoint=endpoint, result="hit")
+    cache_lookups.inc(len(first_index), model=model_name, endpoint=endpoint, result="miss")
+    cache_lookups.inc(len(reviews) - hits - len(first_index), model=model_name, endpoint=endpoint, result="duplicate")
+
+    # The first stage of the cascade scores the missing reviews, and only the uncertain ones go on to the zero-shot model
+    if cascade is not None and missing:
+        start = time.perf_counter()
+        first_scores = cascade.score([reviews[i] for i in missing], deadline)
+        cascade_stage_latency.observe(time.perf_counter() - start, endpoint=endpoint, stage="first")
+        for i, score in zip(missing, first_scores):
+            cascade_reviews.inc(model=cascade.model, endpoint=endpoint, outcome=cascade.outcome(score))
+            if not cascade.escalates(score):
+                positive_scores[i] = score
+                prediction_cache.set(keys[i], score)
+        missing = [i for i in missing if isnan(positive_scores[i])]
+
+    # Inference for the remaining reviews. Identical reviews already in flight in other requests are awaited
+    # instead of being sent again
+    start = time.perf_counter()
+    if batcher is not None:
+        # Reviews are grouped with the ones of other concurrent requests by the micro-batcher
+        futures = [
+            singleflight.submit(keys[i],
+                                lambda i=i: batcher.submit((reviews[i], positive_label, negative_label, deadline)))
+            for i in missing
+            ]
+        outputs = gather(futures)
+    else:
+        outputs = fanout.map(
+            lambda i: singleflight.do(
+                keys[i],
+                lambda: classify_windows(backend, [reviews[i]], positive_label, negative_label, deadline)[0]
+                ),
+            missing
+            )
+    if cascade is not None and missing:
+        cascade_stage_latency.observe(time.perf_counter() - start, endpoint=endpoint, stage="second")
+    errors = {i: output for i, output in zip(missing, outputs) if isinstance(output, ItemError)}
+
+    # Extract the positive score of every review straight from the outputs of the model
+    for i, window_outputs in zip(missing, outputs):
+        if i in errors:
+            continue
+        positive_scores[i] = positive_score_of(window_outputs, positive_label)
+        prediction_cache.set(keys[i], positive_scores[i])
+
+    # Duplicates get the result of their first occurrence
+    outputs_list = []
+    for i, key in enumerate(keys):
+        first = first_index.get(key, i)
+        if first in errors:
+            outputs_list.append(errors[first].to_dict())
+        else:
+            outputs_list.append('positive' if positive_scores[first] > threshold else 'negative')
+
+    failed = sum(1 for key in keys if first_index.get(key) in errors)
+    reviews_scored.inc(len(reviews) - failed, model=model_name, endpoint=endpoint)
+    review_errors.inc(failed, model=model_name, endpoint=endpoint)
+    for review in reviews:
+        review_length.observe(len(str(review)), model=model_name, endpoint=endpoint)
     return outputs_list
 
 
 
+def score_review(review, positive_label, negative_label, deadline=None, endpoint="stream"):
+    """
+    Calculates the positive score of a single review, going through the same cache, coalescing and cascade of
+    get_sentiment. Used where reviews are handled one by one, as in the streaming endpoint.
+
+    Args:
+        review (str): review to score
+        positive_label (str): label indicating positive review
+        negative_label (str): label indicating negative review
+        deadline (Deadline): deadline of the request (None for no deadline, as in bulk jobs)
+        endpoint (str): label of the metrics recorded for the review ("stream" or "job")
+
+    Returns:
+        positive_score (float): probability of the review being positive
+    """
+    review_length.observe(len(review), model=model_name, endpoint=endpoint)
+    key = prediction_cache.make_key(score_key, positive_label, negative_label, review)
+    positive_score = prediction_cache.get(key)
+    cache_lookups.inc(model=model_name, endpoint=endpoint, result="miss" if positive_score is None else "hit")
+    if positive_score is not None:
+        reviews_scored.inc(model=model_name, endpoint=endpoint)
+        return positive_score
+
+    if cascade is not None:
+        start = time.perf_counter()
+        positive_score = cascade.score([review], deadline)[0]
+        cascade_stage_latency.observe(time.perf_counter() - start, endpoint=endpoint, stage="first")
+        cascade_reviews.inc(model=cascade.model, endpoint=endpoint, outcome=cascade.outcome(positive_score))
+        if not cascade.escalates(positive_score):
+            prediction_cache.set(key, positive_score)
+            reviews_scored.inc(model=model_name, endpoint=endpoint)
+            return positive_score
+
+    backend = resilience.wrap(get_backend(model_name))
+    start = time.perf_counter()
+    try:
+        window_outputs = singleflight.do(
+            key, lambda: classify_windows(backend, [review], positive_label, negative_label, deadline)[0]
+            )
+    except Exception:
+        review_errors.inc(model=model_name, endpoint=endpoint)
+        raise
+    finally:
+        if cascade is not None:
+            cascade_stage_latency.observe(time.perf_counter() - start, endpoint=endpoint, stage="second")
+    positive_score = positive_score_of(window_outputs, positive_label)
+    prediction_cache.set(key, positive_score)
+    reviews_scored.inc(model=model_name, endpoint=endpoint)
+    return positive_score
+
+
+
 # HTML form template
 form_html = '''
 <!DOCTYPE html>
@@ -98,6 +316,59 @@ positive_label='a positive movie review (regardless if the movie context is nega
 negative_label='a negative movie review (regardless if the movie context is positive)'
 
 
+def score_chunk(reviews):
+    """
+    Scores a chunk of reviews of a bulk job.
+
+    Args:
+        reviews (list): reviews to score
+
+    Returns:
+        positive_scores (list): positive score of every review, or the exception raised while scoring it
+    """
+    outputs = fanout.map(lambda review: score_review(review, positive_label, negative_label, endpoint="job"), reviews)
+    return [output.exception if isinstance(output, ItemError) else output for output in outputs]
+
+
+def read_reviews_file(file):
+    """
+    Reads the reviews of a bulk job, either a csv like data/inputs/IMDB-movie-reviews.csv (semicolon separated, with a
+    review and optionally a sentiment column) or a json list of such records.
+
+    Args:
+        file (FileStorage): uploaded file
+
+    Returns:
+        reviews (list): reviews to score
+        targets (list or None): ground truth sentiments, if the file has them
+    """
+    if file.filename.lower().endswith('.json'):
+        records = json.load(file)
+        if not isinstance(records, list):
+            raise ValueError("expected a json list of reviews")
+        records = [record if isinstance(record, dict) else {'review': record} for record in records]
+        reviews = [record['review'] for record in records]
+        targets = [record['sentiment'] for record in records] if all('sentiment' in record for record in records) else None
+    else:
+        import pandas as pd # only needed here, kept out of the startup of the workers
+        data = pd.read_csv(file, sep=';', encoding='latin-1', dtype={'review': str})
+        reviews = list(data['review'])
+        targets = list(data['sentiment']) if 'sentiment' in data.columns else None
+    return reviews, targets
+
+
+# Bulk jobs are persisted, and every worker scores queued (or interrupted) jobs in the background. The runner is
+# started on the first request of the worker, as threads started at import time would not survive the fork of the
+# gunicorn workers (with --preload)
+job_store = job_store_from_env()
+job_runner = job_runner_from_env(job_store, score_chunk, threshold)
+
+
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+
+
 @app.route('/', methods=['GET'])
 def index():
     """
@@ -108,36 +379,251 @@ def index():
     """
     return render_template_string(form_html, sentiment=None)
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Returns the hit and miss counters of the prediction cache of the worker that handles the request.
+
+    Returns:
+        Json with the counters.
+    """
+    return jsonify(prediction_cache.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the latency, volume and error metrics of the worker that handles the request, in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def prediction_endpoint():
+    """
+    Returns:
+        endpoint (str): label of the metrics of the current prediction request ("json", "form", "stream" or "job")
+    """
+    if request.path.endswith('/stream'):
+        return "stream"
+    if request.path == '/jobs':
+        return "job"
+    return "json" if request.is_json else "form"
+
+
+def check_size(reviews, endpoint):
+    """
+    Checks the number of reviews and characters of a prediction request.
+
+    Args:
+        reviews (list): reviews of the request
+        endpoint (str): label of the metrics of the request
+
+    Raises:
+        AdmissionError: with status 413 if the request is over a limit
+    """
+    try:
+        limits.check(reviews)
+    except AdmissionError as e:
+        rejected_requests.inc(endpoint=endpoint, reason=e.reason)
+        raise
+
+
+def admit(reviews, endpoint):
+    """
+    Checks the size of a prediction request and admits its reviews in the worker.
+
+    Args:
+        reviews (str or list): a single review (str) or a list of reviews (list)
+        endpoint (str): label of the metrics of the request
+
+    Returns:
+        ticket (Ticket): reviews admitted, to be released with admission.release once the request is answered
+
+    Raises:
+        AdmissionError: if the request is too large (413) or the worker or the client has too many reviews in
+        flight (429)
+    """
+    reviews = reviews if isinstance(reviews, list) else [reviews]
+    check_size(reviews, endpoint)
+    try:
+        return admission.acquire(admission.client_of(request), len(reviews))
+    except AdmissionError as e:
+        rejected_requests.inc(endpoint=endpoint, reason=e.reason)
+        raise
+
+
+@app.errorhandler(AdmissionError)
+def reject_request(e):
+    """
+    Answers requests rejected by admission control right away, with Retry-After when retrying later can help.
+    """
+    return jsonify(e.to_dict()), e.status, e.headers()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def reject_large_body(e):
+    """
+    Answers requests whose body is larger than PREDICT_MAX_BODY_BYTES (JOB_MAX_BODY_BYTES for bulk jobs), found while
+    reading it.
+    """
+    rejected_requests.inc(endpoint=prediction_endpoint(), reason="body")
+    return jsonify({"error": f"Request body too large, the maximum is {request.max_content_length} bytes"}), 413
+
+
 @app.route('/predict', methods=['POST'])
 def predict_sentiment(): 
     """
-    Calculates and returns sentiments of a review or a list of reviews. Works both as an api or a webapp.
+    Calculates and returns sentiments of a review or a list of reviews. Works both as an api or a webapp. Requests over
+    the size limits are answered with 413, and with 429 when the worker is busy (see admission).
 
     Returns:
         Template with the reviews and their sentiment.
     """
+    start = time.perf_counter()
+    request.max_content_length = limits.max_body_bytes # the body is not read beyond it
     if request.is_json:  # Applies for curl requests
         body = request.get_json()
         review = body.get("review", "")
         if not review:
             return jsonify({"error": "Missing review"}), 400
-        sentiments = get_sentiment(review, positive_label, negative_label)
+        ticket = admit(review, "json")
+        try:
+            sentiments = get_sentiment(review, positive_label, negative_label, endpoint="json")
+        finally:
+            admission.release(ticket)
+        request_latency.observe(time.perf_counter() - start, model=model_name, endpoint="json")
         return jsonify(sentiments), 200
 
     else: #Applies for request from html template
         review = request.form.get('review', '')  
 
-        try: # In case a list was received, to be able to treat it as such
-            review = ast.literal_eval(review)
-        except:
-            review = review
-
-        sentiments = get_sentiment(review, positive_label, negative_label)
+        try:
+            check_size([review], "form") # the text is bounded before being parsed
+            try: # In case a list was received, to be able to treat it as such
+                review = ast.literal_eval(review)
+            except:
+                review = review
+            ticket = admit(review, "form")
+        except AdmissionError as e:
+            return render_template_string(form_html, sentiment=e.to_dict(), review=review), e.status, e.headers()
+        try:
+            sentiments = get_sentiment(review, positive_label, negative_label, endpoint="form")
+        finally:
+            admission.release(ticket)
+        request_latency.observe(time.perf_counter() - start, model=model_name, endpoint="form")
         if len(sentiments)==1:  #Cleaner output in case a single review is given
             sentiments=sentiments[0]
         return render_template_string(form_html, sentiment=sentiments, review=review)
     
 
+@app.route('/predict/stream', methods=['POST'])
+def predict_sentiment_stream():
+    """
+    Calculates sentiments of a list of reviews and streams them as newline-delimited json while they are ready, so the
+    first results arrive after about one call to the model. Lines come in order of completion and carry the index of
+    the review in the input. Reviews that were not started yet are dropped if the client disconnects. Admission
+    control applies as in /predict, and the reviews stay admitted until the stream is closed.
+
+    Returns:
+        Stream of json lines like {"index": 0, "prediction": "positive", "positive_score": 0.97}, or
+        {"index": 0, "error": "..."} for reviews whose call failed.
+    """
+    request.max_content_length = limits.max_body_bytes # the body is not read beyond it
+    body = request.get_json(silent=True) or {}
+    reviews = body.get("review", "")
+    if not reviews:
+        return jsonify({"error": "Missing review"}), 400
+    if not isinstance(reviews, list):
+        reviews = [reviews]
+    ticket = admit(reviews, "stream")
+
+    def generate():
+        start = time.perf_counter()
+        deadline = resilience.new_deadline()
+        futures = {
+            fanout.executor.submit(score_review, review, positive_label, negative_label, deadline): i
+            for i, review in enumerate(reviews)
+            }
+        try:
+            for future in as_completed(futures):
+                line = {"index": futures[future]}
+                try:
+                    positive_score = future.result()
+                    line["prediction"] = 'positive' if positive_score > threshold else 'negative'
+                    line["positive_score"] = positive_score
+                except Exception as e:
+                    line.update(ItemError(e).to_dict())
+                yield json.dumps(line) + "\n"
+        finally:
+            # Runs also when the client disconnects and the server closes the generator
+            for future in futures:
+                future.cancel()
+            request_latency.observe(time.perf_counter() - start, model=model_name, endpoint="stream")
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    # Called by the server once the response is closed, even if the stream was never started
+    response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Queues a bulk scoring job for an uploaded csv or json file (form field "file").
+
+    Returns:
+        Json with the id of the job and the url to follow its progress. Files over the job limits are answered with
+        413, and files with empty reviews with 400.
+    """
+    request.max_content_length = job_limits.max_body_bytes # the upload is not read beyond it
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({"error": "Missing file"}), 400
+    try:
+        reviews, targets = read_reviews_file(file)
+    except Exception as e:
+        return jsonify({"error": f"Could not read file: {e}"}), 400
+    if not reviews:
+        return jsonify({"error": "Missing review"}), 400
+    # Empty cells of a csv are read as nan
+    empty = [i for i, review in enumerate(reviews) if not isinstance(review, str) or not review.strip()]
+    if empty:
+        return jsonify({"error": f"{len(empty)} empty or missing reviews, at rows {empty[:10]}"}), 400
+    try:
+        job_limits.check(reviews)
+    except AdmissionError as e:
+        rejected_requests.inc(endpoint="job", reason=e.reason)
+        raise
+
+    job_id = job_store.create(reviews, targets)
+    return jsonify({"id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Returns the status, progress and throughput of a bulk job.
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] == "done":
+        job["predictions_url"] = f"/jobs/{job_id}/predictions"
+    return jsonify(job), 200
+
+@app.route('/jobs/<job_id>/predictions', methods=['GET'])
+def get_job_predictions(job_id):
+    """
+    Downloads the predictions of a finished bulk job, in the format of the predictions.csv files of the runs.
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] != "done":
+        return jsonify({"error": "Job not finished yet", "progress": job["progress"]}), 409
+    return Response(
+        job_store.export_predictions(job_id),
+        mimetype='text/csv',
+        headers={"Content-Disposition": f"attachment; filename=predictions-{job_id}.csv"}
+        )
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -158,6 +644,12 @@ if __name__ == '__main__':
 #curl -X POST http://127.0.0.1:5000/predict -H "Content-Type: application/json" -d '{"review": "I am alright and you?"}'
 # In a list, double members inside it should appear in double quotes
 #curl -X POST http://127.0.0.1:5000/predict -H "Content-Type: application/json" -d '{"review": ["Me again", "Trump is blonde", "I hated it"]}'
+# Results of a list streamed as they are ready (-N disables the buffering of curl)
+#curl -N -X POST http://127.0.0.1:5000/predict/stream -H "Content-Type: application/json" -d '{"review": ["Me again", "Trump is blonde", "I hated it"]}'
+# Bulk job with a whole file, then follow it and download the predictions when it is done
+#curl -X POST http://127.0.0.1:5000/jobs -F "file=@data/inputs/IMDB-movie-reviews.csv"
+#curl http://127.0.0.1:5000/jobs/<id>
+#curl -o predictions.csv http://127.0.0.1:5000/jobs/<id>/predictions
 
 
 #curl -X POST https://sentiment-usecase.onrender.com/predict -H "Content-Type: application/json" -d '{"review": ["Me again", "Love", "I hated it"]}'
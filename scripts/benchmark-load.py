@@ -0,0 +1,218 @@
+"""
+benchmark-load.py
+
+Load test of flask-app.py over http. The app is started under the flask development server or gunicorn, with the
+inference api replaced by a local stub server (see utils/stub_inference_server.py) of configurable latency and errors,
+so serving changes can be compared without calling the real api.
+
+/predict is driven with a mix of single reviews and lists at increasing concurrency. For every concurrency level the
+benchmark reports throughput, p50/p95/p99 latency and error rates (http errors and reviews answered with an error).
+The prediction cache is disabled and every review is unique, so every review goes to the stub.
+
+Usage:
+    python benchmark-load.py --server gunicorn --gunicorn_workers 2 --concurrency 1 4 16 --latency_ms 150 --output load.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Add scripts/utils/ to path, to load the stub server
+sys.path.append(str(Path(__file__).resolve().parent / "utils"))
+from stub_inference_server import start_stub_server, add_behaviour_args, behaviour_from_args
+
+
+base_dir = Path(__file__).resolve().parent.parent
+
+
+def load_reviews(limit=1000):
+    """
+    Reviews of the test data (read without pandas, so the benchmark has no dependencies), or synthetic ones if the
+    file is not there.
+    """
+    path = base_dir / "data" / "inputs" / "IMDB-movie-reviews.csv"
+    if not path.exists():
+        return [f"A film with some plot and some actors, review number {i}." for i in range(limit)]
+    with open(path, newline="", encoding="latin-1") as f:
+        return [row["review"] for row, _ in zip(csv.DictReader(f, delimiter=";"), range(limit))]
+
+
+def app_env(tmp_dir, stub_url):
+    """
+    Environment of the app: model calls go to the stub, and the caches and job queue of the real app are not touched.
+    """
+    env = dict(os.environ)
+    env.update({
+        "HF_ENDPOINT_URL": stub_url,
+        "HUGGING_FACE_TOKEN": env.get("HUGGING_FACE_TOKEN", "stub"),
+        "SENTIMENT_BACKEND": "remote",
+        "PREDICTION_CACHE_SIZE": "0",
+        "PREDICTION_CACHE_PATH": "",
+        "JOBS_DB_PATH": str(Path(tmp_dir) / "jobs.sqlite"),
+    })
+    return env
+
+
+def start_app(server, port, env, gunicorn_workers, gunicorn_threads, log_file):
+    """
+    Starts the app in a subprocess.
+
+    Args:
+        server (str): "dev" (flask development server, threaded) or "gunicorn"
+        port (int): port of the app
+        log_file (file): file receiving the output of the server (a pipe would block it once full)
+
+    Returns:
+        process (Popen): process of the app
+    """
+    if server == "dev":
+        command = [sys.executable, "-m", "flask", "--app", "flask-app", "run", "--port", str(port), "--with-threads"]
+    elif server == "gunicorn":
+        command = ["gunicorn", "--workers", str(gunicorn_workers), "--threads", str(gunicorn_threads),
+                   "--bind", f"127.0.0.1:{port}", "flask-app:app"]
+    else:
+        raise ValueError(f"Unknown server {server!r}, expected 'dev' or 'gunicorn'")
+    return subprocess.Popen(command, cwd=base_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(url, process, log_path, timeout=60):
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited before serving requests:\n{Path(log_path).read_text()}")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise TimeoutError(f"The app did not answer at {url} after {timeout} seconds")
+
+
+def send_request(url, reviews):
+    """
+    Sends a /predict request.
+
+    Returns:
+        result (tuple): seconds, http status, reviews sent, and reviews answered with an error
+    """
+    payload = reviews[0] if len(reviews) == 1 else reviews
+    data = json.dumps({"review": payload}).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            body = json.loads(response.read())
+            status = response.status
+    except urllib.error.HTTPError as e:
+        return time.perf_counter() - start, e.code, len(reviews), len(reviews)
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return time.perf_counter() - start, 0, len(reviews), len(reviews)
+    item_errors = sum(1 for item in body if isinstance(item, dict) and "error" in item)
+    return time.perf_counter() - start, status, len(reviews), item_errors
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run_level(url, reviews, concurrency, n_requests, list_ratio, list_size, rng, level):
+    """
+    Sends n_requests to the app with concurrency requests in flight at a time.
+
+    Returns:
+        results (dict): throughput, latency percentiles and error rates of the level
+    """
+    payloads = []
+    for n in range(n_requests):
+        size = list_size if rng.random() < list_ratio else 1
+        # Unique reviews, so the requests are not coalesced with each other
+        payloads.append([f"{rng.choice(reviews)} ({level}-{n}-{i})" for i in range(size)])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda payload: send_request(url, payload), payloads))
+    duration = time.perf_counter() - start
+
+    latencies = [seconds for seconds, _, _, _ in results]
+    n_reviews = sum(sent for _, _, sent, _ in results)
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "reviews": n_reviews,
+        "duration": duration,
+        "requests_per_second": n_requests / duration,
+        "reviews_per_second": n_reviews / duration,
+        "latency_mean": statistics.fmean(latencies),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "http_error_rate": sum(1 for _, status, _, _ in results if status != 200) / n_requests,
+        "review_error_rate": sum(errors for _, _, _, errors in results) / n_reviews,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test of the flask app against a stub inference server")
+    parser.add_argument('--server', choices=["dev", "gunicorn"], default="dev", help='Server running the app')
+    parser.add_argument('--gunicorn_workers', type=int, default=2, help='Worker processes of gunicorn')
+    parser.add_argument('--gunicorn_threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--port', type=int, default=5055, help='Port of the app')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='Requests in flight')
+    parser.add_argument('--requests', type=int, default=200, help='Requests sent per concurrency level')
+    parser.add_argument('--list_ratio', type=float, default=0.3, help='Fraction of requests sending a list')
+    parser.add_argument('--list_size', type=int, default=10, help='Reviews of the list requests')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the payloads')
+    parser.add_argument('--output', type=str, default=None, help='Json file where results are written')
+    add_behaviour_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    behaviour = behaviour_from_args(args)
+    stub = start_stub_server(behaviour=behaviour)
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+    app_url = f"http://127.0.0.1:{args.port}"
+
+    with tempfile.TemporaryDirectory() as tmp_dir, open(Path(tmp_dir) / "app.log", "w") as log_file:
+        process = start_app(args.server, args.port, app_env(tmp_dir, stub_url), args.gunicorn_workers,
+                            args.gunicorn_threads, log_file)
+        try:
+            wait_until_ready(app_url + "/", process, log_file.name)
+            rng = random.Random(args.seed)
+            reviews = load_reviews()
+            levels = []
+            for concurrency in args.concurrency:
+                levels.append(run_level(app_url + "/predict", reviews, concurrency, args.requests, args.list_ratio,
+                                        args.list_size, rng, len(levels)))
+                print(json.dumps(levels[-1]))
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            stub.shutdown()
+
+    results = {
+        "server": args.server,
+        "gunicorn_workers": args.gunicorn_workers if args.server == "gunicorn" else None,
+        "gunicorn_threads": args.gunicorn_threads if args.server == "gunicorn" else None,
+        "stub": {key: getattr(behaviour, key) for key in ("latency_ms", "jitter_ms", "distribution", "error_rate",
+                                                          "error_status")},
+        "stub_calls": behaviour.calls,
+        "payloads": {"list_ratio": args.list_ratio, "list_size": args.list_size, "seed": args.seed},
+        "levels": levels,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,203 @@
+
+"""
+benchmark-serving-overhead.py
+
+Measures the overhead that flask-app.py adds on top of the model:
+
+* boot time: seconds a fresh interpreter (like a new gunicorn worker) needs to import the app
+* request overhead: time spent per /predict request outside the model, using a stub backend that answers instantly
+  (cache disabled, so every review goes through the whole scoring path)
+* score extraction: the previous pandas-based extraction of positive scores against the current one, on the same
+  model outputs
+
+Boot time can be compared with an older version of the app, e.g.:
+    git show e6c4319:flask-app.py > old-flask-app.py
+    python benchmark-serving-overhead.py --app old-flask-app.py
+
+Usage:
+    python benchmark-serving-overhead.py --repeats 5 --requests 200 --output overhead.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+base_dir = Path(__file__).resolve().parent.parent
+
+positive_label = 'a positive movie review (regardless if the movie context is negative)'
+negative_label = 'a negative movie review (regardless if the movie context is positive)'
+
+
+def isolated_env(tmp_dir):
+    """
+    Environment variables keeping the benchmark away from the caches and job queue of the real app.
+    """
+    env = dict(os.environ)
+    env.update({
+        "PREDICTION_CACHE_SIZE": "0",
+        "PREDICTION_CACHE_PATH": "",
+        "JOBS_DB_PATH": str(Path(tmp_dir) / "jobs.sqlite"),
+        "SENTIMENT_BACKEND": "remote",
+    })
+    return env
+
+
+def measure_boot_time(app_path, repeats, env):
+    """
+    Imports the app in fresh interpreters.
+
+    Returns:
+        times (list): seconds to import the app, one per repetition
+    """
+    code = (
+        "import importlib.util, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"spec = importlib.util.spec_from_file_location('flask_app', {str(app_path)!r})\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "spec.loader.exec_module(module)\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=Path(app_path).parent, env=env,
+                                capture_output=True, text=True, check=True)
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return times
+
+
+class StubBackend:
+    """
+    Backend answering instantly with fixed scores, so only the overhead of the app is measured.
+    """
+
+    batched = False
+
+    def __init__(self, model):
+        self.model = model
+
+    def zero_shot_classification(self, texts, candidate_labels, deadline=None):
+        return [[{"label": candidate_labels[0], "score": 0.75}, {"label": candidate_labels[1], "score": 0.25}]
+                for _ in texts]
+
+
+def measure_request_overhead(app_path, requests, list_sizes):
+    """
+    Sends requests to the app through the flask test client, with the model replaced by StubBackend.
+
+    Returns:
+        results (dict or None): per list size, mean and percentiles of the seconds per request and per review. None if
+        the app does not score through get_backend.
+    """
+    spec = importlib.util.spec_from_file_location("flask_app", app_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, str(Path(app_path).parent))
+    spec.loader.exec_module(module)
+    if not hasattr(module, "get_backend"):
+        return None  # older versions of the app call the inference api directly and can not be stubbed
+    module.get_backend = StubBackend
+    client = module.app.test_client()
+
+    results = {}
+    for size in list_sizes:
+        times = []
+        for n in range(requests):
+            reviews = [f"Review {n}-{i} of the benchmark, a film with some plot and some actors." for i in range(size)]
+            start = time.perf_counter()
+            response = client.post("/predict", json={"review": reviews})
+            times.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.data
+        results[size] = summarize(times)
+        results[size]["mean_per_review"] = results[size]["mean"] / size
+    return results
+
+
+def legacy_extraction(outputs):
+    """
+    Positive scores extracted as flask-app.py did before, through a pandas DataFrame.
+    """
+    import pandas as pd
+    all_rows = []
+    for i, output in enumerate(outputs):
+        for item in output:
+            all_rows.append({"review_index": i, "review": "", "label": item["label"], "score": item["score"]})
+    df = pd.DataFrame(all_rows)
+    df = df[df["label"] == positive_label].reset_index(drop=True)
+    df.drop(columns=['label'], inplace=True)
+    df.rename(columns={'score': 'positive_score'}, inplace=True)
+    return ['positive' if score > 0.5 else 'negative' for score in df['positive_score']]
+
+
+def current_extraction(outputs):
+    """
+    Positive scores extracted directly from the outputs of the model, as flask-app.positive_score_of does.
+    """
+    sys.path.insert(0, str(base_dir))
+    from serving.chunking import aggregate
+    scores = [aggregate([item["score"] for item in output if item["label"] == positive_label], "mean")
+              for output in outputs]
+    return ['positive' if score > 0.5 else 'negative' for score in scores]
+
+
+def measure_extraction(list_sizes, repeats=200):
+    results = {}
+    for size in list_sizes:
+        outputs = StubBackend("stub").zero_shot_classification(["review"] * size, [positive_label, negative_label])
+        results[size] = {}
+        for name, extraction in (("pandas", legacy_extraction), ("direct", current_extraction)):
+            try:
+                extraction(outputs)  # warm up imports
+            except ImportError:
+                continue
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                extraction(outputs)
+                times.append(time.perf_counter() - start)
+            results[size][name] = summarize(times)
+    return results
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "mean": statistics.fmean(times),
+        "p50": times[len(times) // 2],
+        "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure the overhead of the serving path")
+    parser.add_argument('--app', type=str, default=str(base_dir / "flask-app.py"), help='Path of the flask app')
+    parser.add_argument('--repeats', type=int, default=5, help='Interpreters started to measure boot time')
+    parser.add_argument('--requests', type=int, default=200, help='Requests sent per list size')
+    parser.add_argument('--list_sizes', type=int, nargs='+', default=[1, 10, 50], help='Reviews per request')
+    parser.add_argument('--output', type=str, default=None, help='Json file where results are written')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = isolated_env(tmp_dir)
+        os.environ.update(env)
+        boot_times = measure_boot_time(args.app, args.repeats, env)
+        results = {
+            "app": args.app,
+            "boot_time": summarize(boot_times),
+            "request_overhead": measure_request_overhead(args.app, args.requests, args.list_sizes),
+            "score_extraction": measure_extraction(args.list_sizes),
+        }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -2,54 +2,99 @@
 model-logging.py
 
 Given a folder containing predictions and metadata of a specific model, it generates metrics and uploads them to 
-mlflow for benchmarking.
+mlflow for benchmarking. With --all, every folder of data/outputs/runs is logged, skipping the ones whose outputs did
+not change since they were last logged.
+
+Besides the metrics at the 0.5 cutoff used to save predictions, every threshold is evaluated: ROC-AUC, PR-AUC, the
+threshold with the best F1 and a calibration table are logged, and the best threshold is written to threshold.json in
+the folder of the model, where the app can read it (see PREDICT_THRESHOLD_FILE).
 
 Usage:
     python model-logging.py --model_name_folder
+    python model-logging.py --all --processes 4
 """
 import mlflow
 import pandas as pd
 from pathlib import Path
 import json
-from sklearn.metrics import classification_report
-import seaborn as sns
 import matplotlib.pyplot as plt
 import io
 from PIL import Image
-import numpy as np
 import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Add scripts/utils/ to path, to load the metric engine
+import sys
+sys.path.append(str(Path(__file__).resolve().parent / "utils"))
+from streaming_metrics import MetricAccumulator, ThresholdSweep
 
 
 
-def load_predictions_and_metadata(model_name):
+def load_predictions_and_metadata(model_name, chunksize=None):
     """
     Loads predictions and metadata needed for a particular model. 
 
     Args:
         model_name (str): folder containing predictions and metadata of a specific model
+        chunksize (int): if given, predictions are read this many at a time, so memory use does not grow with the size
+            of the run
 
     Returns:
-        predictions (pandas dataframe): dataframe containing reviews, their sentiment, probability of being positive, 
-        and predicted sentiment.
+        predictions (pandas dataframe): dataframe containing the sentiment of the reviews, their probability of being
+        positive, and predicted sentiment. If chunksize is given, an iterator of such dataframes instead.
         metadata (dictionary): metadata and other information such as inference time
     """
-    # Make output dir
-    try:
-        # Works in regular Python scripts
-        base_dir = Path(__file__).resolve().parent.parent
-    except NameError:
-        # Fallback for Jupyter notebooks and interactive shells
-        base_dir = Path().resolve().parent
-
-    path_predictions = base_dir / "data" / 'outputs' / 'runs' / model_name
-
-    predictions = pd.read_csv(path_predictions / 'predictions.csv' , sep=';')
+    path_predictions = get_runs_folder() / model_name
+
+    if (path_predictions / 'predictions.parquet').exists():
+        predictions = read_parquet_predictions(path_predictions / 'predictions.parquet',
+                                               path_predictions.parent.parent / 'reviews.parquet', chunksize)
+    else:
+        # The text of the reviews is not needed for the metrics
+        predictions = pd.read_csv(path_predictions / 'predictions.csv' , sep=';', usecols=lambda column: column != 'review',
+                                  chunksize=chunksize)
     with open(path_predictions / "metadata.json", "r", encoding="utf-8") as f:
         metadata = json.load(f)
 
     return predictions, metadata
 
 
+def read_parquet_predictions(path_scores, path_reviews, chunksize=None):
+    """
+    Reads the predictions of a run saved as parquet. Files are memory-mapped, and only the ground truths are read from
+    the shared reviews file, never the text of the reviews.
+
+    Args:
+        path_scores (Path): predictions.parquet of the run, with review_index and the scores of the model
+        path_reviews (Path): reviews.parquet shared by the runs, with review_index, review and Target
+        chunksize (int): if given, predictions are read this many at a time
+
+    Returns:
+        predictions (pandas dataframe): ground truth and scores of every review, or an iterator of chunks of it
+    """
+    import pyarrow.parquet as pq # only needed for runs saved as parquet
+
+    targets = pq.read_table(path_reviews, columns=['review_index', 'Target'], memory_map=True).to_pandas()
+    if chunksize:
+        return _iter_parquet_predictions(pq.ParquetFile(path_scores, memory_map=True), targets, chunksize)
+    scores = pq.read_table(path_scores, memory_map=True).to_pandas()
+    return targets.merge(scores, how='left', on='review_index')
+
+
+def _iter_parquet_predictions(scores_file, targets, chunksize):
+    # The ground truths (two small columns) are looked up by review_index, so batches of the predictions do not have
+    # to line up with the row groups of reviews.parquet, which was written by another run with its own chunk size
+    targets = targets.astype({'Target': 'category'}).set_index('review_index')['Target']
+    for scores in scores_file.iter_batches(batch_size=chunksize):
+        scores = scores.to_pandas()
+        chunk_targets = targets.reindex(scores['review_index'])
+        if chunk_targets.isna().any():
+            raise ValueError("Predictions of reviews missing from reviews.parquet, was the test data changed?")
+        scores.insert(1, 'Target', chunk_targets.to_numpy())
+        yield scores
+
+
 def flatten_dict(d, parent_key='', sep='-'):
     """
     Flattens a dictionary.  Used in log_model_to_mlflow to log metrics into mlflow
@@ -64,100 +109,221 @@ def flatten_dict(d, parent_key='', sep='-'):
     return items
 
 
-def get_l1(df):
+def evaluate_model(predictions, metadata):
     """
-    Calculates the mean absolute error for a particular dataframe with predictions. 
+    Calculates the metrics of a model, the plot of its scores distribution and its threshold and calibration tables,
+    in a single pass over the predictions.
 
     Args:
-        df (pandas df): dataframe with predictions
+        predictions (pandas df or iterable): dataframe with predictions, or chunks of it (see load_predictions_and_metadata)
+        metadata (dict): dictionary with metadata and other interesting information to be logged.
 
     Returns:
-        l1_loss (float): mean absolute error 
+        metrics (dict): name and value of every metric
+        img (PIL Image): scores distribution plot
+        artifacts (dict): name and csv text of the threshold curves and calibration table
     """
-    # Convert string labels to numeric: 1 if 'positive', 0 if 'negative'
-    y_true = (df["Target"] == "positive").astype(int)
-    y_pred = df["positive_score"]
+    accumulator = MetricAccumulator(bins=15)
+    sweep = ThresholdSweep(calibration_bins=10)
+    for chunk in ([predictions] if isinstance(predictions, pd.DataFrame) else predictions):
+        accumulator.update(chunk)
+        sweep.update(chunk)
+
+    metrics = flatten_dict(accumulator.classification_report())
+    metrics["inference_time"] = metadata['inference_time']
+    metrics.update(accumulator.latency_metrics(metadata['inference_time']))
+    metrics["MAE"] = accumulator.mae()
+    metrics["MAE_positive"], metrics["MAE_negative"] = accumulator.mae_per_label()
+
+    # Every threshold from a single sort of the scores
+    curves = sweep.curves()
+    metrics.update(sweep.summary(curves, metric='f1'))
+    calibration, metrics["ECE"] = sweep.calibration()
+    artifacts = {
+        # Summary metrics use every threshold, the logged table a grid of them
+        "threshold_curves.csv": pd.DataFrame(ThresholdSweep.downsample(curves, points=1001)).to_csv(index=False),
+        "calibration.csv": pd.DataFrame(calibration).to_csv(index=False),
+    }
+
+    # Create scores distribution plot, from the histogram of every class
+    for target, counts in sorted(accumulator.histograms.items()):
+        plt.stairs(counts, accumulator.score_edges, fill=True, alpha=0.5, label=target)
+    plt.legend(title="Target")
+    plt.title("KDE by Category")
+    plt.xlabel("Value")
+    plt.ylabel("Density")
+    # Save plot to in-memory bytes buffer
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight', dpi=300)
+    buf.seek(0)  # rewind buffer to the beginning
+    plt.close()  # close the plot to free memory
+    # Convert BytesIO to PIL Image
+    img = Image.open(buf)
+
+    return {key: float(value) for key, value in metrics.items()}, img, artifacts
 
-    # Calculate L1 loss
-    l1_loss = np.abs(y_true - y_pred).mean()
-    return l1_loss
 
-def l1_per_label(df):
+def log_model_to_mlflow(predictions, metadata, fingerprint=None):
     """
-    Calculates the mean absolute error for a particular dataframe with predictions, slicing per class. 
+    Logs metrics and metadata of a model into mlflow. 
 
     Args:
-        df (pandas df): dataframe with predictions
+        predictions (pandas df): dataframe with predictions
+        metadata (dict): dictionary with metadata and other interesting information to be logged.
+        fingerprint (str): fingerprint of the outputs of the run (see run_fingerprint), saved as a tag
 
     Returns:
-        mae_positive (float): mean absolute error of records with positive review
-        mae_negative (float): mean absolute error of records with negative review
+        metrics (dict): name and value of every metric logged
+    """
+    metrics, img, artifacts = evaluate_model(predictions, metadata)
+    log_evaluation(metadata, metrics, img, artifacts, fingerprint)
+    return metrics
+
+
+def log_evaluation(metadata, metrics, img, artifacts=None, fingerprint=None):
+    """
+    Creates the mlflow run of a model. Metrics and tags are sent in batches (one call each) instead of one call per
+    value.
     """
-    # Convert string labels to numeric
-    y_pred = df["positive_score"]
+    tags = {
+        "model": metadata['model'],
+        "adaptations": metadata['adaptations'],
+        "other_comments": metadata['other_comments'],
+    }
+    if fingerprint is not None:
+        tags["fingerprint"] = fingerprint
 
-    # Create a mask for each class
-    positive_mask = df["Target"] == "positive"
-    negative_mask = df["Target"] == "negative"
+    with mlflow.start_run(run_name=metadata['model']+'/'+metadata['adaptations']):
+        mlflow.log_metrics(metrics)
+        mlflow.log_image(img, "scores_distribution.png")
+        for name, text in (artifacts or {}).items():
+            mlflow.log_text(text, name)
+        mlflow.set_tags(tags)
 
-    # MAE for positive samples (where true label = 1)
-    mae_positive = np.abs(y_pred[positive_mask] - 1).mean()
 
-    # MAE for negative samples (where true label = 0)
-    mae_negative = np.abs(y_pred[negative_mask] - 0).mean()
+def get_runs_folder():
+    """
+    Returns the folder containing one sub-folder of outputs per model.
+    """
+    try:
+        # Works in regular Python scripts
+        base_dir = Path(__file__).resolve().parent.parent
+    except NameError:
+        # Fallback for Jupyter notebooks and interactive shells
+        base_dir = Path().resolve().parent
+    return base_dir / "data" / 'outputs' / 'runs'
 
-    return mae_positive, mae_negative
 
+def export_threshold(model_name, metrics):
+    """
+    Writes the best threshold of a model to threshold.json in its folder, so the app can use it instead of 0.5.
 
-def log_model_to_mlflow(predictions, metadata):
+    Args:
+        model_name (str): folder containing predictions and metadata of a specific model
+        metrics (dict): metrics of the model (see evaluate_model)
     """
-    Logs metrics and metadata of a model into mlflow. 
+    threshold = {
+        "model": model_name,
+        "threshold": metrics["best_threshold"],
+        "metric": "f1",
+        "f1": metrics["best_threshold_f1"],
+        "accuracy": metrics["best_threshold_accuracy"],
+        "roc_auc": metrics["roc_auc"],
+    }
+    with open(get_runs_folder() / model_name / "threshold.json", "w") as f:
+        json.dump(threshold, f, indent=4)
+
+
+def run_fingerprint(model_name):
+    """
+    Hash of the outputs of a run (predictions, metadata, and the shared reviews of parquet runs), which changes only if
+    the run is saved again. threshold.json is written by this script, so it is not part of it.
 
     Args:
-        predictions (pandas df): dataframe with predictions
-        metadata (dict): dictionary with metadata and other interesting information to be logged.
+        model_name (str): folder containing predictions and metadata of a specific model
 
+    Returns:
+        fingerprint (str): sha256 of the files of the run
+    """
+    folder = get_runs_folder() / model_name
+    paths = [folder / 'predictions.csv', folder / 'predictions.parquet', folder / 'metadata.json']
+    if (folder / 'predictions.parquet').exists():
+        paths.append(folder.parent.parent / 'reviews.parquet')
+
+    digest = hashlib.sha256()
+    for path in paths:
+        if not path.exists():
+            continue
+        digest.update(path.name.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def evaluate_folder(model_name, chunksize=None):
     """
-    class_metrics=classification_report(predictions.Target, predictions.Prediction, output_dict=True)
-    flat_class_metrics =  flatten_dict(class_metrics)
+    Loads and evaluates the outputs of a model. Runs in the worker processes of --all, so it returns the plot as png
+    bytes, which can be sent back to the main process.
 
-    # Create scores distribution plot
-    sns.histplot(data=predictions, x="positive_score", hue="Target", common_norm=False, bins=15)
-    plt.title("KDE by Category")
-    plt.xlabel("Value")
-    plt.ylabel("Density")
-    # Save plot to in-memory bytes buffer
+    Returns:
+        result (tuple): metadata, metrics, png of the scores distribution plot and threshold and calibration tables
+    """
+    predictions, metadata = load_predictions_and_metadata(model_name, chunksize)
+    metrics, img, artifacts = evaluate_model(predictions, metadata)
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', dpi=300)
-    buf.seek(0)  # rewind buffer to the beginning
-    plt.close()  # close the plot to free memory
-    # Convert BytesIO to PIL Image
-    img = Image.open(buf)
+    img.save(buf, format='png')
+    return metadata, metrics, buf.getvalue(), artifacts
 
-    with mlflow.start_run(run_name=metadata['model']+'/'+metadata['adaptations']):
-        # Log metrics
-        for akey in flat_class_metrics.keys():
-            mlflow.log_metric(akey, flat_class_metrics[akey])
 
-        mlflow.log_metric("inference_time", metadata['inference_time'])
-        mlflow.log_metric("MAE", get_l1(predictions))
+def logged_fingerprints():
+    """
+    Returns the fingerprints of the runs already logged in the experiment.
+    """
+    runs = mlflow.search_runs(experiment_names=[experiment_name], filter_string="tags.fingerprint != ''",
+                              output_format="list")
+    return {run.data.tags.get("fingerprint") for run in runs}
 
-        mae_positive, mae_negative  = l1_per_label(predictions)
-        mlflow.log_metric("MAE_positive", mae_positive)
-        mlflow.log_metric("MAE_negative", mae_negative)
 
-        # Log plots
-        mlflow.log_image(img, "scores_distribution.png")
+def log_all_models(processes=None, force=False, chunksize=None):
+    """
+    Logs every folder of data/outputs/runs whose outputs changed since they were last logged. Folders are evaluated
+    in parallel worker processes, and logged to mlflow by the main process as they are ready.
 
-        # Log metadata
-        mlflow.set_tag("model", metadata['model'])
-        mlflow.set_tag("adaptations", metadata['adaptations'])
-        mlflow.set_tag("other_comments", metadata['other_comments'])
+    Args:
+        processes (int): worker processes (defaults to the number of cpus)
+        force (bool): if True, folders are logged again even if they did not change
+        chunksize (int): predictions read at a time from every folder
+    """
+    folders = sorted(path.name for path in get_runs_folder().iterdir() if (path / 'metadata.json').exists())
+    fingerprints = {folder: run_fingerprint(folder) for folder in folders}
+    already_logged = set() if force else logged_fingerprints()
+    pending = [folder for folder in folders if fingerprints[folder] not in already_logged]
+    for folder in sorted(set(folders) - set(pending)):
+        print(f"{folder}: unchanged, skipped")
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(evaluate_folder, folder, chunksize): folder for folder in pending}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                metadata, metrics, png, artifacts = future.result()
+            except Exception as e:
+                print(f"{folder}: failed, {e}")
+                continue
+            log_evaluation(metadata, metrics, Image.open(io.BytesIO(png)), artifacts, fingerprints[folder])
+            export_threshold(folder, metrics)
+            print(f"{folder}: logged, best threshold {metrics['best_threshold']:.4f}")
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run sentiment model logging")
-    parser.add_argument('--model_name_folder', type=str, help='Name of the model', required=True,)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--model_name_folder', type=str, help='Name of the model')
+    target.add_argument('--all', action='store_true', help='Log every folder of data/outputs/runs that changed')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes of --all (default: number of cpus)')
+    parser.add_argument('--force', action='store_true', help='With --all, log again the folders that did not change')
+    parser.add_argument('--chunksize', type=int, default=100000, help='Predictions read at a time (memory use does not depend on the size of the run)')
     return parser.parse_args()
 
 
@@ -169,15 +335,11 @@ experiment_name = "sentiment-usecase"
 if __name__ == "__main__":
     args = parse_args()
 
-    predictions, metadata = load_predictions_and_metadata(args.model_name_folder)
-
     mlflow.set_experiment(experiment_name)
 
-    log_model_to_mlflow(predictions, metadata)   
-
-
-
-
-
-
-
+    if args.all:
+        log_all_models(processes=args.processes, force=args.force, chunksize=args.chunksize)
+    else:
+        predictions, metadata = load_predictions_and_metadata(args.model_name_folder, args.chunksize)
+        metrics = log_model_to_mlflow(predictions, metadata, run_fingerprint(args.model_name_folder))
+        export_threshold(args.model_name_folder, metrics)
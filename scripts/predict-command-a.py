@@ -5,15 +5,20 @@ predict-command-a.py
 Predicts review sentiments on the test data using the generative model Command A from Cohere. Returns predictions in 
 a pandas df with a format ready to benchmark, and other information of relevance to be analyzed such as inference time.
 
+Reviews are packed into as few chat calls as fit the context budget (COHERE_PACK_MAX_TOKENS, COHERE_PACK_MAX_REVIEWS),
+so a run of 100 reviews takes a few calls instead of 100 under the same rate limit. --batch_size sets the reviews
+given to a packing at a time.
+
 Usage:
-    python predict-command-a.py 
+    python predict-command-a.py --workers 2 --batch_size 50
 """
 
 import pandas as pd
 import os
-import time
 import json
 from pathlib import Path
+import time
+from math import isnan
 import cohere
 from dotenv import load_dotenv
 load_dotenv()  # Loads from .env
@@ -21,62 +26,258 @@ load_dotenv()  # Loads from .env
 # Add scripts/utils/ to path, to load package functions
 import sys
 sys.path.append(str(Path(__file__).resolve().parent / "utils"))
-from auxiliar_functions import load_test_data, save_outputs
+from auxiliar_functions import load_test_data, OutputsWriter
+from prediction_runner import SentimentFunctionAdapter, run_predictions_in_chunks, parse_runner_args
+from checkpoint import Checkpoint
+# Add the repository root to path, to load the rate limiter
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from serving.rate_limit import (RateLimiter, RateLimitExceeded, limiter_from_env, rate_limit_details, record_call_time,
+                                record_retry)
 
 
 cohere_api_key=os.getenv("COHERE_TOKEN")
 
+# Rate limit of the account (10 requests per minute on trial keys), overridden by COHERE_REQUESTS_PER_MINUTE and
+# COHERE_TOKENS_PER_MINUTE. Calls of all workers share it, so they overlap as long as the budget allows
+limiter = limiter_from_env("COHERE") or RateLimiter(requests_per_window=10, window=60)
+
+
+
+# Packing of the reviews of a batch into as few chat calls as possible, see pack_reviews
+max_pack_tokens = int(os.getenv("COHERE_PACK_MAX_TOKENS", "24000"))
+max_pack_reviews = int(os.getenv("COHERE_PACK_MAX_REVIEWS", "50"))
+max_pack_attempts = int(os.getenv("COHERE_PACK_MAX_ATTEMPTS", "3"))
+
+# Roughly 4 characters per token
+CHARS_PER_TOKEN = 4
+# Tokens of the answer for every review, like {"id": 12, "positive_probability": 0.93}, with room for the spacing and
+# digits the model may add, and of the rest of the answer. An answer cut by max_tokens is lost, so better too many
+ANSWER_TOKENS_PER_REVIEW = 32
+ANSWER_TOKENS_OVERHEAD = 100
+
+prompt = """For every movie review below, estimate the probability that it is a positive review.
+
+Reviews are between <review id="N"> and </review> tags. Answer only with a json object like
+{"results": [{"id": 0, "positive_probability": 0.97}, {"id": 1, "positive_probability": 0.02}]}
+with exactly one item per review id, and a probability between 0 (surely negative) and 1 (surely positive).
+
+[REVIEWS]
+"""
+
+# Structured output: the api only returns json following this schema
+response_format = {
+    "type": "json_object",
+    "json_schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "positive_probability": {"type": "number"},
+                    },
+                    "required": ["id", "positive_probability"],
+                },
+            },
+        },
+        "required": ["results"],
+    },
+}
+
+
+def format_review(review_id, review):
+    review = review[:8000].replace("</review>", "</ review>") # truncation for maximum context length
+    return f'<review id="{review_id}">\n{review}\n</review>'
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def pack_reviews(reviews, max_tokens=max_pack_tokens, max_reviews=max_pack_reviews):
+    """
+    Splits reviews into packs sent in a single chat call each, keeping every pack within a budget of prompt and
+    answer tokens.
+
+    Args:
+        reviews (dict): review id -> text of the review
+        max_tokens (int): maximum tokens of a pack (prompt and answer, estimated from the characters)
+        max_reviews (int): maximum reviews of a pack
+
+    Returns:
+        packs (list): dictionaries of review id -> text of the review. A review longer than the budget is alone in its
+        pack.
+    """
+    packs = [{}]
+    pack_tokens = estimate_tokens(prompt)
+    for review_id, review in reviews.items():
+        tokens = estimate_tokens(format_review(review_id, review)) + ANSWER_TOKENS_PER_REVIEW
+        if packs[-1] and (pack_tokens + tokens > max_tokens or len(packs[-1]) >= max_reviews):
+            packs.append({})
+            pack_tokens = estimate_tokens(prompt)
+        packs[-1][review_id] = review
+        pack_tokens += tokens
+    return [pack for pack in packs if pack]
+
+
+def parse_probabilities(text, review_ids):
+    """
+    Reads the answer of the model, keeping only valid items.
+
+    Args:
+        text (str): answer of the model
+        review_ids (iterable): ids of the reviews of the pack
+
+    Returns:
+        probabilities (dict): review id -> positive probability, for the reviews with a valid item (an expected id, seen
+        once, and a number between 0 and 1). Reviews left out have to be requested again.
+    """
+    try:
+        # Tolerates text around the json object, like markdown fences
+        answer = json.loads(text[text.index("{"):text.rindex("}") + 1])
+        items = answer["results"]
+    except (ValueError, KeyError, TypeError):
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    expected = set(review_ids)
+    probabilities = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            review_id = int(item["id"])
+            probability = float(item["positive_probability"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if review_id in expected and review_id not in probabilities and 0 <= probability <= 1:
+            probabilities[review_id] = probability
+    return probabilities
+
+
+def score_pack(co, pack):
+    """
+    Scores a pack of reviews with a single chat call.
+
+    Args:
+        co (ClientV2): cohere client
+        pack (dict): review id -> text of the review
+
+    Returns:
+        probabilities (dict): positive probability of the reviews of the pack answered correctly
+        truncated (bool): whether the answer was cut by its token limit
+    """
+    messages = [
+        {"role": "system", "content": "You are an expert in movie reviews"},
+        {"role": "user", "content": prompt.replace("[REVIEWS]", "\n\n".join(
+            format_review(review_id, review) for review_id, review in pack.items()))},
+    ]
+    answer_tokens = ANSWER_TOKENS_PER_REVIEW * len(pack) + ANSWER_TOKENS_OVERHEAD
+    estimated_tokens = estimate_tokens(messages[1]["content"]) + answer_tokens
+
+    def chat():
+        start = time.time()
+        try:
+            return co.chat(model="command-a-03-2025", messages=messages, response_format=response_format,
+                           max_tokens=answer_tokens, temperature=0)
+        finally:
+            record_call_time(time.time() - start)  # without the waits of the limiter
+
+    output = limiter.call(chat, tokens=estimated_tokens)
+    truncated = getattr(output, "finish_reason", None) == "MAX_TOKENS"
+    return parse_probabilities(output.message.content[0].text, pack), truncated
+
+
+def split_pack(pack):
+    """
+    Splits a pack in two halves (a pack of a single review is kept as it is).
+    """
+    items = list(pack.items())
+    half = (len(items) + 1) // 2
+    return [dict(part) for part in (items[:half], items[half:]) if part]
 
 
 def get_sentiment(reviews):
     """
     Calculates sentiment of a review or a list of reviews using the generative model Command A from Cohere.
-    Due to rate limit issues, there is a gap of 6 seconds between calls to the model. 
+    Reviews are packed into as few chat calls as fit the token budget (COHERE_PACK_MAX_TOKENS and
+    COHERE_PACK_MAX_REVIEWS), and the model answers with the probability of every review being positive, as json keyed
+    by review id. Reviews missing from the answer or with an invalid item are requested again, up to
+    COHERE_PACK_MAX_ATTEMPTS calls per review. When an answer is cut or can not be parsed, its reviews are requested
+    again in two halves, so a pack the model can not answer in one go still gets scored, while packs of calls that
+    failed are requested again as they were. Calls go through the rate limiter, which slows down when the api answers
+    with rate limit errors. Packs still rate-limited after the retries of the limiter are queued again without using
+    up an attempt, and the run stops once COHERE_PACK_MAX_ATTEMPTS calls in a row were rate-limited (like when the
+    quota of the key is used up), to be resumed later with --resume.
 
     Args:
         reviews (str or list): a single review (str) or a list of reviews (list)
 
     Returns:
-        df (pandas dataframe): dataframe containing reviews, their sentiment, probability of being positive, 
-        and predicted sentiment.
+        df (pandas dataframe): dataframe containing reviews, their sentiment, probability of being positive,
+        and predicted sentiment. Reviews still without a valid answer after all the attempts get a nan probability
+        instead of stopping the run, and are requested again by a run resumed with --resume.
     """
 
     # Make sure input is a list (output of hf is 3 classes if a string is given, or just the top class if a list is given)
     if not isinstance(reviews, list):
         reviews = [reviews]
     co = cohere.ClientV2(cohere_api_key)
-    
-    prompt="""Determine if the following document is a positive or negative movie review:
-    [REVIEW]
-
-    If it is positive, return 1, and if it is negative return 0. Do not give any other answers.
-    """
-
-    # Inference for all reviews
-    all_rows = []
-    for i, review in enumerate(reviews):
-        review = review[:8000] # truncation for maximum context length
 
-        messages = [
-            {"role": "system", "content": "You are an expert in movie reviews"},
-            {"role": "user", "content": prompt.replace("[REVIEW]", review)},
-        ]
+    # Inference for all reviews, the ids are their positions in the list
+    probabilities = {}
+    attempts = dict.fromkeys(range(len(reviews)), 0)
+    rate_limited = 0  # calls in a row still rate-limited after the retries of the limiter
+    packs = pack_reviews(dict(enumerate(reviews)))
+    while packs:
+        pack = packs.pop()
+        call_failed = False
+        try:
+            answered, truncated = score_pack(co, pack)
+            rate_limited = 0
+        except Exception as e:
+            if getattr(e, "status_code", None) in (401, 403):
+                raise  # wrong or expired token, every other call would fail the same way
+            if isinstance(e, RateLimitExceeded) or rate_limit_details(e)[0]:
+                rate_limited += 1
+                if rate_limited >= max_pack_attempts:
+                    raise
+                # Nothing wrong with the pack, it is sent again as it was once the limiter lets it through
+                print(f"Call for reviews {sorted(pack)} rate-limited, queued again: {e}")
+                record_retry()
+                packs.append(pack)
+                continue
+            print(f"Call for reviews {sorted(pack)} failed: {type(e).__name__}: {e}")
+            answered, truncated, call_failed = {}, False, True
+        probabilities.update(answered)
 
-        output = co.chat( model="command-a-03-2025", messages= messages  )
-        output = output.message.content[0].text
-        print(i)
-        time.sleep(6)
+        for review_id in pack:
+            attempts[review_id] += 1
+        retry = {review_id: review for review_id, review in pack.items()
+                 if review_id not in answered and attempts[review_id] < max_pack_attempts}
+        if not retry:
+            continue
+        record_retry()  # counted in the retries column of the predictions
+        # A cut or unreadable answer is not sent again as it was, but in two smaller packs
+        packs.extend(split_pack(retry) if truncated or not (answered or call_failed) else [retry])
 
-        all_rows.append({
-            "review_index": i,
-            "review" : review, 
-            "positive_score": int(output)
-        })
+    failed = sorted(set(range(len(reviews))) - set(probabilities))
+    if failed:
+        print(f"No valid answer for reviews {failed} after {max_pack_attempts} attempts, scored as nan")
 
     # Create DataFrame
-    df = pd.DataFrame(all_rows)
+    df = pd.DataFrame({
+        "review_index": range(len(reviews)),
+        "review": [review[:8000] for review in reviews],
+        "positive_score": [probabilities.get(i, float("nan")) for i in range(len(reviews))],
+    })
 
-    outputs_list = ['positive' if score > 0.5 else 'negative' for score in df['positive_score']]
+    # Reviews without an answer get no Prediction
+    outputs_list = [None if isnan(score) else 'positive' if score > 0.5 else 'negative'
+                    for score in df['positive_score']]
     df['Prediction']=outputs_list
     return df
 
@@ -84,16 +285,19 @@ def get_sentiment(reviews):
 
 
 model_name = 'generative-command-a'
-adaptations = ''
+adaptations = 'Packed prompts with json output of positive probabilities'
 other_comments = 'Rate limit of 10 requests per minute.'
 
 
 if __name__ == "__main__":
-    data = load_test_data()
+    args = parse_runner_args(__doc__, default_batch_size=max_pack_reviews)
+    # Whole test data at once, or chunks of --chunksize reviews saved as soon as they are scored
+    chunks = load_test_data(chunksize=args.chunksize) if args.chunksize else [load_test_data()]
 
-    start = time.time()
-    predictions = get_sentiment(list(data.review))
-    end = time.time()
-    inference_time = end - start
+    adapter = SentimentFunctionAdapter(get_sentiment, batch_size=args.batch_size)
+    checkpoint = Checkpoint(model_name, resume=args.resume) # scores are saved as they come, see --resume
+    writer = OutputsWriter(model_name, output_format=args.output_format)
+    inference_time = run_predictions_in_chunks(adapter, chunks, writer, workers=args.workers, checkpoint=checkpoint)
 
-    save_outputs(data, predictions, model_name, adaptations, inference_time, other_comments)
\ No newline at end of file
+    writer.close(adaptations, inference_time, other_comments)
+    checkpoint.remove()
\ No newline at end of file
@@ -7,14 +7,11 @@ Predicts review sentiments on the test data using the sentiment analysis model
     df with a format ready to benchmark, and other information of relevance to be analyzed such as inference time.
 
 Usage:
-    python predict-twitter-roberta.py 
+    python predict-twitter-roberta.py --workers 4
 """
 
 
-from huggingface_hub import InferenceClient
 import pandas as pd
-import os
-import time
 import json
 from pathlib import Path
 from dotenv import load_dotenv
@@ -23,10 +20,16 @@ load_dotenv()  # Loads from .env
 # Add scripts/utils/ to path, to load package functions
 import sys
 sys.path.append(str(Path(__file__).resolve().parent / "utils"))
-from auxiliar_functions import load_test_data, save_outputs
+from auxiliar_functions import load_test_data, OutputsWriter
+from prediction_runner import SentimentFunctionAdapter, run_predictions_in_chunks, parse_runner_args
+from checkpoint import Checkpoint
+# Add the repository root to path, to load the inference backends
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from serving.backends import get_backend
+from serving.resilience import resilience_from_env
+from serving.chunking import get_chunker, chunk_aggregation
 
 
-my_token=os.getenv("HUGGING_FACE_TOKEN")
 
 
 
@@ -37,8 +40,8 @@ def get_sentiment(reviews):
     """
     Calculates sentiment of a review or a list of reviews using the sentiment model
     cardiffnlp/twitter-roberta-base-sentiment . Since the model returns also the neutral class, it is dropped here and
-    the remainder of the probabilities scaled to make sure positive and negative scores sum to 1. Length of the reviews is truncated to 2k characters
-    to avoid issues with long reviews. 
+    the remainder of the probabilities scaled to make sure positive and negative scores sum to 1. Long reviews are split
+    into windows of the maximum length of the model, and the scores of the windows combined (see CHUNK_AGGREGATION). 
 
     Args:
         reviews (str or list): a single review (str) or a list of reviews (list)
@@ -50,30 +53,32 @@ def get_sentiment(reviews):
     # Make sure input is a list (output of hf is 3 classes if a string is given, or just the top class if a list is given)
     if not isinstance(reviews, list):
         reviews = [reviews]
-    client=InferenceClient(
-        model='cardiffnlp/twitter-roberta-base-sentiment',
-        token=my_token
-        )
+    # Remote inference api or local model (see SENTIMENT_BACKEND), with retries counted in the retries column
+    backend = resilience.wrap(get_backend('cardiffnlp/twitter-roberta-base-sentiment'))
 
     # Inference for all reviews
     all_rows = []
-    for i, review in enumerate(reviews):
-        review = review[:2000] # Quick and dirty truncation of long reviews (max tokens is around 500 (we assumed 3 letters per token))
-        output = client.text_classification(review, top_k=None)
-        for item in output:
-            all_rows.append({
-                "review_index": i,
-                "review" : review, 
-                "label": item["label"],
-                "score": item["score"]
-            })
+    # Long reviews are split into windows that fit the model, all windows are scored together
+    chunker = get_chunker(backend.model)
+    windows = [chunker.split(review) for review in reviews]
+    outputs = iter(backend.text_classification([window for review_windows in windows for window in review_windows]))
+    for i, (review, review_windows) in enumerate(zip(reviews, windows)):
+        for window in range(len(review_windows)):
+            for item in next(outputs):
+                all_rows.append({
+                    "review_index": i,
+                    "window": window,
+                    "review" : review, 
+                    "label": item["label"],
+                    "score": item["score"]
+                })
 
     # Create DataFrame
     df = pd.DataFrame(all_rows)
 
     # Remove 'neutral' label and normalize to 1
     df = df[df["label"].isin(["LABEL_2", "LABEL_0"])]
-    df["score"] = df.groupby("review_index")["score"].transform(lambda x: x / x.sum())
+    df["score"] = df.groupby(["review_index", "window"])["score"].transform(lambda x: x / x.sum())
 
     # Extract positive score only
     df = df[df["label"] == "LABEL_2"].reset_index(drop=True)
@@ -82,6 +87,9 @@ def get_sentiment(reviews):
     df.drop(columns=['label'], inplace=True)
     df.rename(columns={'score':'positive_score'}, inplace=True)
 
+    # Combine the scores of the windows of every review
+    df = df.groupby(['review_index', 'review'], as_index=False)['positive_score'].agg(chunk_aggregation())
+
     outputs_list = ['positive' if score > 0.5 else 'negative' for score in df['positive_score']]
     df['Prediction']=outputs_list
     return df
@@ -91,21 +99,27 @@ def get_sentiment(reviews):
 
 
 
+# Retries and circuit breaker around the calls to the model, as in the app (see UPSTREAM_MAX_RETRIES)
+resilience = resilience_from_env()
+
 model_name = 'twitter-roberta'
-adaptations = 'Truncation to 2k characters'
+adaptations = 'Token-aware windows'
 other_comments = 'Model assigns negative sentiment to reviews with connotative negative words (like violence, drugs...) regardless if the review is positive'
 
 
 
 if __name__ == "__main__":
-    data = load_test_data()
+    args = parse_runner_args(__doc__)
+    # Whole test data at once, or chunks of --chunksize reviews saved as soon as they are scored
+    chunks = load_test_data(chunksize=args.chunksize) if args.chunksize else [load_test_data()]
 
-    start = time.time()
-    predictions = get_sentiment(list(data.review))
-    end = time.time()
-    inference_time = end - start
+    adapter = SentimentFunctionAdapter(get_sentiment, batch_size=args.batch_size)
+    checkpoint = Checkpoint(model_name, resume=args.resume) # scores are saved as they come, see --resume
+    writer = OutputsWriter(model_name, output_format=args.output_format)
+    inference_time = run_predictions_in_chunks(adapter, chunks, writer, workers=args.workers, checkpoint=checkpoint)
 
-    save_outputs(data, predictions, model_name, adaptations, inference_time, other_comments)
+    writer.close(adaptations, inference_time, other_comments)
+    checkpoint.remove()
 
 
 
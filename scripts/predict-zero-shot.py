@@ -7,15 +7,12 @@ Predicts review sentiments on the test data using the zero shot classificator mo
      benchmark, and other information of relevance.
 
 Usage:
-    python predict-zero-shot.py 
+    python predict-zero-shot.py --workers 4
 """
 
 
 
-from huggingface_hub import InferenceClient
 import pandas as pd
-import os
-import time
 import json
 from pathlib import Path
 from dotenv import load_dotenv
@@ -24,10 +21,16 @@ load_dotenv()  # Loads from .env
 # Add scripts/utils/ to path, to load package functions
 import sys
 sys.path.append(str(Path(__file__).resolve().parent / "utils"))
-from auxiliar_functions import load_test_data, save_outputs
+from auxiliar_functions import load_test_data, OutputsWriter
+from prediction_runner import SentimentFunctionAdapter, run_predictions_in_chunks, parse_runner_args
+from checkpoint import Checkpoint
+# Add the repository root to path, to load the inference backends
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from serving.backends import get_backend
+from serving.resilience import resilience_from_env
+from serving.chunking import get_chunker, hypothesis_tokens, chunk_aggregation
 
 
-my_token=os.getenv("HUGGING_FACE_TOKEN")
 
 
 
@@ -52,23 +55,27 @@ def get_sentiment(reviews, positive_label, negative_label):
     # Make sure input is a list (output of hf is 3 classes if a string is given, or just the top class if a list is given)
     if not isinstance(reviews, list):
         reviews = [reviews]
-    client=InferenceClient(
-        model='MoritzLaurer/DeBERTa-v3-large-mnli-fever-anli-ling-wanli',
-        token=my_token
-        )
+    # Remote inference api or local model (see SENTIMENT_BACKEND), with retries counted in the retries column
+    backend = resilience.wrap(get_backend('MoritzLaurer/DeBERTa-v3-large-mnli-fever-anli-ling-wanli'))
     
     # Inference for all reviews
     all_rows = []
-    for i, review in enumerate(reviews):
-        review = review[:4010] # truncation of long reviews to the maximum we have seen
-        output = client.zero_shot_classification(review, candidate_labels = [positive_label, negative_label])
-        for item in output:
-            all_rows.append({
-                "review_index": i,
-                "review" : review, 
-                "label": item["label"],
-                "score": item["score"]
-            })
+    # Long reviews are split into windows that fit the model (next to the hypothesis), all windows are scored together
+    candidate_labels = [positive_label, negative_label]
+    chunker = get_chunker(backend.model, reserved_tokens=hypothesis_tokens(candidate_labels))
+    windows = [chunker.split(review) for review in reviews]
+    outputs = iter(backend.zero_shot_classification([window for review_windows in windows for window in review_windows],
+                                                    candidate_labels = candidate_labels))
+    for i, (review, review_windows) in enumerate(zip(reviews, windows)):
+        for window in range(len(review_windows)):
+            for item in next(outputs):
+                all_rows.append({
+                    "review_index": i,
+                    "window": window,
+                    "review" : review, 
+                    "label": item["label"],
+                    "score": item["score"]
+                })
 
     # Create DataFrame
     df = pd.DataFrame(all_rows)
@@ -80,6 +87,9 @@ def get_sentiment(reviews, positive_label, negative_label):
     df.drop(columns=['label'], inplace=True)
     df.rename(columns={'score':'positive_score'}, inplace=True)
 
+    # Combine the scores of the windows of every review
+    df = df.groupby(['review_index', 'review'], as_index=False)['positive_score'].agg(chunk_aggregation())
+
     outputs_list = ['positive' if score > 0.5 else 'negative' for score in df['positive_score']]
     df['Prediction']=outputs_list
     return df
@@ -89,6 +99,9 @@ def get_sentiment(reviews, positive_label, negative_label):
 
 
 
+# Retries and circuit breaker around the calls to the model, as in the app (see UPSTREAM_MAX_RETRIES)
+resilience = resilience_from_env()
+
 model_name = 'zero-shot'
 adaptations = 'simple labels'
 other_comments = 'Model seems to overcome issues of sentiment classification methods. Labels: a very positive movie review, a very negative movie review'
@@ -102,14 +115,17 @@ negative_label='a very negative movie review'
 
 
 if __name__ == "__main__":
-    data = load_test_data()
+    args = parse_runner_args(__doc__)
+    # Whole test data at once, or chunks of --chunksize reviews saved as soon as they are scored
+    chunks = load_test_data(chunksize=args.chunksize) if args.chunksize else [load_test_data()]
 
-    start = time.time()
-    predictions = get_sentiment(list(data.review), positive_label, negative_label)
-    end = time.time()
-    inference_time = end - start
+    adapter = SentimentFunctionAdapter(get_sentiment, batch_size=args.batch_size, positive_label=positive_label, negative_label=negative_label)
+    checkpoint = Checkpoint(model_name, resume=args.resume) # scores are saved as they come, see --resume
+    writer = OutputsWriter(model_name, output_format=args.output_format)
+    inference_time = run_predictions_in_chunks(adapter, chunks, writer, workers=args.workers, checkpoint=checkpoint)
 
-    save_outputs(data, predictions, model_name, adaptations, inference_time, other_comments)
+    writer.close(adaptations, inference_time, other_comments)
+    checkpoint.remove()
 
 
 
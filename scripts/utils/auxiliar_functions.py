@@ -13,12 +13,17 @@ from pathlib import Path
 
 
 
-def load_test_data():
+def load_test_data(chunksize=None):
     """
     Loads test data into a pandas dataframe. 
 
+    Args:
+        chunksize (int): if given, the file is read in chunks of this many reviews instead of all at once, so memory
+            use does not grow with the size of the file
+
     Returns:
-        df (pandas dataframe): dataframe test data.
+        df (pandas dataframe): dataframe test data. If chunksize is given, an iterator of dataframes instead, whose
+        review_index keeps counting from one chunk to the next.
     """
     try:
         # Works in regular Python scripts
@@ -30,6 +35,9 @@ def load_test_data():
     # Now use it to build your file path
     data_path = base_dir / "data" / 'inputs' / "IMDB-movie-reviews.csv"
 
+    if chunksize:
+        return _iter_test_data(data_path, chunksize)
+
     # Read file
     data = pd.read_csv(data_path, sep=';', encoding='latin-1')
 
@@ -40,23 +48,28 @@ def load_test_data():
     return data 
 
 
+def _iter_test_data(data_path, chunksize):
+    start = 0
+    for data in pd.read_csv(data_path, sep=';', encoding='latin-1', chunksize=chunksize):
+        data.rename(columns={'sentiment':'Target'}, inplace=True)
+        # Position of the review in the whole file, the same as without chunks
+        data['review_index'] = range(start, start + len(data))
+        data.reset_index(drop=True, inplace=True)
+        start += len(data)
+        yield data
 
-def save_outputs(data, predictions, model_name, adaptations, inference_time, other_comments):
+
+
+def get_run_folder(model_name):
     """
-    This function is used after calculating predictions for the test data. It saves the predictions as a pandas df. It 
-    also saves other information such as model used, time it took to process the test data, and additional notes, into
-    a json. These outputs are then used to calculate metrics that are logged into mlflow.
+    Returns the folder where the outputs of a model are stored, creating it if needed.
 
     Args:
-        data (pandas df): dataframe with reviews and ground truths
-        predictions (pandas df): dataframe with reviews and predictions
         model_name (str): Used as a folder that will contain the outputs. It is usually the name of the model. 
-        adaptations (str): if there where specific adaptations of the model or prompt to generate predictions.
-        inference_time (float): number of seconds it took to calculate predictions to all reviews in the test data
-        other_comments (str): other comments regarding the model or its results
 
+    Returns:
+        path_outputs (Path): folder data/outputs/runs/<model_name>
     """
-    # Make output dir
     try:
         # Works in regular Python scripts
         base_dir = Path(__file__).resolve().parent.parent.parent
@@ -67,21 +80,144 @@ def save_outputs(data, predictions, model_name, adaptations, inference_time, oth
     path_outputs = base_dir / "data" / 'outputs' / 'runs' / model_name
     # Create the directory (and parents if they don't exist)
     path_outputs.mkdir(parents=True, exist_ok=True)
+    return path_outputs
+
+
+
+def get_reviews_path():
+    """
+    Returns the parquet file with the reviews and ground truths of the test data, shared by the runs saved as parquet.
 
-    # Add target to the predictions df
-    output_df=data.merge(predictions.drop(columns=['review']), how='left' , on='review_index')
-    output_df.drop(columns=['review_index'], inplace=True)
-
-    # Save predictions
-    output_df.to_csv(path_outputs / 'predictions.csv', index=False, sep=';')
-
-    # Create metadata file and save it
-    metadata = { 
-        'model':model_name,
-        'adaptations': adaptations,
-        'inference_time': inference_time,
-        'other_comments': other_comments
-    }
-    # Save to JSON file
-    with open(path_outputs / "metadata.json", "w") as f:
-        json.dump(metadata, f, indent=4) 
\ No newline at end of file
+    Returns:
+        path (Path): file data/outputs/reviews.parquet
+    """
+    # Next to the folders of the runs
+    return get_run_folder('.').resolve().parent / 'reviews.parquet'
+
+
+
+class OutputsWriter:
+    """
+    Writes the outputs of a run chunk by chunk, so runs over files that do not fit in memory can be saved as they go.
+    Predictions are written next to their final file (with a .tmp suffix) and only replace the predictions of a previous
+    run when the writer is closed, along with metadata.json, so an interrupted run never leaves a truncated file behind.
+
+    Two formats are available:
+        csv: predictions of every chunk are joined with its reviews and ground truths and appended to predictions.csv
+        parquet: only review_index and the scores of the model are written, to predictions.parquet. Reviews and ground
+            truths are written once to data/outputs/reviews.parquet and shared by all the runs (delete it if the
+            test data changes). Needs pyarrow.
+
+    Args:
+        model_name (str): Used as a folder that will contain the outputs. It is usually the name of the model. 
+        output_format (str): "csv" or "parquet"
+    """
+
+    def __init__(self, model_name, output_format='csv'):
+        self.model_name = model_name
+        self.output_format = output_format
+        self.path_outputs = get_run_folder(model_name)
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError(f"Unknown output format {output_format!r}, expected 'csv' or 'parquet'")
+        self.predictions_path = self.path_outputs / f'predictions.{output_format}'
+        self._predictions_tmp_path = self.predictions_path.with_suffix(f'.{output_format}.tmp')
+        if output_format == 'csv':
+            self._file = open(self._predictions_tmp_path, 'w', newline='', encoding='utf-8')
+            self._header = True
+        elif output_format == 'parquet':
+            import pyarrow as pa # only needed for parquet outputs
+            import pyarrow.parquet as pq
+            self._pa, self._pq = pa, pq
+            self._predictions_writer = None
+            # Reviews are written only by the first run, next to the final file until it is complete
+            self.reviews_path = get_reviews_path()
+            self._reviews_tmp_path = None if self.reviews_path.exists() else self.reviews_path.with_suffix('.parquet.tmp')
+            self._reviews_writer = None
+
+    def _append_parquet(self, writer, path, df):
+        table = self._pa.Table.from_pandas(df, preserve_index=False, schema=writer.schema if writer else None)
+        if writer is None:
+            writer = self._pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+        return writer
+
+    def write(self, data, predictions):
+        """
+        Appends the predictions of a chunk of reviews.
+
+        Args:
+            data (pandas df): chunk of the test data, with reviews, ground truths and review_index
+            predictions (pandas df): predictions of the reviews of the chunk, with their review_index
+        """
+        if self.output_format == 'parquet':
+            scores = predictions.drop(columns=['review'])
+            # Same types in every chunk, even when a chunk has no value in a column
+            scores = scores.astype({column: float for column in ('positive_score', 'latency') if column in scores.columns})
+            self._predictions_writer = self._append_parquet(self._predictions_writer, self._predictions_tmp_path,
+                                                            scores)
+            if self._reviews_tmp_path is not None:
+                self._reviews_writer = self._append_parquet(self._reviews_writer, self._reviews_tmp_path, data)
+            return
+
+        # Add target to the predictions df
+        output_df=data.merge(predictions.drop(columns=['review']), how='left' , on='review_index')
+        output_df.drop(columns=['review_index'], inplace=True)
+        output_df.to_csv(self._file, index=False, sep=';', header=self._header)
+        self._header = False
+
+    def close(self, adaptations, inference_time, other_comments):
+        """
+        Completes the predictions, replacing the ones of a previous run, and writes metadata.json.
+
+        Args:
+            adaptations (str): if there where specific adaptations of the model or prompt to generate predictions.
+            inference_time (float): number of seconds it took to calculate predictions to all reviews in the test data
+            other_comments (str): other comments regarding the model or its results
+        """
+        if self.output_format == 'parquet':
+            if self._predictions_writer is not None:
+                self._predictions_writer.close()
+            if self._reviews_writer is not None:
+                self._reviews_writer.close()
+                self._reviews_tmp_path.replace(self.reviews_path)
+            # Outputs of a previous run in the other format are removed, so only the ones of this run are read
+            (self.path_outputs / 'predictions.csv').unlink(missing_ok=True)
+        else:
+            self._file.close()
+            (self.path_outputs / 'predictions.parquet').unlink(missing_ok=True)
+        if self._predictions_tmp_path.exists():
+            self._predictions_tmp_path.replace(self.predictions_path)
+
+        # Create metadata file and save it
+        metadata = { 
+            'model':self.model_name,
+            'adaptations': adaptations,
+            'inference_time': inference_time,
+            'other_comments': other_comments
+        }
+        # Save to JSON file
+        with open(self.path_outputs / "metadata.json.tmp", "w") as f:
+            json.dump(metadata, f, indent=4) 
+        (self.path_outputs / "metadata.json.tmp").replace(self.path_outputs / "metadata.json")
+
+
+
+def save_outputs(data, predictions, model_name, adaptations, inference_time, other_comments):
+    """
+    This function is used after calculating predictions for the test data. It saves the predictions as a pandas df. It 
+    also saves other information such as model used, time it took to process the test data, and additional notes, into
+    a json. These outputs are then used to calculate metrics that are logged into mlflow.
+
+    Args:
+        data (pandas df): dataframe with reviews and ground truths
+        predictions (pandas df): dataframe with reviews and predictions
+        model_name (str): Used as a folder that will contain the outputs. It is usually the name of the model. 
+        adaptations (str): if there where specific adaptations of the model or prompt to generate predictions.
+        inference_time (float): number of seconds it took to calculate predictions to all reviews in the test data
+        other_comments (str): other comments regarding the model or its results
+
+    """
+    # Whole test data as a single chunk
+    writer = OutputsWriter(model_name)
+    writer.write(data, predictions)
+    writer.close(adaptations, inference_time, other_comments)
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""
+checkpoint.py
+
+Checkpoints of long prediction runs. Scores are saved to a SQLite file in the folder of the run as soon as they are
+calculated, so a crash (or an expired token) near the end of a run does not lose the reviews already scored. A run
+started with --resume skips the reviews found in it.
+
+Scores stay on disk: the runner asks for the ones of the chunk it is scoring, so memory use does not grow with the
+size of the run, and every batch is saved in a single transaction, so a crash never leaves half a row.
+
+File written in data/outputs/runs/<model_name>/ while the run is going on:
+    predictions.partial.sqlite : review_index, positive_score, latency and retries of every review already scored,
+        and the seconds spent by the previous sessions of the run, added to the inference time of the run
+
+"""
+
+import sqlite3
+import threading
+
+from auxiliar_functions import get_run_folder
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    review_index INTEGER PRIMARY KEY,
+    positive_score REAL NOT NULL,
+    latency REAL,
+    retries INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+class Checkpoint:
+    """
+    Args:
+        model_name (str): folder of the run
+        resume (bool): if True, scores of a previous session are kept. Otherwise any partial file is discarded.
+    """
+
+    def __init__(self, model_name, resume=False):
+        self.path = get_run_folder(model_name) / "predictions.partial.sqlite"
+        if not resume:
+            self.path.unlink(missing_ok=True)
+        self._lock = threading.Lock()
+        # Batches are saved from the worker threads of the runner, one at a time
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        row = self._conn.execute("SELECT value FROM state WHERE key = 'elapsed'").fetchone()
+        self.previous_elapsed = row[0] if row else 0.0
+
+    def completed_in(self, start, end):
+        """
+        Scores of a previous session for a range of reviews, like the reviews of a chunk.
+
+        Args:
+            start (int): first review_index of the range
+            end (int): review_index after the last one of the range
+
+        Returns:
+            completed (dict): review_index -> (positive_score, latency, retries) of the reviews already scored
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT review_index, positive_score, latency, retries FROM scores "
+                "WHERE review_index >= ? AND review_index < ?", (start, end)).fetchall()
+        return {review_index: (score, latency, retries) for review_index, score, latency, retries in rows}
+
+    def append(self, results, elapsed):
+        """
+        Saves the scores of a batch of reviews.
+
+        Args:
+            results (list): tuples of (review_index, positive_score, latency, retries)
+            elapsed (float): seconds spent by the run so far, including previous sessions
+        """
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)", results)
+            self._conn.execute("INSERT OR REPLACE INTO state VALUES ('elapsed', ?)", (elapsed,))
+
+    def remove(self):
+        """
+        Deletes the partial file, once the complete predictions have been saved.
+        """
+        with self._lock:
+            self._conn.close()
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,252 @@
+"""
+prediction_runner.py
+
+Shared runner for the predict-*.py scripts. Each script only describes how its model scores reviews (a ModelAdapter);
+the runner sends the reviews through a pool of workers, times every item, and returns the predictions in the format
+expected by save_outputs, along with the latency, length and retries of every review.
+
+"""
+
+import argparse
+import time
+from math import isnan
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+
+class ModelAdapter:
+    """
+    How a model scores reviews. Subclasses implement score_batch, or score if the model takes one review per call.
+
+    Attributes:
+        batch_size (int): reviews given to score_batch at a time. Models that score one review per call keep 1, so
+            every worker handles a single review.
+    """
+
+    batch_size = 1
+
+    def score(self, review):
+        """
+        Args:
+            review (str): review to score
+
+        Returns:
+            positive_score (float): probability of the review being positive
+        """
+        raise NotImplementedError
+
+    def score_batch(self, reviews):
+        """
+        Args:
+            reviews (list): reviews to score
+
+        Returns:
+            positive_scores (list): probability of every review being positive
+        """
+        return [self.score(review) for review in reviews]
+
+
+class SentimentFunctionAdapter(ModelAdapter):
+    """
+    Adapter over the get_sentiment functions of the prediction scripts, which take a list of reviews and return a
+    dataframe with their positive_score, and the position of every review in review_index. Reviews missing from the
+    dataframe (like the ones whose labels were not found in the outputs of the model) get a nan score, so they are
+    left out of the checkpoint and scored again by a resumed run.
+
+    Args:
+        get_sentiment (callable): function scoring a list of reviews
+        batch_size (int): reviews given to get_sentiment at a time
+        **kwargs: other arguments of get_sentiment, like the labels of zero-shot models
+    """
+
+    def __init__(self, get_sentiment, batch_size=1, **kwargs):
+        self.get_sentiment = get_sentiment
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+
+    def score_batch(self, reviews):
+        df = self.get_sentiment(reviews, **self.kwargs)
+        if df.empty:
+            return [float('nan')] * len(reviews)
+        if 'review_index' not in df.columns:
+            return list(df['positive_score'])
+        # Rows are matched to the reviews by review_index, reviews left out of the dataframe get a nan score
+        return list(df.set_index('review_index')['positive_score'].reindex(range(len(reviews))))
+
+
+class RunTimings:
+    """
+    Timings of a run: wall-clock time of the whole run and seconds spent on every review. Reviews scored in the same
+    batch share the time (and the retries) of the batch.
+    """
+
+    def __init__(self, n_items):
+        self.start = time.time()
+        self.end = None
+        self.latencies = [None] * n_items
+        self.retries = [0] * n_items
+
+    @property
+    def inference_time(self):
+        return (self.end or time.time()) - self.start
+
+    def summary(self):
+        latencies = sorted(latency for latency in self.latencies if latency is not None)
+        if not latencies:
+            return {"inference_time": self.inference_time, "items": 0}
+        return {
+            "inference_time": self.inference_time,
+            "items": len(latencies),
+            "mean_latency": sum(latencies) / len(latencies),
+            "p50_latency": latencies[len(latencies) // 2],
+            "max_latency": latencies[-1],
+            "retries": sum(self.retries),
+        }
+
+
+def run_predictions(adapter, reviews, workers=1, threshold=0.5, checkpoint=None, start_index=0, started=None):
+    """
+    Scores all reviews with a model.
+
+    Args:
+        adapter (ModelAdapter): model used to score
+        reviews (list): reviews to score. Their position in the list is their review_index.
+        workers (int): batches of reviews scored at the same time
+        threshold (float): positive score above which a review is predicted as positive
+        checkpoint (Checkpoint): if given, scores are saved to it as soon as they are ready, and the reviews it
+            already holds are not scored again
+        start_index (int): review_index of the first review, when reviews are a chunk of a larger file
+        started (float): time the run started, when reviews are a chunk of a larger run. The inference time of the
+            run is counted from it (previous sessions of the run already included)
+
+    Returns:
+        predictions (pandas dataframe): dataframe with review_index, review, positive_score and Prediction, in the
+        format expected by save_outputs (reviews the model gave no score to have a nan score and no Prediction), plus
+        the latency (seconds the model took per review of the batch that scored the review, waits for the rate limit
+        and between retries left out), input_length (characters) and retries (calls retried
+        after rate limits or transient errors) of every review
+        timings (RunTimings): timings of the run
+    """
+    # The scripts add the repository root to the path before running. Retries and time spent in the calls are counted
+    # per thread by the rate limiters, retry helpers and backends of serving/
+    from serving.rate_limit import pop_thread_call_time, pop_thread_retries
+
+    timings = RunTimings(len(reviews))
+    positive_scores = [None] * len(reviews)
+    pending = list(range(len(reviews)))
+    if started is not None:
+        timings.start = started
+    elif checkpoint is not None:
+        # Time of the previous sessions of the run
+        timings.start -= checkpoint.previous_elapsed
+    if checkpoint is not None:
+        # Scores of the previous sessions of the run, only the ones of these reviews are read
+        completed = checkpoint.completed_in(start_index, start_index + len(reviews))
+        for review_index, values in completed.items():
+            i = review_index - start_index
+            positive_scores[i], timings.latencies[i], timings.retries[i] = values
+        pending = [i for i in pending if start_index + i not in completed]
+
+    def score_batch(indices):
+        # Discards the retries and call time of a previous batch that failed in this thread
+        pop_thread_retries()
+        pop_thread_call_time()
+        start = time.time()
+        scores = list(adapter.score_batch([reviews[i] for i in indices]))
+        # Adapters calling a model without going through serving/ (local pipelines) record no call time, their wall
+        # time has no rate limit waits in it
+        call_time = pop_thread_call_time() or time.time() - start
+        latency = call_time / len(indices)
+        retries = pop_thread_retries()
+        if len(scores) != len(indices):
+            raise ValueError(f"{type(adapter).__name__} returned {len(scores)} scores for the {len(indices)} reviews of "
+                             f"the batch starting at review_index {start_index + indices[0]}")
+        unscored = sum(1 for score in scores if isnan(score))
+        if unscored:
+            print(f"{unscored} reviews of the batch starting at review_index {start_index + indices[0]} got no score")
+        for i, score in zip(indices, scores):
+            positive_scores[i] = score
+            timings.latencies[i] = latency
+            timings.retries[i] = retries
+        if checkpoint is not None:
+            # Reviews the model gave no score to (nan) are not saved, so a resumed run scores them again
+            checkpoint.append([(start_index + i, score, latency, retries) for i, score in zip(indices, scores)
+                               if not isnan(score)], timings.inference_time)
+        return len(indices)
+
+    batches = [pending[start:start + adapter.batch_size] for start in range(0, len(pending), adapter.batch_size)]
+    done = len(reviews) - len(pending)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(score_batch, batch) for batch in batches]
+        try:
+            for future in as_completed(futures):
+                done += future.result()
+                print(f"{start_index + done}/{start_index + len(reviews)}")
+        except BaseException:
+            # A failed review stops the run, reviews that were not started yet are dropped
+            for future in futures:
+                future.cancel()
+            raise
+    timings.end = time.time()
+
+    df = pd.DataFrame({
+        "review_index": range(start_index, start_index + len(reviews)),
+        "review": reviews,
+        "positive_score": positive_scores,
+    })
+    # Reviews without score get no prediction, so they are left out of the metrics instead of counted as negative
+    df['Prediction'] = [None if isnan(score) else 'positive' if score > threshold else 'negative'
+                        for score in df['positive_score']]
+    df['latency'] = timings.latencies
+    df['input_length'] = [len(review) for review in reviews]
+    df['retries'] = timings.retries
+    return df, timings
+
+
+def run_predictions_in_chunks(adapter, chunks, writer, workers=1, threshold=0.5, checkpoint=None):
+    """
+    Scores a dataset chunk by chunk, saving the predictions of every chunk before reading the next one, so memory use
+    does not depend on the size of the dataset.
+
+    Args:
+        adapter (ModelAdapter): model used to score
+        chunks (iterable): dataframes with review and review_index columns, like the ones of load_test_data
+        writer (OutputsWriter): writer receiving the predictions of every chunk
+        workers (int): batches of reviews scored at the same time
+        threshold (float): positive score above which a review is predicted as positive
+        checkpoint (Checkpoint): if given, scores are saved to it as soon as they are ready, and the reviews it
+            already holds are not scored again
+
+    Returns:
+        inference_time (float): seconds the run took, including previous sessions of the run
+    """
+    started = time.time() - (checkpoint.previous_elapsed if checkpoint is not None else 0.0)
+    for data in chunks:
+        start_index = int(data['review_index'].iloc[0]) if len(data) else 0
+        predictions, timings = run_predictions(adapter, list(data.review), workers=workers, threshold=threshold,
+                                               checkpoint=checkpoint, start_index=start_index, started=started)
+        print(timings.summary())
+        writer.write(data, predictions)
+    return time.time() - started
+
+
+def parse_runner_args(description, default_workers=4, default_batch_size=1):
+    """
+    Parses the command line options shared by the prediction scripts.
+
+    Args:
+        description (str): description of the script
+        default_workers (int): workers used when --workers is not given
+        default_batch_size (int): reviews per batch when --batch_size is not given
+
+    Returns:
+        args (Namespace): parsed options
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--workers', type=int, default=default_workers, help='Batches of reviews scored at the same time')
+    parser.add_argument('--batch_size', type=int, default=default_batch_size, help='Reviews per call to the model (useful with local models)')
+    parser.add_argument('--resume', action='store_true', help='Skip the reviews already scored by an interrupted run')
+    parser.add_argument('--chunksize', type=int, default=None, help='Read, score and save the data this many reviews at a time (for datasets that do not fit in memory)')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv', help='Format of the predictions (parquet needs pyarrow)')
+    return parser.parse_args()
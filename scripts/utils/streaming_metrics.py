@@ -0,0 +1,339 @@
+"""
+streaming_metrics.py
+
+Single-pass metric engine for model-logging.py. Predictions are read in chunks, and every chunk updates a few small
+accumulators (confusion counts, sums of absolute errors, fixed-bin histograms) with vectorized operations, so runs of
+any size are evaluated in constant memory.
+
+Classification report and MAE are the same as sklearn's classification_report and mean_absolute_error (overall and
+per class). Latency percentiles and the mean latency per length quartile are estimated from log-spaced histograms
+(within a few percent); the other latency statistics are exact.
+
+ThresholdSweep evaluates every decision threshold at once (precision, recall, F1 and accuracy curves, ROC-AUC, PR-AUC,
+best threshold and calibration), with one sort of the scores instead of one classification report per threshold. It
+keeps the scores of the run in memory, 9 bytes per review.
+
+Usage:
+    accumulator = MetricAccumulator()
+    for chunk in pd.read_csv(path, sep=';', chunksize=100000):
+        accumulator.update(chunk)
+    report = accumulator.classification_report()
+"""
+
+import numpy as np
+
+
+class MetricAccumulator:
+    """
+    Args:
+        bins (int): bins of the histogram of positive scores
+        score_range (tuple): range of the bins of the histogram of positive scores
+    """
+
+    # 20 bins per decade, from 0.1 ms to 3 hours for latencies and from 1 to 10 million characters for lengths
+    latency_edges = np.logspace(-4, 4, 161)
+    length_edges = np.logspace(0, 7, 141)
+
+    def __init__(self, bins=15, score_range=(0.0, 1.0)):
+        self.score_edges = np.linspace(score_range[0], score_range[1], bins + 1)
+        self.rows = 0
+        self.confusion = {}  # (target, prediction) -> reviews
+        self.error_sum = {}  # target -> sum of absolute errors of the reviews with a score
+        self.error_count = {}  # target -> reviews with a score
+        self.histograms = {}  # target -> reviews per score bin
+
+        self.latency_counts = np.zeros(len(self.latency_edges) + 1, dtype=np.int64)
+        self.latency_sum = 0.0
+        self.retries_sum = 0.0
+        self.retries_count = 0
+        # Sums to get the correlation and regression line of latency on length in a single pass
+        self.moments = np.zeros(6)  # n, sum x, sum y, sum xx, sum yy, sum xy
+        self.length_counts = np.zeros(len(self.length_edges) + 1, dtype=np.int64)
+        self.length_latency_sum = np.zeros(len(self.length_edges) + 1)
+
+    def update(self, chunk):
+        """
+        Adds a chunk of predictions.
+
+        Args:
+            chunk (pandas df): predictions with Target, Prediction and positive_score columns, and optionally latency,
+                input_length and retries
+        """
+        self.rows += len(chunk)
+        for pair, count in chunk.groupby(['Target', 'Prediction']).size().items():
+            self.confusion[pair] = self.confusion.get(pair, 0) + int(count)
+
+        # Absolute error against 1 for positive reviews and 0 for the others, reviews without score are ignored
+        targets = chunk['Target'].to_numpy()
+        scores = chunk['positive_score'].to_numpy(dtype=float)
+        scored = ~np.isnan(scores)
+        errors = np.abs((targets == 'positive').astype(float) - scores)
+        for target in chunk['Target'].dropna().unique():
+            mask = (targets == target) & scored
+            self.error_sum[target] = self.error_sum.get(target, 0.0) + errors[mask].sum()
+            self.error_count[target] = self.error_count.get(target, 0) + int(mask.sum())
+            counts, _ = np.histogram(scores[mask], bins=self.score_edges)
+            self.histograms[target] = self.histograms.get(target, 0) + counts
+
+        if 'retries' in chunk.columns:
+            retries = chunk['retries'].to_numpy(dtype=float)
+            self.retries_sum += np.nansum(retries)
+            self.retries_count += int((~np.isnan(retries)).sum())
+
+        if 'latency' not in chunk.columns:
+            return
+        latency = chunk['latency'].to_numpy(dtype=float)
+        timed = ~np.isnan(latency)
+        self.latency_counts += np.bincount(np.searchsorted(self.latency_edges, latency[timed], side='right'),
+                                           minlength=len(self.latency_counts))
+        self.latency_sum += latency[timed].sum()
+
+        if 'input_length' in chunk.columns:
+            length = chunk['input_length'].to_numpy(dtype=float)
+            both = timed & ~np.isnan(length)
+            x, y = length[both], latency[both]
+            self.moments += [len(x), x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()]
+            bins = np.searchsorted(self.length_edges, x, side='right')
+            self.length_counts += np.bincount(bins, minlength=len(self.length_counts))
+            self.length_latency_sum += np.bincount(bins, weights=y, minlength=len(self.length_latency_sum))
+
+    def classification_report(self):
+        """
+        Returns:
+            report (dict): same as sklearn classification_report(Target, Prediction, output_dict=True)
+        """
+        labels = sorted({target for target, _ in self.confusion} | {prediction for _, prediction in self.confusion})
+        report = {}
+        total = sum(self.confusion.values())
+        for label in labels:
+            true_positives = self.confusion.get((label, label), 0)
+            predicted = sum(count for (_, prediction), count in self.confusion.items() if prediction == label)
+            support = sum(count for (target, _), count in self.confusion.items() if target == label)
+            report[label] = {
+                'precision': true_positives / predicted if predicted else 0.0,
+                'recall': true_positives / support if support else 0.0,
+                'f1-score': 2 * true_positives / (predicted + support) if predicted + support else 0.0,
+                'support': support,
+            }
+        report['accuracy'] = sum(self.confusion.get((label, label), 0) for label in labels) / total if total else 0.0
+        for average in ('macro avg', 'weighted avg'):
+            weights = [report[label]['support'] if average == 'weighted avg' else 1 for label in labels]
+            report[average] = {
+                metric: (sum(report[label][metric] * weight for label, weight in zip(labels, weights)) / sum(weights)
+                         if sum(weights) else 0.0)
+                for metric in ('precision', 'recall', 'f1-score')
+            }
+            report[average]['support'] = total
+        return report
+
+    def mae(self):
+        """
+        Returns:
+            mae (float): mean absolute error of all the reviews with a score, against 1 for positive and 0 for negative reviews
+        """
+        count = sum(self.error_count.values())
+        return sum(self.error_sum.values()) / count if count else float('nan')
+
+    def mae_per_label(self):
+        """
+        Returns:
+            mae_positive (float): mean absolute error of the positive reviews
+            mae_negative (float): mean absolute error of the negative reviews
+        """
+        def mean(target):
+            count = self.error_count.get(target, 0)
+            return self.error_sum[target] / count if count else float('nan')
+        return mean('positive'), mean('negative')
+
+    def latency_metrics(self, inference_time):
+        """
+        Args:
+            inference_time (float): seconds the run took
+
+        Returns:
+            metrics (dict): throughput (reviews per second), p50/p95/p99 and mean latency, retries, and how latency
+            grows with the length of the review (correlation, seconds per 1000 characters, and mean latency per length
+            quartile). Runs saved without latencies only get their throughput.
+        """
+        metrics = {"throughput": self.rows / inference_time if inference_time else 0.0}
+        timed = int(self.latency_counts.sum())
+        if not timed:
+            return metrics
+        for percentile in (50, 95, 99):
+            metrics[f"latency_p{percentile}"] = _histogram_quantile(self.latency_counts, self.latency_edges,
+                                                                    percentile / 100)
+        metrics["latency_mean"] = self.latency_sum / timed
+
+        if self.retries_count:
+            metrics["retries_total"] = int(self.retries_sum)
+            metrics["retries_mean"] = self.retries_sum / self.retries_count
+
+        n, sx, sy, sxx, syy, sxy = self.moments
+        variance_x, variance_y = n * sxx - sx * sx, n * syy - sy * sy
+        if n > 1 and variance_x > 0:
+            metrics["latency_length_correlation"] = ((n * sxy - sx * sy) / np.sqrt(variance_x * variance_y)
+                                                     if variance_y > 0 else float('nan'))
+            metrics["latency_per_1000_chars"] = (n * sxy - sx * sy) / variance_x * 1000
+            # Length bins are assigned to the quartile holding their middle review
+            middle = (np.cumsum(self.length_counts) - self.length_counts / 2) / n
+            quartiles = np.minimum((middle * 4).astype(int), 3)
+            for quartile in range(4):
+                in_quartile = (quartiles == quartile) & (self.length_counts > 0)
+                if in_quartile.any():
+                    metrics[f"latency_mean_length_q{quartile + 1}"] = (self.length_latency_sum[in_quartile].sum()
+                                                                        / self.length_counts[in_quartile].sum())
+        return {key: float(value) for key, value in metrics.items()}
+
+
+def _histogram_quantile(counts, edges, q):
+    """
+    Quantile of values counted in bins [edges[i - 1], edges[i]), interpolated geometrically within its bin. Bin 0 and
+    the last bin hold the values out of the edges.
+    """
+    cumulative = np.cumsum(counts)
+    target = q * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target))
+    if i == 0:
+        return float(edges[0])
+    if i >= len(edges):
+        return float(edges[-1])
+    before = cumulative[i - 1]
+    fraction = (target - before) / counts[i] if counts[i] else 0.0
+    return float(edges[i - 1] * (edges[i] / edges[i - 1]) ** fraction)
+
+
+class ThresholdSweep:
+    """
+    Metrics of every possible decision threshold, from a single sort of the positive scores. Only the scores and the
+    ground truth of every review are kept (9 bytes per review), chunk by chunk.
+
+    A threshold t predicts as positive the reviews whose positive_score is above t, as the prediction scripts and the
+    app do. Thresholds are taken halfway between consecutive distinct scores, so every possible split is evaluated, and
+    the lowest one halfway between the lowest score and 0. All of them are valid decision thresholds, within [0, 1];
+    when some reviews are scored exactly 0, the lowest one (0) still predicts them as negative.
+
+    Args:
+        calibration_bins (int): equal-width bins of the calibration table
+    """
+
+    def __init__(self, calibration_bins=10):
+        self.calibration_bins = calibration_bins
+        self._scores = []
+        self._positives = []
+
+    def update(self, chunk):
+        """
+        Adds a chunk of predictions, with Target and positive_score columns. Reviews without score are ignored.
+        """
+        scores = chunk['positive_score'].to_numpy(dtype=float)
+        scored = ~np.isnan(scores)
+        self._scores.append(scores[scored])
+        self._positives.append((chunk['Target'].to_numpy() == 'positive')[scored])
+
+    def curves(self):
+        """
+        Returns:
+            curves (dict): arrays of threshold, precision, recall (true positive rate), fpr, f1 and accuracy, from the
+            highest threshold (nothing predicted as positive) to the lowest (everything predicted as positive)
+        """
+        scores = np.concatenate(self._scores) if self._scores else np.array([])
+        positives = np.concatenate(self._positives) if self._positives else np.array([], dtype=bool)
+        order = np.argsort(-scores, kind='mergesort')
+        scores, positives = scores[order], positives[order]
+
+        # Cumulative true and false positives when the reviews down to every distinct score are predicted as positive
+        last_of_score = np.r_[np.diff(scores) != 0, True] if len(scores) else np.array([], dtype=bool)
+        true_positives = np.r_[0, np.cumsum(positives)[last_of_score]]
+        false_positives = np.r_[0, np.cumsum(~positives)[last_of_score]]
+        distinct = scores[last_of_score]
+        lower = np.r_[distinct[1:], 0.0] if len(distinct) else distinct
+        thresholds = np.clip(np.r_[distinct[:1] if len(distinct) else [1.0], (distinct + lower) / 2], 0.0, 1.0)
+
+        n_positive, n = positives.sum(), len(positives)
+        predicted = true_positives + false_positives
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = np.where(predicted > 0, true_positives / predicted, 1.0)
+            recall = true_positives / n_positive if n_positive else np.zeros(len(thresholds))
+            fpr = false_positives / (n - n_positive) if n - n_positive else np.zeros(len(thresholds))
+            f1 = np.where(predicted + n_positive > 0, 2 * true_positives / (predicted + n_positive), 0.0)
+            accuracy = (true_positives + (n - n_positive - false_positives)) / n if n else np.zeros(len(thresholds))
+        return {
+            'threshold': thresholds,
+            'precision': precision,
+            'recall': recall,
+            'fpr': fpr,
+            'f1': f1,
+            'accuracy': accuracy,
+        }
+
+    @staticmethod
+    def downsample(curves, points=1001):
+        """
+        Keeps the rows of the curves closest to a grid of evenly spaced thresholds, so the table logged for a run stays
+        small whatever the number of distinct scores. Kept rows are exact, and the first and last ones are always kept.
+
+        Args:
+            curves (dict): output of curves
+            points (int): thresholds of the grid, from 1 to 0
+
+        Returns:
+            curves (dict): same arrays, with at most points + 2 rows
+        """
+        thresholds = curves['threshold']
+        if len(thresholds) <= points:
+            return curves
+        # First row at or below every threshold of the grid, thresholds being sorted from the highest to the lowest
+        rows = np.searchsorted(-thresholds, -np.linspace(1, 0, points), side='left')
+        rows = np.unique(np.r_[0, rows[rows < len(thresholds)], len(thresholds) - 1])
+        return {name: values[rows] for name, values in curves.items()}
+
+    def summary(self, curves, metric='f1'):
+        """
+        Args:
+            curves (dict): output of curves
+            metric (str): metric maximized by the best threshold, "f1" or "accuracy"
+
+        Returns:
+            summary (dict): roc_auc, pr_auc (average precision), best_threshold and the metrics at it
+        """
+        recall, precision = curves['recall'], curves['precision']
+        best = int(np.argmax(curves[metric]))
+        return {
+            # Trapezoids between consecutive points of the roc curve, which starts at (0, 0)
+            'roc_auc': float(np.sum(np.diff(curves['fpr']) * (recall[1:] + recall[:-1]) / 2)),
+            # Average precision: precision at every threshold weighted by the recall it adds
+            'pr_auc': float(np.sum(np.diff(recall) * precision[1:])),
+            'best_threshold': float(curves['threshold'][best]),
+            'best_threshold_f1': float(curves['f1'][best]),
+            'best_threshold_accuracy': float(curves['accuracy'][best]),
+            'best_threshold_precision': float(precision[best]),
+            'best_threshold_recall': float(recall[best]),
+        }
+
+    def calibration(self):
+        """
+        Returns:
+            table (list): for every bin of positive score, its bounds, reviews, mean score and fraction of positive
+            reviews
+            ece (float): expected calibration error, mean distance between mean score and fraction of positive reviews
+            weighted by the reviews of every bin
+        """
+        scores = np.concatenate(self._scores) if self._scores else np.array([])
+        positives = np.concatenate(self._positives) if self._positives else np.array([], dtype=bool)
+        edges = np.linspace(0, 1, self.calibration_bins + 1)
+        bins = np.clip(np.searchsorted(edges, scores, side='right') - 1, 0, self.calibration_bins - 1)
+        counts = np.bincount(bins, minlength=self.calibration_bins)
+        score_sums = np.bincount(bins, weights=scores, minlength=self.calibration_bins)
+        positive_sums = np.bincount(bins, weights=positives, minlength=self.calibration_bins)
+
+        table = []
+        ece = 0.0
+        for i in range(self.calibration_bins):
+            mean_score = score_sums[i] / counts[i] if counts[i] else float('nan')
+            positive_rate = positive_sums[i] / counts[i] if counts[i] else float('nan')
+            if counts[i]:
+                ece += counts[i] / len(scores) * abs(positive_rate - mean_score)
+            table.append({'lower': round(float(edges[i]), 6), 'upper': round(float(edges[i + 1]), 6),
+                          'reviews': int(counts[i]), 'mean_score': float(mean_score),
+                          'positive_rate': float(positive_rate)})
+        return table, float(ece)
@@ -0,0 +1,166 @@
+"""
+stub_inference_server.py
+
+Local http server answering like the Hugging Face inference API, with configurable latency and errors. Used to
+benchmark the serving path under load without calling (or paying for) the real api: the app is pointed at it with
+HF_ENDPOINT_URL.
+
+* zero-shot requests ({"inputs": ..., "parameters": {"candidate_labels": [...]}}) get {"sequence", "labels", "scores"}
+* other requests get text classification outputs, [[{"label": ..., "score": ...}, ...]]
+
+Usage:
+    python stub_inference_server.py --port 8081 --latency_ms 200 --jitter_ms 50 --error_rate 0.01
+    HF_ENDPOINT_URL=http://127.0.0.1:8081 HUGGING_FACE_TOKEN=stub python flask-app.py
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubBehaviour:
+    """
+    Latency and errors of the stub.
+
+    Args:
+        latency_ms (float): typical milliseconds per call
+        jitter_ms (float): spread of the latency (uniform half-width, or standard deviation of the lognormal)
+        distribution (str): "fixed", "uniform" or "lognormal"
+        error_rate (float): fraction of calls answered with an error
+        error_status (int): http status of the errors (429 errors carry a Retry-After header)
+        retry_after (float): seconds of the Retry-After header of 429 errors
+    """
+
+    def __init__(self, latency_ms=100.0, jitter_ms=0.0, distribution="uniform", error_rate=0.0, error_status=503,
+                 retry_after=1.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def latency(self):
+        """
+        Returns:
+            latency (float): seconds the next call takes
+        """
+        if self.distribution == "fixed" or not self.jitter_ms:
+            milliseconds = self.latency_ms
+        elif self.distribution == "uniform":
+            milliseconds = random.uniform(self.latency_ms - self.jitter_ms, self.latency_ms + self.jitter_ms)
+        elif self.distribution == "lognormal":
+            # Long right tail, like real inference latencies. latency_ms is the median
+            milliseconds = self.latency_ms * random.lognormvariate(0, self.jitter_ms / max(self.latency_ms, 1e-9))
+        else:
+            raise ValueError(f"Unknown latency distribution {self.distribution!r}")
+        return max(0.0, milliseconds) / 1000
+
+    def fails(self):
+        with self._lock:
+            self.calls += 1
+            failed = random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+
+def make_handler(behaviour):
+    """
+    Builds the request handler of a stub with the given behaviour.
+    """
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real api
+
+        def log_message(self, format, *args):
+            pass  # one line per call would slow down the benchmark
+
+        def _send(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            time.sleep(behaviour.latency())
+
+            if behaviour.fails():
+                headers = {"Retry-After": str(behaviour.retry_after)} if behaviour.error_status == 429 else None
+                self._send(behaviour.error_status, {"error": "Stub error"}, headers)
+                return
+
+            text = request.get("inputs", "")
+            labels = (request.get("parameters") or {}).get("candidate_labels")
+            # Deterministic score per text, so repeated runs give the same predictions
+            score = (zlib.crc32(str(text).encode("utf-8")) % 1000) / 1000
+            if labels:
+                scores = [score] + [(1 - score) / max(len(labels) - 1, 1)] * (len(labels) - 1)
+                ranked = sorted(zip(labels, scores), key=lambda item: item[1], reverse=True)
+                self._send(200, {"sequence": text, "labels": [label for label, _ in ranked],
+                                 "scores": [value for _, value in ranked]})
+            else:
+                ranked = sorted([("POSITIVE", score), ("NEGATIVE", 1 - score)], key=lambda item: item[1], reverse=True)
+                self._send(200, [[{"label": label, "score": value} for label, value in ranked]])
+
+    return StubHandler
+
+
+def start_stub_server(host="127.0.0.1", port=0, behaviour=None):
+    """
+    Starts a stub server in a background thread.
+
+    Args:
+        host (str): interface to listen on
+        port (int): port to listen on (0 picks a free one)
+        behaviour (StubBehaviour): latency and errors of the stub
+
+    Returns:
+        server (ThreadingHTTPServer): running server, its url is http://host:server.server_port. Stop it with shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(behaviour or StubBehaviour()))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-inference-server", daemon=True).start()
+    return server
+
+
+def add_behaviour_args(parser):
+    """
+    Adds the options of StubBehaviour to a parser.
+    """
+    parser.add_argument('--latency_ms', type=float, default=100.0, help='Typical milliseconds per call to the model')
+    parser.add_argument('--jitter_ms', type=float, default=20.0, help='Spread of the latency')
+    parser.add_argument('--distribution', choices=["fixed", "uniform", "lognormal"], default="uniform",
+                        help='Distribution of the latency')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of calls answered with an error')
+    parser.add_argument('--error_status', type=int, default=503, help='Http status of the errors')
+
+
+def behaviour_from_args(args):
+    return StubBehaviour(args.latency_ms, args.jitter_ms, args.distribution, args.error_rate, args.error_status)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub of the Hugging Face inference API")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8081, help='Port to listen on')
+    add_behaviour_args(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(behaviour_from_args(args)))
+    server.daemon_threads = True
+    print(f"Stub inference server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
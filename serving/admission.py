@@ -0,0 +1,237 @@
+"""
+admission.py
+
+Admission control for the prediction endpoints, so that a single large request or a burst from one client cannot
+starve the rest of the traffic of a worker.
+
+* size limits: reviews per request, total characters and body size. Requests over them are rejected with 413
+* bounded in-flight work: reviews of the admitted requests of a worker that are not answered yet. Requests that would
+  go over it are rejected right away with 429 and Retry-After, instead of queueing behind the work already admitted
+* fair share (optional): reviews in flight of a single client, as a fraction of the bound of the worker
+
+Usage:
+    limits.check(reviews)
+    with admission.admit(client_id, len(reviews)):
+        ...
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from serving.metrics import admitted_in_flight
+
+
+class AdmissionError(Exception):
+    """
+    Request rejected by admission control.
+
+    Args:
+        message (str): reason of the rejection, returned to the client
+        status (int): http status of the rejection
+        reason (str): label of the rejection in the metrics
+        retry_after (float): seconds the client should wait before trying again (None if retrying does not help)
+    """
+
+    def __init__(self, message, status, reason, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {"error": str(self)}
+
+    def headers(self):
+        return {"Retry-After": str(max(1, round(self.retry_after)))} if self.retry_after is not None else {}
+
+
+class RequestLimits:
+    """
+    Size limits of a request. None disables a limit.
+
+    Args:
+        max_items (int): reviews per request
+        max_chars (int): characters of all the reviews of a request
+        max_body_bytes (int): bytes of the body of a request, enforced by flask while reading it
+    """
+
+    def __init__(self, max_items=None, max_chars=None, max_body_bytes=None):
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.max_body_bytes = max_body_bytes
+
+    def check(self, reviews):
+        """
+        Args:
+            reviews (list): reviews of the request
+
+        Raises:
+            AdmissionError: with status 413 if the request is over a limit
+        """
+        if self.max_items is not None and len(reviews) > self.max_items:
+            raise AdmissionError(f"Too many reviews: {len(reviews)}, the maximum per request is {self.max_items}",
+                                 413, "items")
+        if self.max_chars is not None:
+            chars = sum(len(str(review)) for review in reviews)
+            if chars > self.max_chars:
+                raise AdmissionError(f"Reviews too long: {chars} characters, the maximum per request is {self.max_chars}",
+                                     413, "chars")
+
+
+class Ticket:
+    """
+    Reviews admitted for a request, given back to the controller once it is answered.
+    """
+
+    def __init__(self, client, units):
+        self.client = client
+        self.units = units
+        self.released = False
+
+
+class AdmissionControl:
+    """
+    Bounded number of reviews in flight in a worker, optionally shared fairly among clients. Requests are admitted or
+    rejected right away, never queued.
+
+    Args:
+        max_in_flight (int): reviews of admitted requests not answered yet (None for no bound)
+        client_share (float): fraction of max_in_flight a single client may hold (None for no per-client quota). A
+            client with nothing in flight is always admitted if the worker has room, whatever the size of its request.
+        retry_after (float): seconds returned in the Retry-After header of the rejections
+        client_header (str): header identifying the client, like an api key id set by a gateway. Without it, or when a
+            request does not carry it, clients are told apart by address. The header must be set (or stripped) by a
+            gateway the clients cannot bypass, otherwise a client can pick any identity
+    """
+
+    def __init__(self, max_in_flight=None, client_share=None, retry_after=1.0, client_header=None):
+        self.max_in_flight = max_in_flight
+        self.client_share = client_share
+        self.retry_after = retry_after
+        self.client_header = client_header
+        self.in_flight = 0
+        self._clients = {}  # client -> reviews in flight
+        self._lock = threading.Lock()
+
+    def client_of(self, request):
+        """
+        Args:
+            request (Request): flask request
+
+        Returns:
+            client (str): identifier of the client of the request
+        """
+        if self.client_header and request.headers.get(self.client_header):
+            return request.headers[self.client_header]
+        # X-Forwarded-For is set by the client, only the addresses added by trusted proxies are taken into account
+        # (see trusted_proxies_from_env), so the address cannot be forged to get a fresh quota
+        return request.remote_addr
+
+    def acquire(self, client, units):
+        """
+        Admits the reviews of a request.
+
+        Args:
+            client (str): identifier of the client
+            units (int): reviews of the request
+
+        Returns:
+            ticket (Ticket): to be released once the request is answered
+
+        Raises:
+            AdmissionError: with status 429 if the worker or the quota of the client is full
+        """
+        with self._lock:
+            if self.max_in_flight is not None and self.in_flight > 0 and self.in_flight + units > self.max_in_flight:
+                raise AdmissionError("Server busy, try again later", 429, "overloaded", self.retry_after)
+            client_in_flight = self._clients.get(client, 0)
+            if (self.max_in_flight is not None and self.client_share is not None and client_in_flight > 0
+                    and client_in_flight + units > self.client_share * self.max_in_flight):
+                raise AdmissionError("Too many reviews in flight for this client, try again later", 429,
+                                     "client_quota", self.retry_after)
+            self.in_flight += units
+            self._clients[client] = client_in_flight + units
+        admitted_in_flight.inc(units)
+        return Ticket(client, units)
+
+    def release(self, ticket):
+        """
+        Gives back the reviews of a ticket. Releasing a ticket twice has no effect.
+        """
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= ticket.units
+            remaining = self._clients.get(ticket.client, 0) - ticket.units
+            if remaining > 0:
+                self._clients[ticket.client] = remaining
+            else:
+                self._clients.pop(ticket.client, None)
+        admitted_in_flight.dec(ticket.units)
+
+    @contextmanager
+    def admit(self, client, units):
+        ticket = self.acquire(client, units)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+def _optional_int(name, default):
+    value = os.getenv(name, default)
+    return int(value) if value and int(value) > 0 else None
+
+
+def limits_from_env():
+    """
+    Returns:
+        limits (RequestLimits): limits set by PREDICT_MAX_ITEMS (default 500), PREDICT_MAX_CHARS (default 1000000) and
+        PREDICT_MAX_BODY_BYTES (default 4 MB). Empty or 0 disables a limit.
+    """
+    return RequestLimits(
+        max_items=_optional_int("PREDICT_MAX_ITEMS", "500"),
+        max_chars=_optional_int("PREDICT_MAX_CHARS", "1000000"),
+        max_body_bytes=_optional_int("PREDICT_MAX_BODY_BYTES", str(4 * 1024 * 1024)),
+    )
+
+
+def job_limits_from_env():
+    """
+    Returns:
+        limits (RequestLimits): limits of the files uploaded as bulk jobs, set by JOB_MAX_ITEMS (default 100000),
+        JOB_MAX_CHARS (default 200000000) and JOB_MAX_BODY_BYTES (default 256 MB). Empty or 0 disables a limit.
+    """
+    return RequestLimits(
+        max_items=_optional_int("JOB_MAX_ITEMS", "100000"),
+        max_chars=_optional_int("JOB_MAX_CHARS", "200000000"),
+        max_body_bytes=_optional_int("JOB_MAX_BODY_BYTES", str(256 * 1024 * 1024)),
+    )
+
+
+def trusted_proxies_from_env():
+    """
+    Returns:
+        trusted_proxies (int): proxies in front of the app that append the address of their client to X-Forwarded-For,
+        like the load balancer of the hosting platform, set by TRUSTED_PROXIES (default 0). The address of a request is
+        the one added by the outermost of them, or the address of the connection if there are none
+    """
+    return int(os.getenv("TRUSTED_PROXIES", "0") or 0)
+
+
+def admission_from_env():
+    """
+    Returns:
+        admission (AdmissionControl): controller configured with ADMISSION_MAX_IN_FLIGHT (default 500 reviews per
+        worker, empty or 0 for no bound), ADMISSION_CLIENT_SHARE (e.g. 0.25, default no per-client quota),
+        ADMISSION_RETRY_AFTER (default 1 second) and ADMISSION_CLIENT_HEADER
+    """
+    client_share = os.getenv("ADMISSION_CLIENT_SHARE")
+    return AdmissionControl(
+        max_in_flight=_optional_int("ADMISSION_MAX_IN_FLIGHT", "500"),
+        client_share=float(client_share) if client_share else None,
+        retry_after=float(os.getenv("ADMISSION_RETRY_AFTER", "1")),
+        client_header=os.getenv("ADMISSION_CLIENT_HEADER") or None,
+    )
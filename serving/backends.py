@@ -0,0 +1,308 @@
+"""
+backends.py
+
+Inference backends used to score reviews. Every backend exposes the same batched interface, so the flask app and the
+prediction scripts can switch between them through configuration:
+
+* remote : Hugging Face inference API, through the shared InferenceClient of client_pool (default)
+* local : model loaded in-process from a local directory and run on CPU with torch (needs torch and transformers)
+
+Usage:
+    SENTIMENT_BACKEND=local LOCAL_MODELS_DIR=models python flask-app.py
+
+With the local backend, the model of id "org/name" is loaded from LOCAL_MODELS_DIR/org/name. A tiny randomly
+initialized model saved with save_pretrained in such a folder is enough to exercise it.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from serving.client_pool import client_manager
+from serving.metrics import upstream_in_flight, upstream_latency
+from serving.rate_limit import (limiter_from_env, pop_thread_retries, record_retry, pop_thread_call_time,
+                                record_call_time)
+
+
+# Shared by all the remote backends of the process (None when HF_REQUESTS_PER_MINUTE is not set)
+hf_limiter = limiter_from_env("HF")
+
+
+class Backend:
+    """
+    Interface of the inference backends. Outputs are lists of {"label": str, "score": float} dictionaries sorted by
+    decreasing score, one list per input text.
+    """
+
+    # Whether scoring many texts in one call is cheaper than one call per text
+    batched = False
+    # Label of the provider in the metrics of the calls
+    upstream = None
+
+    def __init__(self, model):
+        self.model = model
+
+    def text_classification(self, texts, deadline=None):
+        """
+        Args:
+            texts (list): texts to classify
+            deadline (Deadline): deadline of the request, bounding the waits for the provider (None for no deadline)
+
+        Returns:
+            outputs (list): scores of all the labels of the model, for every text
+        """
+        raise NotImplementedError
+
+    def zero_shot_classification(self, texts, candidate_labels, deadline=None):
+        """
+        Args:
+            texts (list): texts to classify
+            candidate_labels (list): labels to choose from
+            deadline (Deadline): deadline of the request, bounding the waits for the provider (None for no deadline)
+
+        Returns:
+            outputs (list): scores of every candidate label (summing to 1), for every text
+        """
+        raise NotImplementedError
+
+
+class RemoteBackend(Backend):
+    """
+    Hugging Face inference API. The API scores one text per call, so the texts of a call are sent concurrently, up to
+    the size of the connection pool (HF_POOL_SIZE). Calls go through the rate limiter configured with
+    HF_REQUESTS_PER_MINUTE, if any.
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, model):
+        super().__init__(model)
+        # Host of the dedicated endpoint (HF_ENDPOINT_URL) the calls are sent to, or the serverless api
+        self.upstream = urlparse(client_manager.endpoint_url).netloc if client_manager.endpoint_url else "hf-inference"
+
+    def _map(self, func, texts):
+        if len(texts) <= 1:
+            return [func(text) for text in texts]
+        if RemoteBackend._executor is None:
+            with RemoteBackend._executor_lock:
+                if RemoteBackend._executor is None:
+                    RemoteBackend._executor = ThreadPoolExecutor(max_workers=client_manager.pool_size,
+                                                                 thread_name_prefix="remote-backend")
+        # Retries and call times are counted per thread, those of the executor threads go back to the calling one
+        retries = []
+        call_times = []
+
+        def run(text):
+            try:
+                return func(text)
+            finally:
+                retries.append(pop_thread_retries())
+                call_times.append(pop_thread_call_time())
+
+        try:
+            return list(RemoteBackend._executor.map(run, texts))
+        finally:
+            record_retry(sum(retries))
+            record_call_time(sum(call_times))
+
+    def _call(self, func, deadline):
+        """
+        Makes a call with a client whose timeout is clipped to the time left before the deadline, once the rate limiter
+        lets it through.
+
+        Args:
+            func (callable): function making the call with the client it receives
+            deadline (Deadline): deadline of the request (None for no deadline)
+        """
+        def call():
+            timeout = deadline.clip(client_manager.timeout) if deadline is not None else None
+            upstream_in_flight.inc(model=self.model, upstream=self.upstream)
+            start = time.perf_counter()
+            try:
+                return func(client_manager.get(self.model, timeout=timeout))
+            finally:
+                # Every attempt on its own, without the waits of the limiter
+                elapsed = time.perf_counter() - start
+                record_call_time(elapsed)
+                upstream_latency.observe(elapsed, model=self.model, upstream=self.upstream)
+                upstream_in_flight.dec(model=self.model, upstream=self.upstream)
+
+        # The quota of the inference api is per account, so all models share the same limiter
+        if hf_limiter is None:
+            return call()
+        return hf_limiter.call(call, deadline=deadline)
+
+    def text_classification(self, texts, deadline=None):
+        return self._map(
+            lambda text: _as_dicts(self._call(lambda client: client.text_classification(text, top_k=None), deadline)),
+            texts
+        )
+
+    def zero_shot_classification(self, texts, candidate_labels, deadline=None):
+        return self._map(
+            lambda text: _as_dicts(self._call(
+                lambda client: client.zero_shot_classification(text, candidate_labels=candidate_labels), deadline
+            )),
+            texts
+        )
+
+
+class LocalBackend(Backend):
+    """
+    Sequence classification or NLI model run on CPU. Texts are sorted by length and scored in padded batches, so
+    every forward pass carries as little padding as possible.
+
+    Args:
+        model (str): model id, only used to identify the backend
+        model_path (str or Path): directory with the weights and tokenizer (as written by save_pretrained)
+        num_threads (int): threads used by torch (None keeps the torch default)
+        batch_size (int): maximum texts per forward pass
+        max_length (int): maximum tokens per text (defaults to the maximum of the model, capped at 512)
+        hypothesis_template (str): template turning a candidate label into an NLI hypothesis
+    """
+
+    batched = True
+    upstream = "local"
+
+    def __init__(self, model, model_path, num_threads=None, batch_size=16, max_length=None,
+                 hypothesis_template="This example is {}."):
+        super().__init__(model)
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self._torch = torch
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.network = AutoModelForSequenceClassification.from_pretrained(model_path)
+        self.network.eval()
+        self.batch_size = batch_size
+        self.max_length = max_length or min(self.tokenizer.model_max_length, 512)
+        self.hypothesis_template = hypothesis_template
+        self.id2label = self.network.config.id2label
+        # Torch already spreads a forward pass over num_threads, running several at once only adds contention
+        self._lock = threading.Lock()
+
+    def _logits(self, texts, text_pairs=None):
+        """
+        Runs the model over texts (and their pairs), returning a tensor of logits in the order of the input.
+        """
+        torch = self._torch
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        logits = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in batch],
+                [text_pairs[i] for i in batch] if text_pairs is not None else None,
+                padding=True,
+                truncation="only_first",
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            with self._lock, torch.inference_mode():
+                upstream_in_flight.inc(model=self.model, upstream=self.upstream)
+                start_time = time.perf_counter()
+                try:
+                    batch_logits = self.network(**encoded).logits
+                finally:
+                    elapsed = time.perf_counter() - start_time
+                    record_call_time(elapsed)
+                    upstream_latency.observe(elapsed, model=self.model, upstream=self.upstream)
+                    upstream_in_flight.dec(model=self.model, upstream=self.upstream)
+            for i, row in zip(batch, batch_logits):
+                logits[i] = row
+        return torch.stack(logits)
+
+    def text_classification(self, texts, deadline=None):
+        if not texts:
+            return []
+        logits = self._logits(texts)
+        if logits.shape[-1] == 1:
+            probabilities = logits.sigmoid()
+        else:
+            probabilities = logits.softmax(dim=-1)
+        return [
+            _sorted([{"label": self.id2label[j], "score": float(p)} for j, p in enumerate(row)])
+            for row in probabilities
+        ]
+
+    def zero_shot_classification(self, texts, candidate_labels, deadline=None):
+        if not texts:
+            return []
+        premises = [text for text in texts for _ in candidate_labels]
+        hypotheses = [self.hypothesis_template.format(label) for _ in texts for label in candidate_labels]
+        logits = self._logits(premises, hypotheses)
+        entailment = logits[:, self._entailment_id()].reshape(len(texts), len(candidate_labels))
+        probabilities = entailment.softmax(dim=-1)
+        return [
+            _sorted([{"label": label, "score": float(p)} for label, p in zip(candidate_labels, row)])
+            for row in probabilities
+        ]
+
+    def _entailment_id(self):
+        for label_id, label in self.id2label.items():
+            if label.lower().startswith("entail"):
+                return int(label_id)
+        return -1  # same fallback as the transformers zero-shot pipeline
+
+
+def _as_dicts(output):
+    return [{"label": item["label"], "score": item["score"]} for item in output]
+
+
+def _sorted(output):
+    return sorted(output, key=lambda item: item["score"], reverse=True)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+_loading_locks = {}  # (kind, model) -> lock held while that backend is created
+
+
+def get_backend(model, kind=None):
+    """
+    Returns the backend of a model, creating it on first use. Loading a local model is expensive, so backends are
+    shared by all the callers of the process. A model is loaded while holding a lock of its own, so the callers of the
+    models already loaded are never held up by it.
+
+    Args:
+        model (str): model id
+        kind (str): "remote" or "local" (defaults to the SENTIMENT_BACKEND environment variable, or "remote")
+
+    Returns:
+        backend (Backend): backend scoring with that model
+    """
+    kind = kind or os.getenv("SENTIMENT_BACKEND", "remote")
+    key = (kind, model)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is not None:
+            return backend
+        loading_lock = _loading_locks.setdefault(key, threading.Lock())
+    with loading_lock:
+        with _backends_lock:
+            backend = _backends.get(key)  # created by another caller while this one waited
+        if backend is None:
+            backend = _create_backend(model, kind)
+            with _backends_lock:
+                _backends[key] = backend
+    return backend
+
+
+def _create_backend(model, kind):
+    if kind == "remote":
+        return RemoteBackend(model)
+    if kind == "local":
+        num_threads = os.getenv("LOCAL_NUM_THREADS")
+        return LocalBackend(
+            model,
+            Path(os.getenv("LOCAL_MODELS_DIR", "models")) / model,
+            num_threads=int(num_threads) if num_threads else None,
+            batch_size=int(os.getenv("LOCAL_BATCH_SIZE", "16")),
+        )
+    raise ValueError(f"Unknown backend {kind!r}, expected 'remote' or 'local'")
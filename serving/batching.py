@@ -0,0 +1,115 @@
+"""
+batching.py
+
+Dynamic micro-batching across concurrent requests. Items submitted by any request thread are gathered by a background
+thread into batches, bounded by a maximum size and a maximum wait, and each batch is dispatched to the backend in one
+go. Every caller receives a Future with the result of its own item only.
+
+Dispatch functions that score the items of a batch one by one use the fanout of the batcher, not the one of the
+requests: request threads wait on the batches, so sharing a pool with them could leave the batches without threads.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from serving.fanout import FanOut
+
+
+class MicroBatcher:
+    """
+    Args:
+        dispatch (callable): function receiving a list of items and returning a list with the result of every item,
+            in the same order. An Exception instance in that list fails only the future of its item.
+        max_batch_size (int): maximum number of items dispatched together
+        max_wait (float): maximum seconds the first item of a batch waits for more items to arrive
+        max_concurrent_batches (int): batches that can be dispatched at the same time
+    """
+
+    def __init__(self, dispatch, max_batch_size=16, max_wait=0.01, max_concurrent_batches=2):
+        self.dispatch = dispatch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_concurrent_batches)
+        self._lock = threading.Lock()
+        # Enough threads for every item of every batch running at the same time
+        self.fanout = FanOut(self.max_batch_size * self.max_concurrent_batches, thread_name_prefix="batch-item")
+
+    def _start(self):
+        # The scheduler is started lazily, so it runs inside each gunicorn worker and not in the master process
+        with self._lock:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches, thread_name_prefix="batch")
+                self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        """
+        Queues an item for the next batch.
+
+        Args:
+            item: item passed to dispatch
+
+        Returns:
+            future (Future): resolves to the result of the item
+        """
+        if self._thread is None:
+            self._start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]  # blocks until there is work
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._slots.acquire()  # waits while max_concurrent_batches are already running
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            items = [item for item, _ in batch]
+            try:
+                results = self.dispatch(items)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"dispatch returned {len(results)} results for a batch of {len(batch)} items")
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+def batching_enabled():
+    return os.getenv("PREDICT_BATCHING", "0") == "1"
+
+
+def batcher_from_env(dispatch):
+    """
+    Builds a MicroBatcher configured with the PREDICT_MAX_BATCH_SIZE, PREDICT_MAX_BATCH_WAIT_MS and
+    PREDICT_CONCURRENT_BATCHES environment variables.
+    """
+    return MicroBatcher(
+        dispatch,
+        max_batch_size=int(os.getenv("PREDICT_MAX_BATCH_SIZE", "16")),
+        max_wait=float(os.getenv("PREDICT_MAX_BATCH_WAIT_MS", "10")) / 1000,
+        max_concurrent_batches=int(os.getenv("PREDICT_CONCURRENT_BATCHES", "2")),
+    )
@@ -0,0 +1,216 @@
+"""
+cache.py
+
+Two-tier cache of positive scores for the serving path. The first tier is an in-memory LRU private to each worker, and
+the second one a SQLite file shared by all the workers of a machine that survives restarts.
+
+Entries hold the score of a whole review, the scores of the windows of a long review already combined (see chunking).
+They are keyed on the model (along with the way windows are combined), the candidate labels and a hash of the review,
+so changing any of them never returns a stale score.
+
+The disk tier is pruned every few minutes by the worker that writes to it: expired entries are deleted, then the oldest
+ones beyond the row cap. Disk lookups and writes give up after a short wait for the lock of another worker, a busy disk
+tier counts as a miss instead of slowing down the request.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class PredictionCache:
+    """
+    Args:
+        max_size (int): maximum number of entries kept in memory (0 disables the memory tier)
+        ttl (float): seconds an entry stays valid (0 or less keeps them forever)
+        path (str or Path): SQLite file of the disk tier (None or empty disables it)
+        max_disk_size (int): maximum number of entries kept on disk, the oldest ones are deleted first (0 for no cap)
+        disk_timeout (float): seconds a lookup or a write waits for a disk tier locked by another worker
+        prune_interval (float): seconds between two prunings of the disk tier by a worker
+    """
+
+    def __init__(self, max_size=10000, ttl=7 * 24 * 3600, path=None, max_disk_size=1000000, disk_timeout=0.05,
+                 prune_interval=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.max_disk_size = max_disk_size
+        self.disk_timeout = disk_timeout
+        self.prune_interval = prune_interval
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "disk_busy": 0}
+        self._next_prune = time.monotonic()
+
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)  # other workers may be creating it at the same time
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, score REAL, created REAL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created)")
+            conn.close()
+
+    @staticmethod
+    def make_key(model, positive_label, negative_label, review):
+        """
+        Builds the key of a review.
+
+        Args:
+            model (str): model used to score the review, along with anything else its score depends on
+            positive_label (str): label indicating positive review
+            negative_label (str): label indicating negative review
+            review (str): whole review, before it is split into the windows sent to the model
+
+        Returns:
+            key (str): hex digest identifying the prediction
+        """
+        review_hash = hashlib.sha256(review.encode("utf-8")).hexdigest()
+        return hashlib.sha256("\x1f".join([model, positive_label, negative_label, review_hash]).encode("utf-8")).hexdigest()
+
+    def _connection(self):
+        # sqlite connections can not be shared between threads, so every thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.disk_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")  # lets readers of other workers go on while one of them writes
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created, now):
+        return self.ttl > 0 and now - created > self.ttl
+
+    def _remember(self, key, score, created):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._memory[key] = (score, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, key):
+        """
+        Looks a key up, first in memory and then on disk.
+
+        Args:
+            key (str): key built with make_key
+
+        Returns:
+            score (float or None): cached positive score, or None if the key is missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._expired(entry[1], now):
+                    del self._memory[key]
+                else:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return entry[0]
+
+        if self.path is not None:
+            try:
+                row = self._connection().execute(
+                    "SELECT score, created FROM predictions WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                row = None  # a busy or broken disk tier should never fail (or hold up) a prediction
+                self._count("disk_busy")
+            if row is not None and not self._expired(row[1], now):
+                self._remember(key, row[0], row[1])
+                self._count("disk_hits")
+                return row[0]
+
+        self._count("misses")
+        return None
+
+    def set(self, key, score):
+        """
+        Stores the positive score of a key in both tiers.
+
+        Args:
+            key (str): key built with make_key
+            score (float): positive score of the review
+        """
+        now = time.time()
+        self._remember(key, score, now)
+        if self.path is not None:
+            try:
+                with self._connection() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO predictions (key, score, created) VALUES (?, ?, ?)", (key, score, now)
+                    )
+            except sqlite3.Error:
+                self._count("disk_busy")  # the score is still cached in memory
+                return
+            self._prune_if_due(now)
+
+    def _prune_if_due(self, now):
+        with self._lock:
+            if time.monotonic() < self._next_prune:
+                return
+            self._next_prune = time.monotonic() + self.prune_interval
+        try:
+            self.prune(now)
+        except sqlite3.Error:
+            self._count("disk_busy")  # tried again at the next interval
+
+    def prune(self, now=None):
+        """
+        Deletes the expired entries of the disk tier, then the oldest ones beyond max_disk_size.
+
+        Args:
+            now (float): current time (defaults to time.time())
+
+        Returns:
+            deleted (int): entries deleted
+        """
+        if self.path is None:
+            return 0
+        now = time.time() if now is None else now
+        deleted = 0
+        with self._connection() as conn:
+            if self.ttl > 0:
+                deleted += conn.execute("DELETE FROM predictions WHERE created < ?", (now - self.ttl,)).rowcount
+            if self.max_disk_size > 0:
+                excess = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.max_disk_size
+                if excess > 0:
+                    deleted += conn.execute(
+                        "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY created LIMIT ?)",
+                        (excess,)
+                    ).rowcount
+        return deleted
+
+    def stats(self):
+        """
+        Returns:
+            stats (dict): hit and miss counters of this worker, lookups and writes skipped because the disk tier was busy
+            (counted as misses too for lookups) and number of entries held in memory
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_size"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+prediction_cache = PredictionCache(
+    max_size=int(os.getenv("PREDICTION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PREDICTION_CACHE_TTL", str(7 * 24 * 3600))),
+    path=os.getenv("PREDICTION_CACHE_PATH", str(Path(__file__).resolve().parent.parent / "data" / "cache" / "predictions.sqlite")),
+    max_disk_size=int(os.getenv("PREDICTION_CACHE_DISK_SIZE", "1000000")),
+)
@@ -0,0 +1,134 @@
+"""
+cascade.py
+
+Two-stage scoring for the serving path. First, a small sentiment model scores every review. By default this is
+distilbert fine-tuned on SST-2, the distilbert-finetuned-sst-2 run. Only reviews it is unsure about go on to the large
+zero-shot model. A review is unsure when its positive score falls within the uncertainty band. Clear-cut reviews cost
+one call to the small model instead of one to the large one.
+
+Reviews whose first stage call fails are escalated too, so the cascade never answers worse than the zero-shot model
+alone. The first stage has its own circuit breaker and is not retried.
+
+Usage:
+    PREDICT_CASCADE=1 CASCADE_LOWER=0.1 CASCADE_UPPER=0.9 CASCADE_BACKEND=local python flask-app.py
+"""
+
+import os
+from math import nan, isnan
+
+from serving.backends import get_backend
+from serving.chunking import get_chunker, aggregate
+from serving.fanout import fanout, ItemError
+from serving.resilience import Resilience, CircuitBreaker
+
+
+class Cascade:
+    """
+    First stage of the cascade.
+
+    Args:
+        model (str): model id of the sentiment model of the first stage
+        lower (float): lower end of the uncertainty band
+        upper (float): upper end of the uncertainty band. Reviews scored within [lower, upper] are escalated.
+        kind (str): backend of the first stage, "remote" or "local" (defaults to SENTIMENT_BACKEND)
+        positive_label (str): label of the positive class in the outputs of the model
+        aggregation (str): how the scores of the windows of a long review are combined
+    """
+
+    def __init__(self, model, lower=0.1, upper=0.9, kind=None, positive_label="POSITIVE", aggregation="mean"):
+        if not 0 <= lower <= upper <= 1:
+            raise ValueError(f"Uncertainty band [{lower}, {upper}] is not within [0, 1]")
+        self.model = model
+        self.lower = lower
+        self.upper = upper
+        self.kind = kind
+        self.positive_label = positive_label
+        self.aggregation = aggregation
+        # Failures of the first stage only cost an escalation, so it is not retried and fails fast on its own
+        self.resilience = Resilience(CircuitBreaker(), max_retries=0)
+
+    @property
+    def key(self):
+        """
+        Identifies the configuration of the cascade in the keys of the prediction cache, as it changes the scores.
+        """
+        return f"cascade:{self.model}:{self.lower}-{self.upper}"
+
+    def outcome(self, score):
+        """
+        Args:
+            score (float): positive score of the first stage (nan if its call failed)
+
+        Returns:
+            outcome (str): "accepted" if the score is final, "escalated" if it falls within the uncertainty band, or
+            "failed" if the call failed (also escalated)
+        """
+        if isnan(score):
+            return "failed"
+        return "escalated" if self.lower <= score <= self.upper else "accepted"
+
+    def escalates(self, score):
+        """
+        Args:
+            score (float): positive score of the first stage (nan if its call failed)
+
+        Returns:
+            escalates (bool): whether the review has to be scored by the zero-shot model
+        """
+        return self.outcome(score) != "accepted"
+
+    def score(self, reviews, deadline=None):
+        """
+        Scores reviews with the first stage model. Backends able to score many texts at once get a single call, the
+        remote one gets concurrent calls of one review each.
+
+        Args:
+            reviews (list): reviews to score
+            deadline (Deadline): deadline of the request
+
+        Returns:
+            positive_scores (list): positive score of every review, nan for the reviews whose call failed
+        """
+        backend = self.resilience.wrap(get_backend(self.model, self.kind))
+        if backend.batched or len(reviews) == 1:
+            try:
+                return self._score(backend, reviews, deadline)
+            except Exception:
+                return [nan] * len(reviews)
+        outputs = fanout.map(lambda review: self._score(backend, [review], deadline)[0], reviews)
+        return [nan if isinstance(output, ItemError) else output for output in outputs]
+
+    def _score(self, backend, reviews, deadline):
+        # Long reviews are split into windows that fit the model, all windows are scored together
+        chunker = get_chunker(self.model)
+        windows = [chunker.split(review) for review in reviews]
+        outputs = iter(backend.text_classification([window for review_windows in windows for window in review_windows],
+                                                   deadline=deadline))
+        scores = []
+        for review_windows in windows:
+            window_scores = [item["score"] for _ in review_windows for item in next(outputs)
+                             if item["label"] == self.positive_label]
+            scores.append(aggregate(window_scores, self.aggregation))
+        return scores
+
+
+def cascade_from_env(aggregation="mean"):
+    """
+    Args:
+        aggregation (str): how the scores of the windows of a long review are combined
+
+    Returns:
+        cascade (Cascade): first stage configured with CASCADE_MODEL, CASCADE_LOWER (default 0.1), CASCADE_UPPER
+        (default 0.9), CASCADE_BACKEND and CASCADE_POSITIVE_LABEL (default POSITIVE), or None if PREDICT_CASCADE is
+        not set to 1
+    """
+    if os.getenv("PREDICT_CASCADE", "0") != "1":
+        return None
+    return Cascade(
+        os.getenv("CASCADE_MODEL", "distilbert/distilbert-base-uncased-finetuned-sst-2-english"),
+        lower=float(os.getenv("CASCADE_LOWER", "0.1")),
+        upper=float(os.getenv("CASCADE_UPPER", "0.9")),
+        kind=os.getenv("CASCADE_BACKEND") or None,
+        positive_label=os.getenv("CASCADE_POSITIVE_LABEL", "POSITIVE"),
+        aggregation=aggregation,
+    )
@@ -0,0 +1,212 @@
+"""
+chunking.py
+
+Token-aware splitting of long reviews. Instead of cutting reviews after a fixed number of characters, reviews are split
+into overlapping windows that fit the maximum sequence length of the model that scores them. The windows of a review
+are scored together and their positive scores combined into a single one (see AGGREGATIONS).
+
+The tokenizer of the model is loaded with transformers when it is installed (from LOCAL_MODELS_DIR/<model id> if that
+folder exists, otherwise from the Hugging Face hub). Without it, tokens are approximated from words and punctuation,
+with a safety margin for the words that the real tokenizer splits in several pieces. Long runs of characters without
+spaces (urls, base64, repeated letters) count as one token every few characters, and CJK characters as one token each,
+as the real tokenizers split them.
+"""
+
+import math
+import os
+import re
+import statistics
+import threading
+from pathlib import Path
+
+
+# Ways of combining the positive scores of the windows of a review. The names are the ones of pandas groupby
+# aggregations, so they can be passed to .agg() directly
+AGGREGATIONS = ("mean", "median", "max", "min", "first")
+
+# Tokens kept for the special tokens added by the tokenizer ([CLS], [SEP]...) and for re-tokenization differences
+# at the borders of the windows
+SPECIAL_TOKENS_MARGIN = 8
+
+
+class _TransformersTokenizer:
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.model_max_length = tokenizer.model_max_length
+
+    def offsets(self, text):
+        encoded = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return encoded["offset_mapping"]
+
+
+# Scripts written without spaces between words, every character is at least one token
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_APPROXIMATE_TOKENS = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+|[^\w\s]")
+
+
+class _ApproximateTokenizer:
+
+    # Words are usually one token, but long or rare words are split in several sub-words
+    TOKENS_PER_WORD = 1.5
+    # Runs of word characters longer than a word are counted as one token every CHARS_PER_TOKEN characters
+    MAX_WORD_CHARS = 12
+    CHARS_PER_TOKEN = 4
+    model_max_length = 512
+
+    def offsets(self, text):
+        offsets = []
+        for match in _APPROXIMATE_TOKENS.finditer(text):
+            start, end = match.span()
+            if end - start <= self.MAX_WORD_CHARS:
+                offsets.append((start, end))
+            else:
+                offsets.extend((i, min(i + self.CHARS_PER_TOKEN, end)) for i in range(start, end, self.CHARS_PER_TOKEN))
+        return offsets
+
+
+class ReviewChunker:
+    """
+    Splits reviews into windows of at most max_tokens tokens, overlapping by stride tokens.
+
+    Args:
+        tokenizer: object with an offsets(text) method returning the (start, end) characters of every token
+        max_tokens (int): maximum number of tokens of the review in a window
+        stride (int): tokens shared by consecutive windows, so sentences cut at a border are seen whole once
+    """
+
+    def __init__(self, tokenizer, max_tokens, stride=64):
+        self.tokenizer = tokenizer
+        self.max_tokens = max(1, max_tokens)
+        self.stride = min(max(0, stride), self.max_tokens // 2)
+
+    def split(self, review):
+        """
+        Args:
+            review (str): text of the review
+
+        Returns:
+            windows (list): substrings of the review, in order. A review that already fits is returned as is.
+        """
+        offsets = self.tokenizer.offsets(review)
+        if len(offsets) <= self.max_tokens:
+            return [review]
+
+        windows = []
+        step = self.max_tokens - self.stride
+        for start in range(0, len(offsets), step):
+            end = min(start + self.max_tokens, len(offsets))
+            windows.append(review[offsets[start][0]:offsets[end - 1][1]])
+            if end == len(offsets):
+                break
+        return windows
+
+
+def load_tokenizer(model):
+    """
+    Loads the tokenizer of a model, falling back to an approximation if transformers is not available or the tokenizer
+    can not be loaded.
+
+    Args:
+        model (str): model id
+
+    Returns:
+        tokenizer: object with an offsets(text) method and a model_max_length attribute
+    """
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        return _ApproximateTokenizer()
+
+    local_path = Path(os.getenv("LOCAL_MODELS_DIR", "models")) / model
+    try:
+        return _TransformersTokenizer(AutoTokenizer.from_pretrained(local_path if local_path.exists() else model))
+    except Exception:
+        return _ApproximateTokenizer()
+
+
+_chunkers = {}
+_chunkers_lock = threading.Lock()
+
+
+def get_chunker(model, reserved_tokens=0):
+    """
+    Returns the chunker of a model, creating it on first use.
+
+    Args:
+        model (str): model id
+        reserved_tokens (int): tokens of the sequence that are not available for the review, e.g. the hypothesis of a
+            zero-shot classification
+
+    Returns:
+        chunker (ReviewChunker): chunker fitting the maximum sequence length of the model. CHUNK_MAX_TOKENS caps it
+        and CHUNK_STRIDE sets the overlap between windows (default 64 tokens).
+    """
+    key = (model, reserved_tokens)
+    with _chunkers_lock:
+        chunker = _chunkers.get(key)
+        if chunker is None:
+            tokenizer = load_tokenizer(model)
+            # Some tokenizers report a huge sentinel when the length is unknown, 512 is the limit of the models we use
+            max_length = min(tokenizer.model_max_length, 512, int(os.getenv("CHUNK_MAX_TOKENS", "512")))
+            max_tokens = max_length - reserved_tokens - SPECIAL_TOKENS_MARGIN
+            if isinstance(tokenizer, _ApproximateTokenizer):
+                max_tokens = int(max_tokens / tokenizer.TOKENS_PER_WORD)
+            chunker = ReviewChunker(tokenizer, max_tokens, stride=int(os.getenv("CHUNK_STRIDE", "64")))
+            _chunkers[key] = chunker
+    return chunker
+
+
+def hypothesis_tokens(labels, template="This example is {}."):
+    """
+    Approximate number of tokens taken by the longest zero-shot hypothesis, to be reserved in every window.
+
+    Args:
+        labels (list): candidate labels
+        template (str): template turning a label into a hypothesis
+
+    Returns:
+        tokens (int): tokens to reserve
+    """
+    tokenizer = _ApproximateTokenizer()
+    return max(int(len(tokenizer.offsets(template.format(label))) * tokenizer.TOKENS_PER_WORD) + 1 for label in labels)
+
+
+def aggregate(scores, aggregation):
+    """
+    Combines the positive scores of the windows of a review, with the same result as the pandas aggregation of the
+    same name.
+
+    Args:
+        scores (list): positive score of every window, in order
+        aggregation (str): one of AGGREGATIONS
+
+    Returns:
+        score (float): positive score of the review
+    """
+    if not scores:
+        raise ValueError("No window scores to aggregate")
+    if len(scores) == 1:
+        return scores[0]
+    if aggregation == "mean":
+        return math.fsum(scores) / len(scores)
+    if aggregation == "median":
+        return statistics.median(scores)
+    if aggregation == "max":
+        return max(scores)
+    if aggregation == "min":
+        return min(scores)
+    if aggregation == "first":
+        return scores[0]
+    raise ValueError(f"Unknown aggregation {aggregation!r}, expected one of {AGGREGATIONS}")
+
+
+def chunk_aggregation():
+    """
+    Returns:
+        aggregation (str): aggregation of window scores set by CHUNK_AGGREGATION (default "mean")
+    """
+    aggregation = os.getenv("CHUNK_AGGREGATION", "mean")
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown CHUNK_AGGREGATION {aggregation!r}, expected one of {AGGREGATIONS}")
+    return aggregation
@@ -0,0 +1,98 @@
+"""
+client_pool.py
+
+Process-wide manager of Hugging Face inference clients. Clients are created lazily on first use and shared by all the
+requests handled by a worker, and a single http session shared by all the threads keeps its connections alive so the
+TLS handshake to the inference provider is paid once per connection instead of once per call.
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from huggingface_hub import InferenceClient, configure_http_backend
+
+
+class ClientManager:
+    """
+    Thread-safe registry of InferenceClient objects, one per model.
+
+    Args:
+        token (str): Hugging Face token used by all the clients
+        pool_size (int): maximum number of keep-alive connections kept per host, shared by all the threads of the process
+        timeout (float): seconds to wait for the inference provider before giving up (None waits forever)
+        endpoint_url (str): url of an inference endpoint all the models are sent to, like a dedicated endpoint or a
+            local stub server for benchmarks (None uses the inference api of every model)
+    """
+
+    def __init__(self, token=None, pool_size=10, timeout=None, endpoint_url=None):
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.endpoint_url = endpoint_url
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._backend_configured = False
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _session_factory(self):
+        """
+        Returns the http session used by huggingface_hub. The library asks for a session once per thread, every thread
+        gets the same one, so pool_size bounds the keep-alive connections of the whole process and not of every thread.
+        Connections are reused between calls, whichever thread makes them.
+        """
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                # Connections of the pool are handed to one thread at a time by urllib3, calls beyond pool_size open
+                # extra connections that are closed afterwards instead of waiting
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def get(self, model, timeout=None):
+        """
+        Returns the client of a model, creating it on first use.
+
+        Args:
+            model (str): model id or url of the inference endpoint
+            timeout (float): timeout of the call about to be made, when it is shorter than the one of the manager (e.g.
+                clipped to the deadline of a request)
+
+        Returns:
+            client (InferenceClient): client shared by all the callers of this process, or a client of its own with the
+            given timeout. Both use the same http session.
+        """
+        client = self._clients.get(model)
+        if client is None:
+            with self._lock:
+                if not self._backend_configured:
+                    configure_http_backend(backend_factory=self._session_factory)
+                    self._backend_configured = True
+                client = self._clients.get(model)
+                if client is None:
+                    client = InferenceClient(model=self.endpoint_url or model, token=self.token, timeout=self.timeout)
+                    self._clients[model] = client
+        if timeout is None or timeout == self.timeout:
+            return client
+        # The timeout is an attribute of the client, a short-lived copy is cheap as connections live in the session
+        return InferenceClient(model=self.endpoint_url or model, token=self.token, timeout=timeout)
+
+
+def _timeout_from_env():
+    # Bounds every call, so a hung connection is retried (or fails) instead of blocking a worker. Empty waits forever
+    timeout = os.getenv("HF_TIMEOUT", "30")
+    return float(timeout) if timeout else None
+
+
+# Shared by all the requests of a worker (each gunicorn worker process gets its own copy)
+client_manager = ClientManager(
+    token=os.getenv("HUGGING_FACE_TOKEN"),
+    pool_size=int(os.getenv("HF_POOL_SIZE", "10")),
+    timeout=_timeout_from_env(),
+    endpoint_url=os.getenv("HF_ENDPOINT_URL") or None,
+)
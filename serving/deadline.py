@@ -0,0 +1,72 @@
+"""
+deadline.py
+
+Deadline of a request, shared by every step waiting on the provider for it: the rate limiter, the calls themselves
+(whose timeout is clipped to the time left) and the retries between them.
+
+Usage:
+    deadline = Deadline(30)
+    timeout = deadline.clip(30)
+"""
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of calling (or waiting to call) the provider once the deadline of the request has passed.
+    """
+
+
+class Deadline:
+    """
+    Point in time after which a request should stop waiting for the provider.
+
+    Args:
+        seconds (float): seconds from now (None for no deadline)
+    """
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        """
+        Returns:
+            remaining (float or None): seconds left (0 once expired), or None if there is no deadline
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def clip(self, timeout):
+        """
+        Args:
+            timeout (float): timeout of a single call (None waits forever)
+
+        Returns:
+            timeout (float or None): the smaller of timeout and the seconds left
+
+        Raises:
+            DeadlineExceeded: if the deadline has passed
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining == 0:
+            raise DeadlineExceeded("Request deadline exceeded before calling the model")
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+def latest(deadlines):
+    """
+    Deadline of a call made on behalf of several requests, so that none of them is cut short.
+
+    Args:
+        deadlines (list): deadlines of the requests (None for no deadline)
+
+    Returns:
+        deadline (Deadline or None): the one ending last, or None if any of the requests has no deadline
+    """
+    if any(deadline is None or deadline.expires is None for deadline in deadlines):
+        return None
+    return max(deadlines, key=lambda deadline: deadline.expires)
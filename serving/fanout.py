@@ -0,0 +1,102 @@
+"""
+fanout.py
+
+Runs the upstream call of every review of a request concurrently on a worker-wide thread pool. Results keep the
+order of the input, and a failing review is returned as an ItemError instead of failing the whole list.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ItemError:
+    """
+    Placeholder returned in place of the result of an item whose call raised an exception.
+
+    Args:
+        exception (Exception): exception raised while processing the item
+    """
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.message = f"{type(exception).__name__}: {exception}"
+
+    def to_dict(self):
+        return {"error": self.message}
+
+    def __repr__(self):
+        return f"ItemError({self.message!r})"
+
+
+class FanOut:
+    """
+    Thread pool shared by all the requests of a worker. The pool is created on first use.
+
+    Args:
+        max_workers (int): maximum number of calls running at the same time. With 1, items are processed one after
+            the other in the calling thread.
+        thread_name_prefix (str): prefix of the names of the threads of the pool
+    """
+
+    def __init__(self, max_workers=8, thread_name_prefix="fanout"):
+        self.max_workers = max(1, max_workers)
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix=self.thread_name_prefix)
+        return self._executor
+
+    def map(self, func, items):
+        """
+        Applies func to every item.
+
+        Args:
+            func (callable): function called with a single item
+            items (list): items to process
+
+        Returns:
+            results (list): result of func for every item, in the same order as items. Items that raised an
+            exception get an ItemError instead.
+        """
+        if self.max_workers == 1 or len(items) <= 1:
+            return [_call(func, item) for item in items]
+
+        futures = [self.executor.submit(_call, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+def gather(futures):
+    """
+    Waits for a list of futures.
+
+    Args:
+        futures (list): futures to wait for
+
+    Returns:
+        results (list): result of every future, in the same order. Futures that failed get an ItemError instead.
+    """
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(ItemError(e))
+    return results
+
+
+def _call(func, item):
+    try:
+        return func(item)
+    except Exception as e:
+        return ItemError(e)
+
+
+fanout = FanOut(max_workers=int(os.getenv("PREDICT_CONCURRENCY", "8")))
@@ -0,0 +1,380 @@
+"""
+jobs.py
+
+Asynchronous bulk scoring jobs. Jobs and their reviews are persisted in a SQLite file, and background workers score
+the pending reviews in chunks. Since progress is stored after every chunk, jobs interrupted by a restart are picked up
+again where they stopped.
+
+Every process running a JobRunner takes part in the work: a job is claimed by one runner at a time, and a claim that
+stops being refreshed (the process died) is taken over by another runner. Every claim carries an owner token, and
+results are only saved by the current owner, so a runner whose claim was taken over stops instead of scoring the job
+twice.
+"""
+
+import csv
+import io
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    has_target INTEGER NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    heartbeat REAL,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    review_index INTEGER NOT NULL,
+    review TEXT NOT NULL,
+    target TEXT,
+    positive_score REAL,
+    prediction TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, review_index)
+);
+"""
+
+
+class ClaimLost(Exception):
+    """
+    Raised when a runner saves results of a job whose claim was taken over by another runner.
+    """
+
+
+class JobStore:
+    """
+    Args:
+        path (str or Path): SQLite file holding the jobs
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        # Files created before claims had an owner
+        if "owner" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def create(self, reviews, targets=None):
+        """
+        Queues a new job.
+
+        Args:
+            reviews (list): reviews to score
+            targets (list): ground truth sentiment of every review, if known
+
+        Returns:
+            job_id (str): id of the job
+        """
+        job_id = uuid.uuid4().hex
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, total, has_target, created) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, len(reviews), targets is not None, time.time()),
+            )
+            conn.executemany(
+                "INSERT INTO job_items (job_id, review_index, review, target) VALUES (?, ?, ?, ?)",
+                ((job_id, i, review, targets[i] if targets is not None else None) for i, review in enumerate(reviews)),
+            )
+        return job_id
+
+    def claim(self, stale_after):
+        """
+        Claims a queued job, or a running one whose runner stopped refreshing its heartbeat.
+
+        Args:
+            stale_after (float): seconds without heartbeat after which a running job is taken over
+
+        Returns:
+            claim (tuple or None): id of the claimed job and owner token of the claim, or None if there is nothing to do
+        """
+        now = time.time()
+        owner = uuid.uuid4().hex
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # only one runner can claim at a time
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?) "
+                "ORDER BY created LIMIT 1",
+                (now - stale_after,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started = COALESCE(started, ?), heartbeat = ?, owner = ? WHERE id = ?",
+                (now, now, owner, row["id"]),
+            )
+        return row["id"], owner
+
+    def heartbeat(self, job_id, owner):
+        """
+        Refreshes the claim of a job.
+
+        Returns:
+            owned (bool): False if the claim was taken over by another runner
+        """
+        with self._connection() as conn:
+            cursor = conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                                  (time.time(), job_id, owner))
+        return cursor.rowcount == 1
+
+    def pending_items(self, job_id, limit):
+        """
+        Returns:
+            items (list): up to limit (review_index, review) tuples of the job that are not scored yet
+        """
+        rows = self._connection().execute(
+            "SELECT review_index, review FROM job_items "
+            "WHERE job_id = ? AND positive_score IS NULL AND error IS NULL ORDER BY review_index LIMIT ?",
+            (job_id, limit),
+        ).fetchall()
+        return [(row["review_index"], row["review"]) for row in rows]
+
+    def save_results(self, job_id, owner, results):
+        """
+        Stores the results of a chunk and refreshes the progress of the job.
+
+        Args:
+            job_id (str): id of the job
+            owner (str): owner token of the claim
+            results (list): tuples of (review_index, positive_score, prediction, error)
+
+        Raises:
+            ClaimLost: if the claim was taken over by another runner, nothing is saved then
+        """
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # ownership cannot change until the results are saved
+            owned = conn.execute("SELECT 1 FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                                 (job_id, owner)).fetchone()
+            if owned is None:
+                raise ClaimLost(f"Job {job_id} was claimed by another runner")
+            conn.executemany(
+                "UPDATE job_items SET positive_score = ?, prediction = ?, error = ? WHERE job_id = ? AND review_index = ?",
+                ((score, prediction, error, job_id, i) for i, score, prediction, error in results),
+            )
+            conn.execute(
+                "UPDATE jobs SET heartbeat = ?, "
+                "done = (SELECT COUNT(*) FROM job_items WHERE job_id = ? AND (positive_score IS NOT NULL OR error IS NOT NULL)), "
+                "failed = (SELECT COUNT(*) FROM job_items WHERE job_id = ? AND error IS NOT NULL) "
+                "WHERE id = ?",
+                (time.time(), job_id, job_id, job_id),
+            )
+
+    def finish(self, job_id, owner):
+        """
+        Marks a job as done.
+
+        Raises:
+            ClaimLost: if the claim was taken over by another runner
+        """
+        with self._connection() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'done', finished = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                                  (time.time(), job_id, owner))
+        if cursor.rowcount != 1:
+            raise ClaimLost(f"Job {job_id} was claimed by another runner")
+
+    def get(self, job_id):
+        """
+        Returns:
+            job (dict or None): status, progress and throughput of the job, or None if it does not exist
+        """
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {key: row[key] for key in ("id", "status", "total", "done", "failed", "created", "started", "finished")}
+        job["progress"] = job["done"] / job["total"] if job["total"] else 1.0
+        if job["started"] is not None:
+            elapsed = (job["finished"] or time.time()) - job["started"]
+            job["reviews_per_second"] = job["done"] / elapsed if elapsed > 0 else None
+        return job
+
+    def export_predictions(self, job_id):
+        """
+        Writes the results of a job in the format of the predictions.csv files of save_outputs (semicolon separated,
+        with review, Target if it was given, positive_score and Prediction).
+
+        Returns:
+            lines: iterator over the lines of the csv, read from the database in chunks
+        """
+        has_target = self._connection().execute("SELECT has_target FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+        columns = ["review"] + (["Target"] if has_target else []) + ["positive_score", "Prediction"]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=";")
+
+        def flush():
+            value = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return value
+
+        writer.writerow(columns)
+        yield flush()
+        last_index = -1
+        while True:
+            rows = self._connection().execute(
+                "SELECT review_index, review, target, positive_score, prediction FROM job_items "
+                "WHERE job_id = ? AND review_index > ? ORDER BY review_index LIMIT 1000",
+                (job_id, last_index),
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                writer.writerow([row["review"]] + ([row["target"]] if has_target else []) + [row["positive_score"], row["prediction"]])
+            last_index = rows[-1]["review_index"]
+            yield flush()
+
+
+class JobRunner:
+    """
+    Background threads scoring the pending jobs of a JobStore.
+
+    Args:
+        store (JobStore): store holding the jobs
+        score_chunk (callable): function receiving a list of reviews and returning, for each of them, either its
+            positive score or an exception
+        workers (int): number of jobs scored at the same time by this process
+        chunk_size (int): reviews scored and saved at a time
+        poll_interval (float): seconds between checks for new jobs when idle
+        threshold (float): positive score above which a review is predicted as positive
+    """
+
+    def __init__(self, store, score_chunk, workers=1, chunk_size=32, poll_interval=1.0, threshold=0.5):
+        self.store = store
+        self.score_chunk = score_chunk
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.threshold = threshold
+        self.stale_after = max(60.0, 10 * poll_interval)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the threads of the runner, once: later calls do nothing. The app calls it on the first request of each
+        worker, so the threads run inside each gunicorn worker and not in the master process.
+        """
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._loop, name=f"job-runner-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _loop(self):
+        while True:
+            try:
+                claim = self.store.claim(self.stale_after)
+            except sqlite3.Error:
+                claim = None
+            if claim is None:
+                time.sleep(self.poll_interval)
+                continue
+            try:
+                self.run(*claim)
+            except ClaimLost:
+                continue  # another runner has the job now
+            except Exception:
+                # The heartbeat stops, so the job is taken over later on
+                time.sleep(self.poll_interval)
+
+    def _keep_alive(self, job_id, owner, stop, lost):
+        # Refreshes the claim while a chunk is being scored, however long it takes
+        while not stop.wait(self.stale_after / 4):
+            try:
+                if not self.store.heartbeat(job_id, owner):
+                    lost.set()
+                    return
+            except sqlite3.Error:
+                continue
+
+    def run(self, job_id, owner):
+        """
+        Scores the pending reviews of a job chunk by chunk, and marks it as done. The claim is refreshed in the
+        background while the job is scored.
+
+        Args:
+            job_id (str): id of the job
+            owner (str): owner token of the claim
+
+        Raises:
+            ClaimLost: if another runner took the job over, the job is left to it
+        """
+        stop, lost = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(target=self._keep_alive, args=(job_id, owner, stop, lost),
+                                     name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+        heartbeat.start()
+        try:
+            self._score_job(job_id, owner, lost)
+        finally:
+            stop.set()
+
+    def _score_job(self, job_id, owner, lost):
+        while True:
+            if lost.is_set():
+                raise ClaimLost(f"Job {job_id} was claimed by another runner")
+            items = self.store.pending_items(job_id, self.chunk_size)
+            if not items:
+                break
+            scores = self.score_chunk([review for _, review in items])
+            results = []
+            for (i, _), score in zip(items, scores):
+                if isinstance(score, Exception):
+                    results.append((i, None, None, f"{type(score).__name__}: {score}"))
+                else:
+                    results.append((i, score, 'positive' if score > self.threshold else 'negative', None))
+            self.store.save_results(job_id, owner, results)
+        self.store.finish(job_id, owner)
+
+
+def job_store_from_env():
+    """
+    Returns:
+        store (JobStore): store at JOBS_DB_PATH (default data/jobs/jobs.sqlite)
+    """
+    default_path = Path(__file__).resolve().parent.parent / "data" / "jobs" / "jobs.sqlite"
+    return JobStore(os.getenv("JOBS_DB_PATH", str(default_path)))
+
+
+def job_runner_from_env(store, score_chunk, threshold=0.5):
+    """
+    Args:
+        threshold (float): positive score above which a review is predicted as positive
+
+    Returns:
+        runner (JobRunner): runner configured with JOB_WORKERS (default 1) and JOB_CHUNK_SIZE (default 32)
+    """
+    return JobRunner(
+        store,
+        score_chunk,
+        workers=int(os.getenv("JOB_WORKERS", "1")),
+        chunk_size=int(os.getenv("JOB_CHUNK_SIZE", "32")),
+        threshold=threshold,
+    )
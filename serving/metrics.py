@@ -0,0 +1,199 @@
+"""
+metrics.py
+
+In-process metrics of the serving path, exposed at /metrics in the Prometheus text format. Recording a value is a
+dictionary lookup and an addition under a lock, cheap enough for the scoring path of every review.
+
+Every gunicorn worker keeps its own metrics, so a scraper sees the worker that answers the scrape. Aggregate them by
+instance (or run a single worker per container) when sizing the service.
+
+Usage:
+    requests_total = metrics.counter("requests_total", "Requests received", ["endpoint"])
+    requests_total.inc(endpoint="json")
+    text = metrics.render()
+"""
+
+import threading
+from bisect import bisect_left
+
+
+class _Metric:
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        """
+        Returns:
+            samples (list): tuples of (name, labels text, value), as written to the exposition format
+        """
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    """
+    Value that only goes up, like the number of reviews scored.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, like the number of calls in flight.
+    """
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (latencies, lengths) in cumulative buckets.
+
+    Args:
+        buckets (list): increasing upper bounds of the buckets, a +Inf bucket is always added
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(float(bound) for bound in buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect_left(self.buckets, value)  # first bucket whose bound is >= value
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][position] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else _format(bound)
+                    samples.append((f"{self.name}_bucket", self._labels(key, [("le", le)]), cumulative))
+                samples.append((f"{self.name}_sum", self._labels(key), total))
+                samples.append((f"{self.name}_count", self._labels(key), count))
+        return samples
+
+
+class Registry:
+    """
+    Set of metrics rendered together at /metrics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self._register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def render(self):
+        """
+        Returns:
+            text (str): all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Metrics of the worker
+metrics = Registry()
+
+request_latency = metrics.histogram(
+    "sentiment_request_duration_seconds", "Time spent answering a request", ["model", "endpoint"])
+upstream_latency = metrics.histogram(
+    "sentiment_upstream_call_duration_seconds",
+    "Time spent in a single call to the model (or forward pass of a local model), by provider", ["model", "upstream"])
+review_length = metrics.histogram(
+    "sentiment_review_length_chars", "Characters of the reviews received", ["model", "endpoint"],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+reviews_scored = metrics.counter(
+    "sentiment_reviews_scored_total", "Reviews scored successfully", ["model", "endpoint"])
+review_errors = metrics.counter(
+    "sentiment_review_errors_total", "Reviews whose scoring failed", ["model", "endpoint"])
+cache_lookups = metrics.counter(
+    "sentiment_cache_lookups_total",
+    "Lookups of the prediction cache, by result (hit, miss, or duplicate of a missing review of the same request)",
+    ["model", "endpoint", "result"])
+upstream_in_flight = metrics.gauge(
+    "sentiment_upstream_in_flight", "Calls to the model currently running, by provider", ["model", "upstream"])
+cascade_reviews = metrics.counter(
+    "sentiment_cascade_reviews_total",
+    "Reviews scored by the first stage of the cascade, by outcome (accepted, escalated, or failed and escalated)",
+    ["model", "endpoint", "outcome"])
+cascade_stage_latency = metrics.histogram(
+    "sentiment_cascade_stage_duration_seconds", "Time a request spends in each stage of the cascade (first or second)",
+    ["endpoint", "stage"])
+rejected_requests = metrics.counter(
+    "sentiment_rejected_requests_total",
+    "Requests rejected by admission control, by reason (items, chars, body, overloaded or client_quota)",
+    ["endpoint", "reason"])
+admitted_in_flight = metrics.gauge(
+    "sentiment_admitted_reviews_in_flight", "Reviews of admitted requests not answered yet")
@@ -0,0 +1,254 @@
+"""
+rate_limit.py
+
+Adaptive token-bucket rate limiter for calls to rate-limited providers (Cohere, Hugging Face inference API).
+
+Instead of sleeping a fixed time after every call, callers take a slot from a bucket that refills at the allowed rate,
+so calls can overlap as long as the budget allows it. When the provider answers with a rate-limit error (HTTP 429,
+optionally with Retry-After), the rate is halved and calls pause for the time asked by the provider; every successful
+call then raises the rate again, up to the configured budget.
+
+Usage:
+    limiter = RateLimiter(requests_per_window=10, window=60)
+    output = limiter.call(lambda: co.chat(model=..., messages=...), tokens=estimated_tokens)
+"""
+
+import os
+import threading
+import time
+
+from serving.deadline import DeadlineExceeded
+
+
+# Retries made by the calls of each thread, and time spent in them, so callers can report how many retries an item
+# needed and how long the model took
+_thread_retries = threading.local()
+
+
+def record_retry(count=1):
+    """
+    Counts retries made by the current thread, or on its behalf by the threads of an executor.
+
+    Args:
+        count (int): retries to add
+    """
+    _thread_retries.count = getattr(_thread_retries, "count", 0) + count
+
+
+def pop_thread_retries():
+    """
+    Returns:
+        retries (int): retries made by the current thread since the previous call
+    """
+    retries = getattr(_thread_retries, "count", 0)
+    _thread_retries.count = 0
+    return retries
+
+
+def record_call_time(seconds):
+    """
+    Adds the time spent in calls to a model by the current thread (or on its behalf by the threads of an executor),
+    without the waits for the rate limit budget and between retries, so callers can report the latency of the model.
+
+    Args:
+        seconds (float): seconds of the call
+    """
+    _thread_retries.call_time = getattr(_thread_retries, "call_time", 0.0) + seconds
+
+
+def pop_thread_call_time():
+    """
+    Returns:
+        call_time (float): seconds spent in calls to a model by the current thread since the previous call
+    """
+    call_time = getattr(_thread_retries, "call_time", 0.0)
+    _thread_retries.call_time = 0.0
+    return call_time
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised by RateLimiter.call when the provider keeps rate-limiting a call after all the retries.
+    """
+
+
+class _Bucket:
+
+    def __init__(self, capacity, window):
+        self.capacity = capacity
+        self.max_rate = capacity / window  # units per second
+        self.rate = self.max_rate
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # Requests bigger than the bucket only wait for it to be full
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+
+class RateLimiter:
+    """
+    Args:
+        requests_per_window (float): calls allowed per window
+        window (float): seconds of the window
+        tokens_per_window (float): tokens (e.g. LLM prompt and completion tokens) allowed per window, None for no limit
+        max_in_flight (int): maximum calls running at the same time, None for no limit
+        min_fraction (float): lowest fraction of the budget the rate can go down to after rate-limit errors
+        increase_fraction (float): fraction of the budget the rate goes up after every successful call
+    """
+
+    def __init__(self, requests_per_window, window=60.0, tokens_per_window=None, max_in_flight=None,
+                 min_fraction=0.1, increase_fraction=0.05):
+        self.requests = _Bucket(requests_per_window, window)
+        self.tokens = _Bucket(tokens_per_window, window) if tokens_per_window else None
+        self.min_fraction = min_fraction
+        self.increase_fraction = increase_fraction
+        self.paused_until = 0.0
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0, deadline=None):
+        """
+        Blocks until the budget allows one more call of the given number of tokens, and takes it from the budget.
+
+        Args:
+            tokens (int): tokens the call is expected to use
+            deadline (Deadline): deadline of the call (None waits as long as needed)
+
+        Raises:
+            DeadlineExceeded: right away if the budget does not allow the call before the deadline
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.requests.refill(now)
+                wait = max(self.paused_until - now, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    self.tokens.refill(now)
+                    wait = max(wait, self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.level -= 1
+                    if self.tokens is not None:
+                        self.tokens.level -= tokens
+                    return
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and wait >= remaining:
+                raise DeadlineExceeded(f"Rate limit budget allows the call in {wait:.1f} seconds, after the deadline")
+            time.sleep(wait)
+
+    def success(self):
+        """
+        Raises the rate after a successful call (additive increase).
+        """
+        with self._lock:
+            for bucket in self._buckets():
+                bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * self.increase_fraction)
+
+    def throttled(self, retry_after=None):
+        """
+        Halves the rate after a rate-limit error (multiplicative decrease), and pauses all calls for retry_after seconds.
+
+        Args:
+            retry_after (float): seconds asked by the provider before the next call, if any
+        """
+        with self._lock:
+            for bucket in self._buckets():
+                bucket.rate = max(bucket.max_rate * self.min_fraction, bucket.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def _buckets(self):
+        return [self.requests] + ([self.tokens] if self.tokens is not None else [])
+
+    def call(self, func, tokens=0, max_retries=5, deadline=None):
+        """
+        Makes a call within the budget, retrying it when the provider answers with a rate-limit error.
+
+        Args:
+            func (callable): function without arguments making the call
+            tokens (int): tokens the call is expected to use
+            max_retries (int): rate-limit errors tolerated before giving up
+            deadline (Deadline): deadline of the call, after which no more waits or retries are made
+
+        Returns:
+            result: result of func
+
+        Raises:
+            RateLimitExceeded: if the provider still rate-limits the call after max_retries retries
+            DeadlineExceeded: if the budget, or the pause asked by the provider, does not allow the call before the
+                deadline
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens, deadline)
+            if self._in_flight is not None:
+                remaining = deadline.remaining() if deadline is not None else None
+                if not self._in_flight.acquire(timeout=remaining):
+                    raise DeadlineExceeded("Too many calls in flight to make the call before the deadline")
+            try:
+                result = func()
+            except Exception as e:
+                limited, retry_after = rate_limit_details(e)
+                if not limited:
+                    raise
+                self.throttled(retry_after)
+                if attempt == max_retries:
+                    raise RateLimitExceeded(f"Still rate limited after {max_retries} retries") from e
+                record_retry()
+                continue
+            finally:
+                if self._in_flight is not None:
+                    self._in_flight.release()
+            self.success()
+            return result
+
+
+def rate_limit_details(exception):
+    """
+    Tells if an exception raised by a client is a rate-limit error.
+
+    Args:
+        exception (Exception): exception raised by requests, huggingface_hub or cohere
+
+    Returns:
+        limited (bool): True for HTTP 429 errors
+        retry_after (float or None): seconds asked by the provider in the Retry-After header, if any
+    """
+    response = getattr(exception, "response", None)
+    status = getattr(exception, "status_code", None) or getattr(response, "status_code", None)
+    if status != 429:
+        return False, None
+    headers = getattr(exception, "headers", None) or getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return True, float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return True, None  # http date instead of seconds, fall back to the adaptive rate alone
+
+
+def limiter_from_env(prefix):
+    """
+    Builds the limiter of a provider from <prefix>_REQUESTS_PER_MINUTE, <prefix>_TOKENS_PER_MINUTE and
+    <prefix>_MAX_IN_FLIGHT.
+
+    Args:
+        prefix (str): prefix of the environment variables, e.g. "HF" or "COHERE"
+
+    Returns:
+        limiter (RateLimiter or None): None when no request budget is configured
+    """
+    requests_per_minute = os.getenv(f"{prefix}_REQUESTS_PER_MINUTE")
+    if not requests_per_minute:
+        return None
+    tokens_per_minute = os.getenv(f"{prefix}_TOKENS_PER_MINUTE")
+    max_in_flight = os.getenv(f"{prefix}_MAX_IN_FLIGHT")
+    return RateLimiter(
+        float(requests_per_minute),
+        window=60.0,
+        tokens_per_window=float(tokens_per_minute) if tokens_per_minute else None,
+        max_in_flight=int(max_in_flight) if max_in_flight else None,
+    )
@@ -0,0 +1,261 @@
+"""
+resilience.py
+
+Protections around upstream calls, so a slow or failing inference provider does not hang the workers:
+
+* retries with jittered exponential backoff for transient errors (timeouts, connection errors, 429 and 5xx answers)
+* a request deadline, which clips the timeout of every call and the waits of the rate limiter, and after which no
+  more calls or retries are made
+* a circuit breaker that, after several consecutive failures, fails fast (or switches to a fallback backend) for a
+  while instead of sending more calls to a provider that is down
+
+Usage:
+    resilience = resilience_from_env()
+    backend = resilience.wrap(get_backend(model_name))
+    outputs = backend.zero_shot_classification(texts, candidate_labels, deadline=Deadline(30))
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+
+from serving.backends import Backend, get_backend
+from serving.deadline import Deadline, DeadlineExceeded
+from serving.rate_limit import RateLimitExceeded, record_retry
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the provider while the circuit breaker is open.
+    """
+
+
+def is_transient(exception):
+    """
+    Tells if an error is worth retrying: timeouts, connection errors, rate limits and server errors. Other http
+    errors (bad input, wrong token...) would fail again.
+    """
+    if isinstance(exception, (CircuitOpenError, DeadlineExceeded)):
+        return False
+    if isinstance(exception, RateLimitExceeded):
+        return True
+    response = getattr(exception, "response", None)
+    status = getattr(exception, "status_code", None) or getattr(response, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(exception, (TimeoutError, ConnectionError, requests.exceptions.Timeout,
+                                  requests.exceptions.ConnectionError))
+
+
+def retry_call(func, deadline=None, max_retries=3, base_delay=0.5, max_delay=8.0):
+    """
+    Calls func, retrying transient errors with jittered exponential backoff ("full jitter") within the deadline.
+
+    Args:
+        func (callable): function without arguments making the call
+        deadline (Deadline): no attempt is started after the deadline, nor a retry whose wait would end after it
+        max_retries (int): retries after the first attempt
+        base_delay (float): maximum wait before the first retry, doubled for every following one
+        max_delay (float): cap of the wait between attempts
+
+    Returns:
+        result: result of func
+    """
+    for attempt in range(max_retries + 1):
+        if deadline is not None and deadline.remaining() == 0:
+            raise DeadlineExceeded("Request deadline exceeded before calling the model")
+        try:
+            return func()
+        except Exception as e:
+            # The rate limiter already retried a call it gives up on, as long as the provider asked
+            if attempt == max_retries or not is_transient(e) or isinstance(e, RateLimitExceeded):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and delay >= remaining:
+                raise
+            record_retry()
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. After failure_threshold consecutive failures it opens, and calls fail right away with
+    CircuitOpenError. After recovery_time seconds it lets a single trial call through (half-open): a success closes it,
+    a failure opens it again.
+
+    Args:
+        failure_threshold (int): consecutive failures that open the breaker
+        recovery_time (float): seconds the breaker stays open before a trial call
+    """
+
+    def __init__(self, failure_threshold=5, recovery_time=30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.recovery_time:
+                return "half-open"
+            return "open"
+
+    def _before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.recovery_time or self._trial_running:
+                raise CircuitOpenError("Upstream circuit breaker is open")
+            self._trial_running = True
+
+    def _after_call(self, success):
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+    def call(self, func):
+        """
+        Calls func through the breaker. Only transient errors count as failures of the provider, and a call stopped by
+        the deadline of its request counts as neither a failure nor a success.
+        """
+        self._before_call()
+        try:
+            result = func()
+        except DeadlineExceeded:
+            with self._lock:
+                self._trial_running = False
+            raise
+        except Exception as e:
+            self._after_call(success=not is_transient(e))
+            raise
+        self._after_call(success=True)
+        return result
+
+
+class ResilientBackend(Backend):
+    """
+    Backend wrapping another one with retries, deadlines and a circuit breaker. When the breaker is open, or retries
+    run out on a transient error, calls go to the fallback backend if there is one.
+
+    Args:
+        primary (Backend): backend normally used
+        resilience (Resilience): breaker and retry settings shared by the calls to the provider
+    """
+
+    def __init__(self, primary, resilience):
+        super().__init__(primary.model)
+        self.primary = primary
+        self.resilience = resilience
+        self.batched = primary.batched
+
+    def _run(self, method, args, deadline):
+        resilience = self.resilience
+        if deadline is not None and deadline.remaining() == 0:
+            raise DeadlineExceeded("Request deadline exceeded before calling the model")
+        try:
+            return resilience.breaker.call(lambda: retry_call(
+                lambda: getattr(self.primary, method)(*args, deadline=deadline),
+                deadline=deadline,
+                max_retries=resilience.max_retries,
+                base_delay=resilience.base_delay,
+                max_delay=resilience.max_delay,
+            ))
+        except Exception as e:
+            if not resilience.has_fallback or not (isinstance(e, CircuitOpenError) or is_transient(e)):
+                raise
+            # Loaded on first use, a local fallback model is only paid for if the provider ever fails
+            fallback = get_backend(resilience.fallback_model or self.model, resilience.fallback_kind)
+            return getattr(fallback, method)(*args, deadline=deadline)
+
+    def text_classification(self, texts, deadline=None):
+        return self._run("text_classification", (texts,), deadline)
+
+    def zero_shot_classification(self, texts, candidate_labels, deadline=None):
+        return self._run("zero_shot_classification", (texts, candidate_labels), deadline)
+
+
+class Resilience:
+    """
+    Protections shared by all the calls of a worker to the provider.
+
+    Args:
+        breaker (CircuitBreaker): breaker of the provider
+        fallback_kind (str): kind of backend (see get_backend) used while the provider is unavailable, None for the
+            default kind
+        fallback_model (str): model used while the provider is unavailable, None for the same model. It must answer
+            with the labels of the main model (another NLI model for zero-shot classification)
+        max_retries (int): retries of a call to the provider
+        base_delay (float): maximum wait before the first retry
+        max_delay (float): cap of the wait between retries
+        deadline (float): seconds a request may spend waiting for the provider (None for no limit)
+    """
+
+    def __init__(self, breaker, fallback_kind=None, fallback_model=None, max_retries=3, base_delay=0.5, max_delay=8.0,
+                 deadline=None):
+        self.breaker = breaker
+        self.fallback_kind = fallback_kind
+        self.fallback_model = fallback_model
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    @property
+    def has_fallback(self):
+        # Without any fallback, calls fail fast while the provider is unavailable
+        return self.fallback_kind is not None or self.fallback_model is not None
+
+    def wrap(self, backend):
+        """
+        Args:
+            backend (Backend): backend calling the provider
+
+        Returns:
+            backend (ResilientBackend): same backend, with the protections
+        """
+        return ResilientBackend(backend, self)
+
+    def new_deadline(self):
+        """
+        Returns:
+            deadline (Deadline): deadline of a request starting now
+        """
+        return Deadline(self.deadline)
+
+
+def resilience_from_env():
+    """
+    Builds the protections from UPSTREAM_MAX_RETRIES, UPSTREAM_BACKOFF_BASE, UPSTREAM_BACKOFF_MAX, PREDICT_DEADLINE,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_TIME, SENTIMENT_FALLBACK_BACKEND and SENTIMENT_FALLBACK_MODEL.
+
+    Returns:
+        resilience (Resilience): protections of the worker
+    """
+    deadline = os.getenv("PREDICT_DEADLINE", "60")
+    return Resilience(
+        CircuitBreaker(
+            failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+            recovery_time=float(os.getenv("BREAKER_RECOVERY_TIME", "30")),
+        ),
+        fallback_kind=os.getenv("SENTIMENT_FALLBACK_BACKEND") or None,
+        fallback_model=os.getenv("SENTIMENT_FALLBACK_MODEL") or None,
+        max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "3")),
+        base_delay=float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5")),
+        max_delay=float(os.getenv("UPSTREAM_BACKOFF_MAX", "8")),
+        deadline=float(deadline) if deadline else None,
+    )
@@ -0,0 +1,86 @@
+"""
+singleflight.py
+
+Coalesces identical calls that are in flight at the same time. The first caller of a key runs the call and the callers
+that arrive while it is running wait for its result instead of making their own call.
+"""
+
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0  # number of calls that were served by another caller's result
+
+    def do(self, key, func):
+        """
+        Runs func, unless a call with the same key is already running, in which case its result is awaited.
+
+        Args:
+            key (hashable): identifies the call
+            func (callable): function without arguments making the call
+
+        Returns:
+            result: result of the call. If the call raised an exception, it is raised to every waiting caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+
+        return future.result()
+
+    def submit(self, key, start):
+        """
+        Non-blocking version of do, for calls that already return a Future.
+
+        Args:
+            key (hashable): identifies the call
+            start (callable): function without arguments starting the call and returning its Future
+
+        Returns:
+            future (Future): future of the call, shared with the other callers of the same key
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = start()
+            self._calls[key] = future
+        # Outside of the lock, as the callback runs right away if the future is already done
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def in_flight(self):
+        """
+        Returns:
+            in_flight (int): number of distinct calls running right now
+        """
+        with self._lock:
+            return len(self._calls)
+
+
+singleflight = SingleFlight()
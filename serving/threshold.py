@@ -0,0 +1,29 @@
+"""
+threshold.py
+
+Decision threshold of the serving path: reviews whose positive score is above it are predicted as positive.
+
+model-logging.py sweeps every threshold of a model's predictions and writes the best one to threshold.json in the run
+folder of the model. Point PREDICT_THRESHOLD_FILE at that file to serve with it, or set PREDICT_THRESHOLD directly.
+"""
+
+import json
+import os
+
+
+def decision_threshold():
+    """
+    Returns:
+        threshold (float): PREDICT_THRESHOLD if set, otherwise the "threshold" of the json file at
+            PREDICT_THRESHOLD_FILE if set, otherwise 0.5
+    """
+    if os.getenv("PREDICT_THRESHOLD"):
+        threshold = float(os.getenv("PREDICT_THRESHOLD"))
+    elif os.getenv("PREDICT_THRESHOLD_FILE"):
+        with open(os.getenv("PREDICT_THRESHOLD_FILE"), "r", encoding="utf-8") as f:
+            threshold = float(json.load(f)["threshold"])
+    else:
+        threshold = 0.5
+    if not 0 <= threshold <= 1:
+        raise ValueError(f"Decision threshold {threshold} is not between 0 and 1")
+    return threshold
@@ -0,0 +1,16 @@
+"""
+conftest.py
+
+Makes the serving package and the utils of the scripts importable from the tests, the way the app and the scripts
+import them.
+
+Usage:
+    python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(base_dir))
+sys.path.append(str(base_dir / "scripts" / "utils"))
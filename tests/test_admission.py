@@ -0,0 +1,94 @@
+"""
+test_admission.py
+
+Checks the size limits and the accounting of the reviews in flight of serving/admission.py.
+
+Usage:
+    python -m pytest tests/test_admission.py
+"""
+
+import pytest
+
+from serving.admission import AdmissionControl, AdmissionError, RequestLimits
+
+
+def test_acquire_and_release_keep_count_of_reviews_in_flight():
+    admission = AdmissionControl(max_in_flight=10)
+    first = admission.acquire("a", 4)
+    second = admission.acquire("b", 6)
+    assert admission.in_flight == 10
+    assert admission._clients == {"a": 4, "b": 6}
+
+    admission.release(first)
+    assert admission.in_flight == 6
+    assert admission._clients == {"b": 6}
+    admission.release(second)
+    assert admission.in_flight == 0
+    assert admission._clients == {}
+
+
+def test_releasing_a_ticket_twice_has_no_effect():
+    admission = AdmissionControl(max_in_flight=10)
+    ticket = admission.acquire("a", 3)
+    other = admission.acquire("a", 2)
+    admission.release(ticket)
+    admission.release(ticket)
+    assert admission.in_flight == 2
+    assert admission._clients == {"a": 2}
+    admission.release(other)
+
+
+def test_full_worker_rejects_with_retry_after():
+    admission = AdmissionControl(max_in_flight=10, retry_after=3)
+    ticket = admission.acquire("a", 8)
+    with pytest.raises(AdmissionError) as rejected:
+        admission.acquire("b", 3)
+    assert rejected.value.status == 429
+    assert rejected.value.reason == "overloaded"
+    assert rejected.value.headers() == {"Retry-After": "3"}
+    # A rejected request holds nothing
+    assert admission.in_flight == 8
+    assert admission.acquire("b", 2).units == 2
+    admission.release(ticket)
+
+
+def test_idle_worker_admits_a_request_larger_than_the_bound():
+    admission = AdmissionControl(max_in_flight=10)
+    ticket = admission.acquire("a", 50)
+    with pytest.raises(AdmissionError):
+        admission.acquire("b", 1)
+    admission.release(ticket)
+    assert admission.in_flight == 0
+
+
+def test_client_share_limits_a_single_client():
+    admission = AdmissionControl(max_in_flight=10, client_share=0.5)
+    admission.acquire("a", 4)
+    with pytest.raises(AdmissionError) as rejected:
+        admission.acquire("a", 2)
+    assert rejected.value.reason == "client_quota"
+    # Other clients still get their share
+    admission.acquire("b", 5)
+    assert admission.in_flight == 9
+
+
+def test_admit_releases_when_the_request_fails():
+    admission = AdmissionControl(max_in_flight=10)
+    with pytest.raises(RuntimeError):
+        with admission.admit("a", 5):
+            assert admission.in_flight == 5
+            raise RuntimeError("scoring failed")
+    assert admission.in_flight == 0
+    assert admission._clients == {}
+
+
+def test_request_limits():
+    limits = RequestLimits(max_items=2, max_chars=10)
+    limits.check(["short", "ones"])
+    with pytest.raises(AdmissionError) as rejected:
+        limits.check(["a", "b", "c"])
+    assert (rejected.value.status, rejected.value.reason) == (413, "items")
+    with pytest.raises(AdmissionError) as rejected:
+        limits.check(["far too long"])
+    assert (rejected.value.status, rejected.value.reason) == (413, "chars")
+    RequestLimits().check(["no limits"] * 1000)
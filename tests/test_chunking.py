@@ -0,0 +1,42 @@
+"""
+test_chunking.py
+
+Checks that the approximate tokenizer used without transformers does not undercount the tokens of text without spaces,
+so the windows of the chunker still fit the model.
+
+Usage:
+    python -m pytest tests/test_chunking.py
+"""
+
+from serving.chunking import ReviewChunker, _ApproximateTokenizer
+
+
+def test_words_and_punctuation_are_one_token():
+    tokenizer = _ApproximateTokenizer()
+    text = "The movie was great, really!"
+    assert [text[start:end] for start, end in tokenizer.offsets(text)] == \
+        ["The", "movie", "was", "great", ",", "really", "!"]
+
+
+def test_long_runs_without_spaces_count_several_tokens():
+    tokenizer = _ApproximateTokenizer()
+    encoded = "QUJD" * 100
+    offsets = tokenizer.offsets(f"see {encoded} here")
+    assert len(offsets) == 2 + len(encoded) // tokenizer.CHARS_PER_TOKEN
+    # The pieces cover the run without gaps
+    assert "".join(f"see {encoded} here"[start:end] for start, end in offsets[1:-1]) == encoded
+
+
+def test_cjk_characters_are_one_token_each():
+    tokenizer = _ApproximateTokenizer()
+    assert len(tokenizer.offsets("这部电影非常好看")) == 8
+    assert len(tokenizer.offsets("映画great")) == 3
+
+
+def test_windows_of_text_without_spaces_fit():
+    chunker = ReviewChunker(_ApproximateTokenizer(), max_tokens=50, stride=10)
+    review = "https://example.com/" + "a1" * 500
+    windows = chunker.split(review)
+    assert len(windows) > 1
+    assert all(len(window) <= 50 * _ApproximateTokenizer.CHARS_PER_TOKEN for window in windows)
+    assert windows[0].startswith("https") and review.endswith(windows[-1])
@@ -0,0 +1,38 @@
+"""
+test_get_backend.py
+
+Checks that a model being loaded by get_backend does not hold up the callers of the other models.
+
+Usage:
+    python -m pytest tests/test_get_backend.py
+"""
+
+import threading
+
+from serving import backends
+
+
+def test_loading_a_model_does_not_block_other_models(monkeypatch):
+    loading = threading.Event()
+    release = threading.Event()
+    create_backend = backends._create_backend
+
+    def slow_create_backend(model, kind):
+        if model == "test-org/slow":
+            loading.set()
+            release.wait(5)
+        return create_backend(model, kind)
+
+    monkeypatch.setattr(backends, "_create_backend", slow_create_backend)
+    results = []
+    loader = threading.Thread(target=lambda: results.append(backends.get_backend("test-org/slow", "remote")))
+    loader.start()
+    assert loading.wait(5)
+
+    # Another model is created while the slow one is still loading
+    assert isinstance(backends.get_backend("test-org/fast", "remote"), backends.RemoteBackend)
+    assert loader.is_alive()
+
+    release.set()
+    loader.join(5)
+    assert results[0] is backends.get_backend("test-org/slow", "remote")
@@ -0,0 +1,98 @@
+"""
+test_jobs.py
+
+Checks the claims of serving/jobs.py: a job has one owner at a time, a claim whose heartbeat stops is taken over, and
+the previous owner can not save results any more.
+
+Usage:
+    python -m pytest tests/test_jobs.py
+"""
+
+import pytest
+
+from serving.jobs import ClaimLost, JobRunner, JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs.sqlite")
+
+
+def test_a_job_is_claimed_once(store):
+    job_id = store.create(["good", "bad"], ["positive", "negative"])
+    claimed_id, owner = store.claim(stale_after=60)
+    assert claimed_id == job_id
+    assert store.get(job_id)["status"] == "running"
+    assert store.claim(stale_after=60) is None
+    assert store.heartbeat(job_id, owner)
+
+
+def test_jobs_are_claimed_in_order_of_creation(store):
+    first = store.create(["first"])
+    second = store.create(["second"])
+    assert store.claim(stale_after=60)[0] == first
+    assert store.claim(stale_after=60)[0] == second
+
+
+def test_stale_claim_is_taken_over(store):
+    job_id = store.create(["good", "bad"])
+    _, first_owner = store.claim(stale_after=60)
+    # The heartbeat of the first owner is older than stale_after
+    _, second_owner = store.claim(stale_after=-1)
+    assert second_owner != first_owner
+
+    assert not store.heartbeat(job_id, first_owner)
+    with pytest.raises(ClaimLost):
+        store.save_results(job_id, first_owner, [(0, 0.9, "positive", None)])
+    with pytest.raises(ClaimLost):
+        store.finish(job_id, first_owner)
+    assert store.get(job_id)["done"] == 0
+
+    assert store.heartbeat(job_id, second_owner)
+    store.save_results(job_id, second_owner, [(0, 0.9, "positive", None), (1, None, None, "ValueError: down")])
+    store.finish(job_id, second_owner)
+    job = store.get(job_id)
+    assert (job["status"], job["done"], job["failed"], job["progress"]) == ("done", 2, 1, 1.0)
+
+
+def test_heartbeat_keeps_a_claim(store):
+    job_id = store.create(["good"])
+    _, owner = store.claim(stale_after=60)
+    assert store.heartbeat(job_id, owner)
+    assert store.claim(stale_after=60) is None
+    # Finished jobs are neither refreshed nor claimed again
+    store.finish(job_id, owner)
+    assert not store.heartbeat(job_id, owner)
+    assert store.claim(stale_after=-1) is None
+
+
+def test_runner_scores_pending_reviews_in_chunks(store):
+    chunks = []
+
+    def score_chunk(reviews):
+        chunks.append(reviews)
+        return [ValueError("down") if review == "broken" else 0.9 if review == "good" else 0.1 for review in reviews]
+
+    job_id = store.create(["good", "bad", "broken", "good", "bad"], ["positive"] * 5)
+    runner = JobRunner(store, score_chunk, chunk_size=2)
+    runner.run(*store.claim(runner.stale_after))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+    job = store.get(job_id)
+    assert (job["status"], job["done"], job["failed"]) == ("done", 5, 1)
+    lines = "".join(store.export_predictions(job_id)).splitlines()
+    assert lines[0] == "review;Target;positive_score;Prediction"
+    assert lines[1:4] == ["good;positive;0.9;positive", "bad;positive;0.1;negative", "broken;positive;;"]
+
+
+def test_runner_stops_when_its_claim_is_lost(store):
+    job_id = store.create(["good", "bad", "good"])
+    _, owner = store.claim(stale_after=60)
+
+    def score_chunk(reviews):
+        store.claim(stale_after=-1)  # another runner takes the job over while the chunk is scored
+        return [0.9] * len(reviews)
+
+    with pytest.raises(ClaimLost):
+        JobRunner(store, score_chunk, chunk_size=1).run(job_id, owner)
+    assert store.get(job_id)["done"] == 0
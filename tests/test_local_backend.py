@@ -0,0 +1,120 @@
+"""
+test_local_backend.py
+
+Checks that LocalBackend answers with the contract of the backends (one list of {"label", "score"} per text, sorted by
+decreasing score, in the order of the input) on a tiny randomly initialized model saved with save_pretrained. Skipped
+when torch or transformers are not installed.
+
+Usage:
+    python -m pytest tests/test_local_backend.py
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from serving.backends import LocalBackend, get_backend
+
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "this", "the", "movie", "was", "great", "bad", "boring", "and",
+         "too", "long", "example", "is", "positive", "negative", "."]
+
+REVIEWS = ["the movie was great", "bad", "this movie was boring and too long and bad and boring .", "great great"]
+
+
+def save_tiny_model(folder, id2label):
+    """
+    Saves a randomly initialized bert of a single layer and its tokenizer to folder, as a model of the hub would be.
+    """
+    folder.mkdir(parents=True)
+    vocab_file = folder / "vocab.txt"
+    vocab_file.write_text("\n".join(VOCAB) + "\n", encoding="utf-8")
+    tokenizer = transformers.BertTokenizer(str(vocab_file), model_max_length=64)
+    config = transformers.BertConfig(
+        vocab_size=len(VOCAB), hidden_size=8, num_hidden_layers=1, num_attention_heads=2, intermediate_size=16,
+        max_position_embeddings=64, num_labels=len(id2label), id2label=id2label,
+        label2id={label: i for i, label in id2label.items()},
+    )
+    torch.manual_seed(0)
+    transformers.BertForSequenceClassification(config).save_pretrained(folder)
+    tokenizer.save_pretrained(folder)
+    return folder
+
+
+@pytest.fixture
+def sentiment_model(tmp_path):
+    return save_tiny_model(tmp_path / "test-org" / "tiny-sentiment", {0: "NEGATIVE", 1: "POSITIVE"})
+
+
+@pytest.fixture
+def nli_model(tmp_path):
+    return save_tiny_model(tmp_path / "test-org" / "tiny-nli", {0: "entailment", 1: "neutral", 2: "contradiction"})
+
+
+def check_contract(outputs, texts, labels):
+    assert len(outputs) == len(texts)
+    for output in outputs:
+        assert sorted(item["label"] for item in output) == sorted(labels)
+        assert all(set(item) == {"label", "score"} and isinstance(item["score"], float) for item in output)
+        scores = [item["score"] for item in output]
+        assert scores == sorted(scores, reverse=True)
+        assert sum(scores) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_text_classification_contract(sentiment_model):
+    backend = LocalBackend("test-org/tiny-sentiment", sentiment_model, batch_size=2)
+    outputs = backend.text_classification(REVIEWS, deadline=None)
+    check_contract(outputs, REVIEWS, ["NEGATIVE", "POSITIVE"])
+    assert backend.text_classification([]) == []
+
+
+def test_text_classification_keeps_input_order(sentiment_model):
+    # Texts are sorted by length and padded into batches, every text must still get its own scores
+    backend = LocalBackend("test-org/tiny-sentiment", sentiment_model, batch_size=2)
+    batched = backend.text_classification(REVIEWS)
+    for review, output in zip(REVIEWS, batched):
+        alone = backend.text_classification([review])[0]
+        assert {item["label"]: pytest.approx(item["score"], abs=1e-5) for item in alone} == \
+            {item["label"]: item["score"] for item in output}
+
+
+def test_text_classification_maps_labels(sentiment_model):
+    backend = LocalBackend("test-org/tiny-sentiment", sentiment_model)
+    network = transformers.AutoModelForSequenceClassification.from_pretrained(sentiment_model).eval()
+    tokenizer = transformers.AutoTokenizer.from_pretrained(sentiment_model)
+    with torch.inference_mode():
+        probabilities = network(**tokenizer(REVIEWS[0], return_tensors="pt")).logits.softmax(dim=-1)[0]
+    output = {item["label"]: item["score"] for item in backend.text_classification([REVIEWS[0]])[0]}
+    assert output["NEGATIVE"] == pytest.approx(float(probabilities[0]), abs=1e-5)
+    assert output["POSITIVE"] == pytest.approx(float(probabilities[1]), abs=1e-5)
+
+
+def test_zero_shot_classification_contract(nli_model):
+    backend = LocalBackend("test-org/tiny-nli", nli_model, batch_size=3)
+    candidate_labels = ["positive", "negative"]
+    outputs = backend.zero_shot_classification(REVIEWS, candidate_labels)
+    check_contract(outputs, REVIEWS, candidate_labels)
+    assert backend.zero_shot_classification([], candidate_labels) == []
+
+
+def test_zero_shot_classification_uses_entailment(nli_model):
+    backend = LocalBackend("test-org/tiny-nli", nli_model)
+    network = transformers.AutoModelForSequenceClassification.from_pretrained(nli_model).eval()
+    tokenizer = transformers.AutoTokenizer.from_pretrained(nli_model)
+    candidate_labels = ["positive", "negative"]
+    hypotheses = [backend.hypothesis_template.format(label) for label in candidate_labels]
+    with torch.inference_mode():
+        logits = network(**tokenizer([REVIEWS[0]] * 2, hypotheses, padding=True, return_tensors="pt")).logits
+    probabilities = logits[:, 0].softmax(dim=-1)  # entailment is label 0 of the model
+    outputs = backend.zero_shot_classification([REVIEWS[0]], candidate_labels)
+    output = {item["label"]: item["score"] for item in outputs[0]}
+    assert output["positive"] == pytest.approx(float(probabilities[0]), abs=1e-5)
+    assert output["negative"] == pytest.approx(float(probabilities[1]), abs=1e-5)
+
+
+def test_get_backend_loads_local_models_once(sentiment_model, monkeypatch):
+    monkeypatch.setenv("LOCAL_MODELS_DIR", str(sentiment_model.parent.parent))
+    backend = get_backend("test-org/tiny-sentiment", "local")
+    assert isinstance(backend, LocalBackend)
+    assert get_backend("test-org/tiny-sentiment", "local") is backend
@@ -0,0 +1,73 @@
+"""
+test_prediction_runner.py
+
+Checks how the runner of the prediction scripts handles adapters that do not score every review of a batch, and the
+latency it saves for every review.
+
+Usage:
+    python -m pytest tests/test_prediction_runner.py
+"""
+
+import time
+from math import isnan
+
+import pandas as pd
+import pytest
+
+import checkpoint as checkpoint_module
+from checkpoint import Checkpoint
+from prediction_runner import ModelAdapter, SentimentFunctionAdapter, run_predictions
+from serving.rate_limit import record_call_time
+
+
+REVIEWS = [f"review {i}" for i in range(7)]
+
+
+class TooFewScores(ModelAdapter):
+
+    batch_size = 3
+
+    def score_batch(self, reviews):
+        return [0.9] * (len(reviews) - 1)
+
+
+@pytest.fixture
+def checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint_module, "get_run_folder", lambda model_name: tmp_path)
+    run_checkpoint = Checkpoint("test-run")
+    yield run_checkpoint
+    run_checkpoint.remove()
+
+
+def test_too_few_scores_fail_with_the_batch(checkpoint):
+    with pytest.raises(ValueError, match="returned 2 scores for the 3 reviews of the batch starting at review_index 0"):
+        run_predictions(TooFewScores(), REVIEWS, checkpoint=checkpoint)
+
+
+def test_reviews_missing_from_the_dataframe_are_scored_again_on_resume(checkpoint):
+    def get_sentiment(reviews):
+        # Reviews containing "3" are dropped, as when the labels of the model are not found in its outputs
+        rows = [(i, review, 0.8) for i, review in enumerate(reviews) if "3" not in review]
+        return pd.DataFrame(rows, columns=["review_index", "review", "positive_score"])
+
+    predictions, _ = run_predictions(SentimentFunctionAdapter(get_sentiment, batch_size=3), REVIEWS,
+                                     checkpoint=checkpoint)
+    assert isnan(predictions['positive_score'][3])
+    assert pd.isna(predictions['Prediction'][3])
+    assert predictions['Prediction'][4] == 'positive'
+    assert sorted(checkpoint.completed_in(0, len(REVIEWS))) == [0, 1, 2, 4, 5, 6]
+
+
+class WaitsForTheLimiter(ModelAdapter):
+
+    batch_size = 4
+
+    def score_batch(self, reviews):
+        time.sleep(0.2)  # waits for the rate limit budget
+        record_call_time(0.4)
+        return [0.9] * len(reviews)
+
+
+def test_latency_is_the_call_time_per_review_without_limiter_waits(checkpoint):
+    predictions, _ = run_predictions(WaitsForTheLimiter(), REVIEWS, checkpoint=checkpoint)
+    assert list(predictions['latency']) == pytest.approx([0.1] * 4 + [0.4 / 3] * 3)
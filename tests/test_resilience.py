@@ -0,0 +1,201 @@
+"""
+test_resilience.py
+
+Checks the protections of serving/resilience.py around the calls to the model (fallbacks, circuit breaker, retries),
+with backends and calls that fail on demand instead of a provider, and a clock moved by hand.
+
+Usage:
+    python -m pytest tests/test_resilience.py
+"""
+
+import pytest
+
+from serving import resilience as resilience_module
+from serving.backends import Backend
+from serving.deadline import Deadline, DeadlineExceeded
+from serving.rate_limit import pop_thread_retries
+from serving.resilience import CircuitBreaker, CircuitOpenError, Resilience, retry_call
+
+
+class UnavailableError(Exception):
+    status_code = 503
+
+
+class FakeBackend(Backend):
+
+    def __init__(self, model, failures=0):
+        super().__init__(model)
+        self.failures = failures
+        self.calls = 0
+
+    def text_classification(self, texts, deadline=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise UnavailableError("Service unavailable")
+        return [[{"label": self.model, "score": 1.0}] for _ in texts]
+
+
+class FakeTime:
+    """
+    Clock of the module under test, moved by hand. Sleeping moves it forward at once.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(resilience_module, "time", clock)
+    return clock
+
+
+def fail():
+    raise UnavailableError("Service unavailable")
+
+
+@pytest.fixture
+def fallbacks(monkeypatch):
+    created = []
+
+    def get_backend(model, kind=None):
+        created.append((model, kind))
+        return FakeBackend(model)
+
+    monkeypatch.setattr(resilience_module, "get_backend", get_backend)
+    return created
+
+
+def test_fallback_model_scores_when_the_provider_is_down(fallbacks):
+    resilience = Resilience(CircuitBreaker(), fallback_model="test-org/small", max_retries=0)
+    outputs = resilience.wrap(FakeBackend("test-org/large", failures=1)).text_classification(["review"])
+    assert outputs == [[{"label": "test-org/small", "score": 1.0}]]
+    assert fallbacks == [("test-org/small", None)]
+
+
+def test_fallback_backend_keeps_the_model(fallbacks):
+    resilience = Resilience(CircuitBreaker(), fallback_kind="local", max_retries=0)
+    resilience.wrap(FakeBackend("test-org/large", failures=1)).text_classification(["review"])
+    assert fallbacks == [("test-org/large", "local")]
+
+
+def test_without_fallback_errors_are_raised(fallbacks):
+    resilience = Resilience(CircuitBreaker(), max_retries=0)
+    with pytest.raises(UnavailableError):
+        resilience.wrap(FakeBackend("test-org/large", failures=1)).text_classification(["review"])
+    assert fallbacks == []
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_time=10)
+    for _ in range(2):
+        with pytest.raises(UnavailableError):
+            breaker.call(fail)
+    assert breaker.state == "closed"
+    # A success resets the count of consecutive failures
+    assert breaker.call(lambda: "ok") == "ok"
+    for _ in range(3):
+        with pytest.raises(UnavailableError):
+            breaker.call(fail)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "not called")
+
+
+def test_breaker_lets_a_trial_call_through_after_the_recovery_time(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=10)
+    with pytest.raises(UnavailableError):
+        breaker.call(fail)
+    clock.now += 10
+    assert breaker.state == "half-open"
+
+    # A failed trial opens it again for a whole recovery time
+    with pytest.raises(UnavailableError):
+        breaker.call(fail)
+    assert breaker.state == "open"
+    clock.now += 5
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "not called")
+
+    # A successful trial closes it
+    clock.now += 5
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_breaker_ignores_errors_of_the_request(clock):
+    breaker = CircuitBreaker(failure_threshold=1)
+
+    def bad_request():
+        raise ValueError("invalid input")
+
+    def too_late():
+        raise DeadlineExceeded("deadline exceeded")
+
+    for func, error in ((bad_request, ValueError), (too_late, DeadlineExceeded)):
+        with pytest.raises(error):
+            breaker.call(func)
+    assert breaker.state == "closed"
+
+
+def test_retry_call_retries_transient_errors(clock):
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            fail()
+        return "ok"
+
+    pop_thread_retries()
+    assert retry_call(flaky, max_retries=3, base_delay=1, max_delay=8) == "ok"
+    assert len(attempts) == 3
+    assert pop_thread_retries() == 2
+    # Full jitter: every wait is at most the capped exponential delay
+    assert len(clock.sleeps) == 2
+    assert all(0 <= wait <= 2 ** i for i, wait in enumerate(clock.sleeps))
+
+
+def test_retry_call_gives_up(clock):
+    attempts = []
+
+    def always_down():
+        attempts.append(1)
+        fail()
+
+    with pytest.raises(UnavailableError):
+        retry_call(always_down, max_retries=2)
+    assert len(attempts) == 3
+
+    def bad_request():
+        attempts.append(1)
+        raise ValueError("invalid input")
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        retry_call(bad_request, max_retries=2)
+    assert len(attempts) == 1
+
+
+class AlmostExpired(Deadline):
+
+    def remaining(self):
+        return 1e-6
+
+
+def test_retry_call_stops_at_the_deadline(clock):
+    with pytest.raises(DeadlineExceeded):
+        retry_call(lambda: "not called", deadline=Deadline(-1))
+    # No retry whose wait would end after the deadline
+    with pytest.raises(UnavailableError):
+        retry_call(fail, deadline=AlmostExpired(60), max_retries=5, base_delay=10, max_delay=10)
+    assert clock.sleeps == []
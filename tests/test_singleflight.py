@@ -0,0 +1,87 @@
+"""
+test_singleflight.py
+
+Checks that serving/singleflight.py makes a single call for the identical calls in flight at the same time.
+
+Usage:
+    python -m pytest tests/test_singleflight.py
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from serving.singleflight import SingleFlight
+
+
+def test_concurrent_calls_of_a_key_are_made_once():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "score"
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        leader = executor.submit(flight.do, "review", call)
+        assert started.wait(5)
+        followers = [executor.submit(flight.do, "review", call) for _ in range(4)]
+        while flight.coalesced < 4:
+            threading.Event().wait(0.01)
+        assert flight.in_flight() == 1
+        release.set()
+        assert [future.result(5) for future in [leader] + followers] == ["score"] * 5
+    assert len(calls) == 1
+    assert flight.in_flight() == 0
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError("provider down")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, "review", failing)
+        assert started.wait(5)
+        follower = executor.submit(flight.do, "review", failing)
+        while flight.coalesced < 1:
+            threading.Event().wait(0.01)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result(5)
+    # The next call is made again
+    assert flight.do("review", lambda: "score") == "score"
+
+
+def test_different_keys_and_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("a", lambda: 2) == 2
+    assert flight.do("b", lambda: 3) == 3
+    assert flight.coalesced == 0
+
+
+def test_submit_shares_the_future_until_it_is_done():
+    flight = SingleFlight()
+    future = Future()
+    starts = []
+
+    def start():
+        starts.append(1)
+        return future
+
+    assert flight.submit("review", start) is future
+    assert flight.submit("review", start) is future
+    assert len(starts) == 1 and flight.coalesced == 1
+    future.set_result("score")
+    assert flight.in_flight() == 0
+    assert flight.submit("review", lambda: Future()) is not future
@@ -0,0 +1,129 @@
+"""
+test_streaming_metrics.py
+
+Checks the single-pass metrics of streaming_metrics against sklearn on random predictions, fed in chunks of uneven
+size the way model-logging.py reads them. Skipped when scikit-learn is not installed.
+
+Usage:
+    python -m pytest tests/test_streaming_metrics.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+metrics = pytest.importorskip("sklearn.metrics")
+calibration = pytest.importorskip("sklearn.calibration")
+
+from streaming_metrics import MetricAccumulator, ThresholdSweep
+
+
+def random_predictions(reviews, seed, decimals=2):
+    """
+    Predictions of a made-up model: scores leaning towards the right class, rounded so that some of them are tied, a
+    few exactly 0 or 1 and a few missing (failed calls).
+    """
+    rng = np.random.default_rng(seed)
+    positive = rng.random(reviews) < 0.4
+    scores = np.clip(rng.normal(np.where(positive, 0.65, 0.35), 0.25), 0, 1)
+    scores = scores.round(decimals) if decimals is not None else scores
+    scores[rng.random(reviews) < 0.02] = np.nan
+    return pd.DataFrame({
+        'Target': np.where(positive, 'positive', 'negative'),
+        'Prediction': np.where(np.nan_to_num(scores) > 0.5, 'positive', 'negative'),
+        'positive_score': scores,
+        'latency': rng.exponential(0.3, reviews),
+    })
+
+
+def chunks_of(df, sizes=(1, 7, 100, 333)):
+    start, i = 0, 0
+    while start < len(df):
+        yield df.iloc[start:start + sizes[i % len(sizes)]]
+        start += sizes[i % len(sizes)]
+        i += 1
+
+
+@pytest.fixture(params=[0, 1, 2])
+def predictions(request):
+    return random_predictions(2000, request.param)
+
+
+def test_classification_report_matches_sklearn(predictions):
+    accumulator = MetricAccumulator()
+    for chunk in chunks_of(predictions):
+        accumulator.update(chunk)
+    expected = metrics.classification_report(predictions['Target'], predictions['Prediction'], output_dict=True)
+    report = accumulator.classification_report()
+    assert report.keys() == expected.keys()
+    assert report['accuracy'] == pytest.approx(expected['accuracy'])
+    for label in ('negative', 'positive', 'macro avg', 'weighted avg'):
+        assert report[label] == pytest.approx(expected[label])
+
+
+def test_mae_matches_sklearn(predictions):
+    accumulator = MetricAccumulator()
+    for chunk in chunks_of(predictions):
+        accumulator.update(chunk)
+    scored = predictions.dropna(subset=['positive_score'])
+    truth = (scored['Target'] == 'positive').astype(float)
+    scores = scored['positive_score']
+    assert accumulator.mae() == pytest.approx(metrics.mean_absolute_error(truth, scores))
+    positive = scored['Target'] == 'positive'
+    mae_positive, mae_negative = accumulator.mae_per_label()
+    assert mae_positive == pytest.approx(metrics.mean_absolute_error(truth[positive], scores[positive]))
+    assert mae_negative == pytest.approx(metrics.mean_absolute_error(truth[~positive], scores[~positive]))
+
+
+def test_threshold_sweep_matches_sklearn(predictions):
+    sweep = ThresholdSweep()
+    for chunk in chunks_of(predictions):
+        sweep.update(chunk)
+    curves = sweep.curves()
+    summary = sweep.summary(curves, metric='f1')
+
+    scored = predictions.dropna(subset=['positive_score'])
+    truth = scored['Target'] == 'positive'
+    scores = scored['positive_score']
+    assert summary['roc_auc'] == pytest.approx(metrics.roc_auc_score(truth, scores))
+    assert summary['pr_auc'] == pytest.approx(metrics.average_precision_score(truth, scores))
+
+    # Every threshold is a valid decision threshold, and its metrics are the ones of predicting score > threshold
+    assert ((curves['threshold'] >= 0) & (curves['threshold'] <= 1)).all()
+    for i in range(1, len(curves['threshold']) - 1, 7):
+        predicted = scores > curves['threshold'][i]
+        assert curves['precision'][i] == pytest.approx(metrics.precision_score(truth, predicted, zero_division=1.0))
+        assert curves['recall'][i] == pytest.approx(metrics.recall_score(truth, predicted))
+        assert curves['f1'][i] == pytest.approx(metrics.f1_score(truth, predicted))
+        assert curves['accuracy'][i] == pytest.approx(metrics.accuracy_score(truth, predicted))
+
+    best = scores > summary['best_threshold']
+    assert summary['best_threshold_f1'] == pytest.approx(metrics.f1_score(truth, best))
+    assert summary['best_threshold_f1'] == pytest.approx(curves['f1'].max())
+
+
+def test_downsampled_curves_keep_exact_rows(predictions):
+    sweep = ThresholdSweep()
+    sweep.update(predictions)
+    curves = sweep.curves()
+    sampled = ThresholdSweep.downsample(curves, points=11)
+    assert len(sampled['threshold']) <= 13
+    assert sampled['threshold'][0] == curves['threshold'][0]
+    assert sampled['threshold'][-1] == curves['threshold'][-1]
+    rows = np.searchsorted(-curves['threshold'], -sampled['threshold'])
+    for name, values in sampled.items():
+        assert np.array_equal(values, curves[name][rows])
+
+
+def test_calibration_matches_sklearn():
+    # Scores are not rounded, sklearn puts the scores on a bin edge in the lower bin and the sweep in the upper one
+    predictions = random_predictions(2000, 0, decimals=None)
+    sweep = ThresholdSweep(calibration_bins=10)
+    sweep.update(predictions)
+    table, _ = sweep.calibration()
+    scored = predictions.dropna(subset=['positive_score'])
+    positive_rate, mean_score = calibration.calibration_curve(scored['Target'] == 'positive', scored['positive_score'],
+                                                              n_bins=10)
+    filled = [row for row in table if row['reviews']]
+    assert [row['positive_rate'] for row in filled] == pytest.approx(list(positive_rate))
+    assert [row['mean_score'] for row in filled] == pytest.approx(list(mean_score))